@@ -1,21 +1,44 @@
-from asyncio import AbstractEventLoop
-import json
-from time import sleep
+import asyncio
+from asyncio import AbstractEventLoop, gather, sleep as async_sleep
+from concurrent.futures import ProcessPoolExecutor
+import hmac
+from multiprocessing import get_context
+import os
+import tempfile
 
+from aiohttp import web
 import click
 from sanic import Sanic
 from sanic import response
 
+from .embedded_store import EmbeddedKeyValueStore
+from .events import EventConsumer, encode_event
 from .h_client import HypothesisAPIClient
 from .index import AnnotationCountIndex
-from .index_fetcher import Annotation, ElasticsearchFetcher, HypothesisAPIFetcher
-from .kv_store import KeyValueStore
-from .util import error_response, get_logger, optional_env
+from .index_fetcher import ElasticsearchFetcher, HypothesisAPIFetcher
+from .ingest import FORMATS, ingest_file
+from .kv_store import ClusterKeyValueStore, KeyValueStore
+from .metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, REGISTRY
+from .principals import PrincipalsCache
+from . import profiler
+from .scheduler import AdaptiveScheduler
+from .snapshot import export_snapshot, import_snapshot
+from .uri_filter import URIFilter
+from .util import error_response, get_logger, optional_env, parse_flag
 from .util import run_async_task
 
 
 app = Sanic()
 
+# Maximum number of URLs that can be looked up in one `/counts` request.
+MAX_URLS_PER_REQUEST = 500
+
+# Maximum number of events that can be submitted in one `/events` request.
+MAX_EVENTS_PER_REQUEST = 1000
+
+# Maximum duration in seconds of one `/debug/profile` request.
+MAX_PROFILE_SECONDS = 60
+
 
 @app.get('/count')
 async def count(request):
@@ -30,23 +53,240 @@ async def count(request):
     # These are cached in redis for a period of time to reduce the number of
     # requests made to "h".
     access_token = request.headers.get('Authorization')
-    count = await request.app.ann_count_index.fetch_count(url, access_token)
-    return response.json({'count': count})
+    index = request.app.ann_count_index
+
+    # The count and the version of the URL are read together, so answering a
+    # repeated request costs no more than counting.
+    count, tag = await index.fetch_count_and_tag(url, access_token)
+    etag = f'"{tag}"'
+    headers = _count_cache_headers(etag, access_token)
+    if _etag_matches(request.headers.get('If-None-Match'), etag):
+        return response.HTTPResponse(status=304, headers=headers)
+    return response.json({'count': count}, headers=headers)
+
+
+def _count_cache_headers(etag, access_token):
+    max_age = optional_env('COUNT_CACHE_MAX_AGE', int, 10)
+    visibility = 'private' if access_token else 'public'
+    return {'ETag': etag,
+            'Cache-Control': f'{visibility}, max-age={max_age}',
+            'Vary': 'Authorization'}
+
+
+def _etag_matches(if_none_match, etag):
+    """
+    Return whether an `If-None-Match` header matches `etag`.
+    """
+    if not if_none_match:
+        return False
+    for candidate in if_none_match.split(','):
+        candidate = candidate.strip()
+        if candidate.startswith('W/'):
+            candidate = candidate[2:]
+        if candidate in ('*', etag):
+            return True
+    return False
+
+
+@app.post('/counts')
+async def counts(request):
+    """
+    Return the number of annotations on each of a list of URLs.
+
+    The request body is a JSON object with a "urls" list. The response maps
+    each URL to its count.
+    """
+    body = request.json
+    urls = body.get('urls') if isinstance(body, dict) else None
+    if not isinstance(urls, list) or not all(isinstance(u, str) for u in urls):
+        return error_response('request body must contain a "urls" list')
+    if len(urls) > MAX_URLS_PER_REQUEST:
+        return error_response(f'at most {MAX_URLS_PER_REQUEST} URLs may be requested at once')
+
+    access_token = request.headers.get('Authorization')
+    counts = await request.app.ann_count_index.fetch_counts(urls, access_token)
+    return response.json({'counts': counts})
 
 
 @app.post('/delete/<id>')
 async def delete(request, id):
     index = request.app.ann_count_index
-    found = index.remove_annotation(id)
+    found = await index.remove_annotation(id)
     return response.json({'removed': found})
 
 
+@app.post('/invalidate/<userid>')
+async def invalidate(request, userid):
+    """
+    Discard the cached profile and groups of a user.
+
+    h calls this when the user joins or leaves a group. Requests must be
+    authorized with the `INVALIDATION_TOKEN` secret as a bearer token.
+    """
+    token = optional_env('INVALIDATION_TOKEN', str, '')
+    if not token:
+        return error_response('invalidation is not enabled', status=404)
+    if not _has_bearer_token(request, token):
+        return error_response('invalid authorization', status=401)
+    invalidated = await request.app.ann_count_index.invalidate_principals(userid)
+    return response.json({'invalidated': invalidated})
+
+
+@app.post('/events')
+async def events(request):
+    """
+    Queue annotation events for the indexer.
+
+    The request body is a JSON object with an "events" list. See
+    `events.encode_event` for the format of each event. Requests must be
+    authorized with the `EVENTS_TOKEN` secret as a bearer token.
+    """
+    settings = _get_event_settings()
+    if not settings['stream'] or not settings['token']:
+        return error_response('event ingest is not enabled', status=404)
+    if not _has_bearer_token(request, settings['token']):
+        return error_response('invalid authorization', status=401)
+
+    body = request.json
+    events = body.get('events') if isinstance(body, dict) else None
+    if not isinstance(events, list):
+        return error_response('request body must contain an "events" list')
+    if len(events) > MAX_EVENTS_PER_REQUEST:
+        return error_response(f'at most {MAX_EVENTS_PER_REQUEST} events may be submitted at once')
+    try:
+        entries = [encode_event(event) for event in events]
+    except ValueError as ex:
+        return error_response(str(ex))
+
+    kv_store = request.app.ann_count_index.kv_store
+    await kv_store.append_to_stream(settings['stream'], entries,
+                                    maxlen=settings['maxlen'])
+    return response.json({'accepted': len(entries)}, status=202)
+
+
+@app.get('/ready')
+async def ready(request):
+    """
+    Report whether this worker is ready to serve requests.
+
+    A worker is ready once it knows the h API's routes and can reach Redis.
+    """
+    index = request.app.ann_count_index
+    checks = {'h_api': index.h_api.ready}
+    try:
+        checks['redis'] = bool(await index.kv_store.ping())
+    except Exception:
+        checks['redis'] = False
+    status = 200 if all(checks.values()) else 503
+    return response.json({'ready': status == 200, 'checks': checks}, status=status)
+
+
+@app.get('/metrics')
+async def metrics(request):
+    """
+    Return the server's metrics in the Prometheus text format.
+    """
+    body = await _render_metrics(request.app.ann_count_index)
+    return response.text(body, content_type=METRICS_CONTENT_TYPE)
+
+
+@app.get('/debug/profile')
+async def debug_profile(request):
+    """
+    Profile the server for a number of seconds and return the folded stacks.
+
+    This is only available if `PROFILER_ENABLED` is set.
+    """
+    if not request.app.profiler_enabled:
+        return error_response('profiling is not enabled', status=404)
+    try:
+        seconds = float(request.args.get('seconds', 10))
+    except ValueError:
+        return error_response('"seconds" must be a number')
+    if not 0 < seconds <= MAX_PROFILE_SECONDS:
+        return error_response(f'"seconds" must be between 0 and {MAX_PROFILE_SECONDS}')
+    stacks = await profiler.profile(seconds)
+    return response.text(stacks)
+
+
+def _has_bearer_token(request, token):
+    expected = f'Bearer {token}'
+    return hmac.compare_digest(request.headers.get('Authorization', ''), expected)
+
+
+async def _render_metrics(index):
+    logger = get_logger(__name__)
+    try:
+        await index.indexer_lag()
+    except Exception as ex:
+        logger.warning(f'failed to read indexer position: {ex}')
+    return REGISTRY.render()
+
+
 @app.listener('before_server_start')
 def before_start(app, loop):
     # Instantiate the count index client.
     # This is done as a "before_server_start" listener in order to be able to
     # pass Sanic's event loop to `_get_index`.
     app.ann_count_index = _get_index(loop)
+    app.profiler_enabled = optional_env('PROFILER_ENABLED', parse_flag, False)
+
+
+@app.listener('after_server_start')
+def after_start(app, loop):
+    # When events are pushed, annotations are indexed within moments, so the
+    # filter is refreshed often enough for the first annotation of a URL to be
+    # counted soon after. A refresh which finds no change is a single read.
+    default_refresh_interval = 1.0 if _get_event_settings()['stream'] else 30.0
+    refresh_interval = optional_env('URI_FILTER_REFRESH_INTERVAL', float,
+                                    default_refresh_interval)
+    if refresh_interval > 0:
+        app.add_task(_refresh_uri_filter(app.ann_count_index.uri_filter,
+                                         refresh_interval))
+
+    # Routes loaded from the cache file are used until they have been
+    # rediscovered, so that startup does not wait for h.
+    h_api_client = app.ann_count_index.h_api
+    routes_interval = optional_env('H_ROUTES_REFRESH_INTERVAL', float, 3600.0)
+    if routes_interval > 0:
+        app.add_task(h_api_client.refresh_routes_periodically(routes_interval))
+
+
+async def _refresh_uri_filter(uri_filter, interval):
+    logger = get_logger(__name__)
+    while True:
+        try:
+            await uri_filter.refresh()
+        except Exception as ex:
+            logger.warning(f'failed to refresh URI filter: {ex}')
+        await async_sleep(interval)
+
+
+def _get_event_settings():
+    return {
+        'stream': optional_env('EVENTS_STREAM', str, ''),
+        'group': optional_env('EVENTS_GROUP', str, 'indexer'),
+        'token': optional_env('EVENTS_TOKEN', str, ''),
+        'maxlen': optional_env('EVENTS_MAXLEN', int, 1000000),
+    }
+
+
+def _es_max_request_rate():
+    """
+    Return the maximum rate of requests to Elasticsearch, or `None` for no
+    limit.
+
+    `ES_BATCH_FETCH_DELAY`, the minimum time between requests, is still
+    accepted in place of `ES_MAX_REQUEST_RATE`.
+    """
+    rate = optional_env('ES_MAX_REQUEST_RATE', float, None)
+    if rate is None:
+        delay = optional_env('ES_BATCH_FETCH_DELAY', float, None)
+        if delay is None:
+            rate = 2.0
+        elif delay > 0:
+            rate = 1 / delay
+    return rate or None
 
 
 def _get_index(loop: AbstractEventLoop=None):
@@ -55,26 +295,90 @@ def _get_index(loop: AbstractEventLoop=None):
                                'http://localhost:9200'),
         'es.fetch_from_es': optional_env('FETCH_FROM_ELASTICSEARCH',
                                          bool, True),
+        'es.index': optional_env('ELASTICSEARCH_INDEX', str, 'hypothesis'),
+        'es.batch_size': optional_env('ES_BATCH_SIZE', int, 1000),
+        'es.max_request_rate': _es_max_request_rate(),
+        'es.tiebreaker_field': optional_env('ES_TIEBREAKER_FIELD', str, '_id'),
+        'kv.backend': optional_env('KV_BACKEND', str, 'redis'),
+        'kv.path': optional_env('KV_PATH', str, 'badger.db'),
+        'kv.mmap_size': optional_env('KV_MMAP_SIZE', int, 2**30),
         'redis.host': optional_env('REDIS_HOST', str, '0.0.0.0'),
         'redis.port': optional_env('REDIS_PORT', int, 6379),
+        'redis.db': optional_env('REDIS_DB', int, 0),
+        'redis.cluster': optional_env('REDIS_CLUSTER', parse_flag, False),
+        'redis.batch_window': optional_env('REDIS_BATCH_WINDOW', float, 0.0),
+        'redis.batch_max_keys': optional_env('REDIS_BATCH_MAX_KEYS', int, 1000),
+        'redis.max_connections': optional_env('REDIS_MAX_CONNECTIONS', int, 50),
+        'redis.timeout': optional_env('REDIS_TIMEOUT', float, 5.0),
+        'redis.pool_timeout': optional_env('REDIS_POOL_TIMEOUT', float, 1.0),
         'h.api': optional_env('H_API_URL', str,
                               'http://localhost:5000/api'),
+        'h.routes_cache': optional_env('H_ROUTES_CACHE', str,
+                                       os.path.join(tempfile.gettempdir(),
+                                                    'badger-h-routes.json')),
+        'principals.cache_size': optional_env('PRINCIPALS_CACHE_SIZE', int,
+                                              10000),
+        'principals.cache_ttl': optional_env('PRINCIPALS_CACHE_TTL', float,
+                                             10.0),
+        'principals.soft_ttl': optional_env('PRINCIPALS_SOFT_TTL', float, 300.0),
+        'principals.hard_ttl': optional_env('PRINCIPALS_HARD_TTL', float, 86400.0),
+        'principals.anonymous_groups': optional_env('ANONYMOUS_GROUPS',
+                                                    lambda val: val.split(','),
+                                                    ['__world__']),
+        'uri_filter.bits': optional_env('URI_FILTER_BITS', int, 2**27),
+        'index.counter_layout': optional_env('COUNTER_LAYOUT', str, 'keys'),
+        'index.ann_layout': optional_env('ANN_LAYOUT', str, 'keys'),
     }
 
     logger = get_logger(__name__)
-    logger.info(f'using Redis server {settings["redis.host"]}:{settings["redis.port"]}')
     logger.info(f'using H service {settings["h.api"]}')
 
-    kv_store = KeyValueStore(redis_host=settings['redis.host'],
-                             redis_port=settings['redis.port'])
-    h_api_client = HypothesisAPIClient(settings['h.api'], loop=loop)
+    if settings['kv.backend'] == 'embedded':
+        logger.info(f'using embedded store {settings["kv.path"]}')
+        kv_store = EmbeddedKeyValueStore(settings['kv.path'],
+                                         mmap_size=settings['kv.mmap_size'],
+                                         timeout=settings['redis.timeout'])
+    elif settings['kv.backend'] != 'redis':
+        raise ValueError(f'unknown KV_BACKEND: {settings["kv.backend"]}')
+    elif settings['redis.cluster']:
+        logger.info(f'using Redis Cluster {settings["redis.host"]}:{settings["redis.port"]}')
+        kv_store = ClusterKeyValueStore(redis_host=settings['redis.host'],
+                                        redis_port=settings['redis.port'],
+                                        max_connections=settings['redis.max_connections'],
+                                        timeout=settings['redis.timeout'],
+                                        batch_window=settings['redis.batch_window'],
+                                        batch_max_keys=settings['redis.batch_max_keys'])
+    else:
+        logger.info(f'using Redis server {settings["redis.host"]}:{settings["redis.port"]}')
+        kv_store = KeyValueStore(redis_host=settings['redis.host'],
+                                 redis_port=settings['redis.port'],
+                                 max_connections=settings['redis.max_connections'],
+                                 timeout=settings['redis.timeout'],
+                                 pool_timeout=settings['redis.pool_timeout'],
+                                 redis_db=settings['redis.db'],
+                                 batch_window=settings['redis.batch_window'],
+                                 batch_max_keys=settings['redis.batch_max_keys'])
+    h_api_client = HypothesisAPIClient(settings['h.api'], loop=loop,
+                                       routes_cache=settings['h.routes_cache'])
 
     if settings['es.fetch_from_es']:
         ann_fetcher = ElasticsearchFetcher(settings['es.url'], loop=loop,
-                                           batch_fetch_delay=5.0)
+                                           max_request_rate=settings['es.max_request_rate'],
+                                           batch_size=settings['es.batch_size'],
+                                           tiebreaker_field=settings['es.tiebreaker_field'],
+                                           es_index=settings['es.index'])
     else:
         ann_fetcher = HypothesisAPIFetcher(h_api_client)
-    ann_count_index = AnnotationCountIndex(h_api_client, ann_fetcher, kv_store)
+    principals_cache = PrincipalsCache(maxsize=settings['principals.cache_size'],
+                                       ttl=settings['principals.cache_ttl'])
+    uri_filter = URIFilter(kv_store, bits=settings['uri_filter.bits'])
+    ann_count_index = AnnotationCountIndex(h_api_client, ann_fetcher, kv_store,
+                                           principals_cache, uri_filter,
+                                           counter_layout=settings['index.counter_layout'],
+                                           ann_layout=settings['index.ann_layout'],
+                                           principals_soft_ttl=settings['principals.soft_ttl'],
+                                           principals_hard_ttl=settings['principals.hard_ttl'],
+                                           anonymous_groups=settings['principals.anonymous_groups'])
     return ann_count_index
 
 
@@ -84,44 +388,283 @@ def cli():
 
 
 @cli.command(help='Run the web server')
-def server():
-    app.run(host='0.0.0.0', port=8001)
+@click.option('--host', default='0.0.0.0', help='Address to listen on')
+@click.option('--port', default=8001, help='Port to listen on')
+@click.option('--workers', type=int,
+              help='Number of worker processes sharing the port (default: SERVER_WORKERS or 1)')
+def server(host, port, workers):
+    if workers is None:
+        workers = optional_env('SERVER_WORKERS', int, 1)
+    _use_uvloop()
+    app.run(host=host, port=port, workers=workers)
+
+
+def _use_uvloop():
+    """
+    Use uvloop's event loop, if it is installed.
+    """
+    logger = get_logger(__name__)
+    try:
+        import uvloop
+    except ImportError:
+        logger.info('uvloop is not installed, using the default event loop')
+        return
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
 
 
 @cli.command(help='Run the indexing server')
 def indexer():
+    event_settings = _get_event_settings()
+
+    # When events are pushed to the indexer, polling only needs to catch
+    # annotations whose events were lost.
+    default_max_delay = 300.0 if event_settings['stream'] else 60.0
+    scheduler = AdaptiveScheduler(
+        min_delay=optional_env('INDEXER_MIN_DELAY', float, 1.0),
+        max_delay=optional_env('INDEXER_MAX_DELAY', float, default_max_delay))
+
     async def run():
         index = _get_index()
-        while True:
-            await index.incremental_index()
-            sleep(5)
+        metrics_port = optional_env('INDEXER_METRICS_PORT', int, 8002)
+        if metrics_port:
+            await _start_metrics_server(index, metrics_port)
+        tasks = [scheduler.run(index.incremental_index)]
+        if event_settings['stream']:
+            consumer = EventConsumer(index, event_settings['stream'],
+                                     group=event_settings['group'])
+            tasks.append(consumer.run())
+        # If the consumer stops, eg. because the consumer group cannot be
+        # created, the indexer exits rather than silently falling back to
+        # polling.
+        await gather(*tasks)
 
     run_async_task(run())
 
 
+async def _start_metrics_server(index, port):
+    """
+    Serve the `/metrics` and `/debug/profile` endpoints for a process which
+    does not run the web server.
+    """
+    profiler_enabled = optional_env('PROFILER_ENABLED', parse_flag, False)
+
+    async def metrics_handler(request):
+        body = await _render_metrics(index)
+        return web.Response(text=body, headers={'Content-Type': METRICS_CONTENT_TYPE})
+
+    async def profile_handler(request):
+        if not profiler_enabled:
+            raise web.HTTPNotFound()
+        seconds = min(float(request.query.get('seconds', 10)), MAX_PROFILE_SECONDS)
+        return web.Response(text=await profiler.profile(seconds))
+
+    metrics_app = web.Application()
+    metrics_app.router.add_get('/metrics', metrics_handler)
+    metrics_app.router.add_get('/debug/profile', profile_handler)
+    runner = web.AppRunner(metrics_app)
+    await runner.setup()
+    await web.TCPSite(runner, '0.0.0.0', port).start()
+    get_logger(__name__).info(f'serving metrics on port {port}')
+
+
+@cli.command(help='Build the index from scratch using parallel worker processes')
+@click.option('--workers', default=os.cpu_count(), help='Number of worker processes')
+@click.option('--partitions', type=int,
+              help='Number of partitions to split annotations into (default: workers)')
+@click.option('--restart', is_flag=True,
+              help='Discard the progress of an interrupted backfill')
+def backfill(workers, partitions, restart):
+    if not optional_env('FETCH_FROM_ELASTICSEARCH', bool, True):
+        raise click.UsageError('backfill requires FETCH_FROM_ELASTICSEARCH')
+
+    # Fetch from Elasticsearch as fast as possible unless configured otherwise.
+    # This is inherited by the worker processes.
+    if 'ES_BATCH_FETCH_DELAY' not in os.environ:
+        os.environ.setdefault('ES_MAX_REQUEST_RATE', '0')
+
+    logger = get_logger(__name__)
+
+    async def plan_backfill():
+        index = _get_index()
+        return await index.plan_backfill(partitions or workers, restart=restart)
+
+    plan = run_async_task(plan_backfill())
+    logger.info(f'backfilling {len(plan)} partitions using {workers} workers')
+
+    # Worker processes are spawned rather than forked so that they do not
+    # inherit this process' event loop and connections.
+    with ProcessPoolExecutor(workers, mp_context=get_context('spawn')) as pool:
+        starts = [start for start, _ in plan]
+        ends = [end for _, end in plan]
+        for partition, last_created in enumerate(pool.map(_backfill_partition,
+                                                          range(len(plan)),
+                                                          starts, ends)):
+            logger.info(f'partition {partition} complete, last annotation created {last_created}')
+
+    async def finish_backfill():
+        index = _get_index()
+        return await index.finish_backfill()
+
+    if run_async_task(finish_backfill()):
+        logger.info('backfill complete')
+    else:
+        logger.error('backfill incomplete, run the command again to resume')
+
+
+def _backfill_partition(partition, start, end):
+    async def run():
+        index = _get_index()
+        return await index.backfill_partition(partition, start, end)
+
+    return run_async_task(run())
+
+
 @cli.command(help='Index annotations from a file')
 @click.argument('path')
-def index_from_file(path):
+@click.option('--format', type=click.Choice(FORMATS),
+              help='Format of the file (default: detected from its contents)')
+@click.option('--workers', type=int, help='Number of processes used to decode the file')
+def index_from_file(path, format, workers):
+    async def run():
+        logger = get_logger(__name__)
+        index = _get_index()
+
+        def log_progress(read_count):
+            logger.info(f'indexed {read_count} annotations from {path}')
+
+        await ingest_file(index, path, format=format, workers=workers,
+                          on_progress=log_progress)
+
+    run_async_task(run())
+
+
+@cli.group(help='Export or import snapshots of the index')
+def snapshot():
+    pass
+
+
+@snapshot.command(name='export', help='Write a snapshot of the index to a file')
+@click.argument('path')
+def export_snapshot_cmd(path):
+    async def run():
+        logger = get_logger(__name__)
+        index = _get_index()
+
+        def log_progress(count):
+            logger.info(f'exported {count} keys to {path}')
+
+        count = await export_snapshot(index, path, on_progress=log_progress)
+        logger.info(f'exported {count} keys ({os.path.getsize(path)} bytes) to {path}')
+
+    run_async_task(run())
+
+
+@snapshot.command(name='import', help='Load a snapshot of the index from a file')
+@click.argument('path')
+@click.option('--catch-up/--no-catch-up', default=True,
+              help='Index annotations added since the snapshot was taken')
+def import_snapshot_cmd(path, catch_up):
+    async def run():
+        logger = get_logger(__name__)
+        index = _get_index()
+
+        def log_progress(count):
+            logger.info(f'imported {count} keys from {path}')
+
+        header = await import_snapshot(index, path, on_progress=log_progress)
+        logger.info(f'imported {header["keys"]} keys from a snapshot taken at '
+                    f'{header["created"]}')
+        if catch_up:
+            new_anns = await index.incremental_index()
+            logger.info(f'indexed {new_anns} annotations added since the snapshot')
+
+    run_async_task(run())
+
+
+@cli.command(help='Build the filter of annotated URIs for an existing index')
+def build_uri_filter():
     async def run():
         logger = get_logger(__name__)
         index = _get_index()
-        buffer = []
-        indexed_count = 0
+        scanned = await index.build_uri_filter()
+        logger.info(f'added URIs of {scanned} counters to the URI filter')
 
-        for line in open(path):
-            if '""""' in line:
-                search_response = json.loads('\n'.join(buffer))
-                anns = [Annotation.from_api_ann(ann) for ann in search_response['rows']]
-                buffer = []
-                index.index_annotations(anns)
-                indexed_count += len(anns)
+    run_async_task(run())
 
-                logger.info(f'indexed {indexed_count} annotations from {path}')
-            else:
-                buffer.append(line)
+
+@cli.command(help='Build the digest used by "reconcile" for an existing index')
+def build_digest():
+    async def run():
+        logger = get_logger(__name__)
+        index = _get_index()
+        await index.build_digest()
+        logger.info('built the index digest')
 
     run_async_task(run())
 
 
+@cli.command(help='Correct differences between the index and Elasticsearch')
+def reconcile():
+    if not optional_env('FETCH_FROM_ELASTICSEARCH', bool, True):
+        raise click.UsageError('reconcile requires FETCH_FROM_ELASTICSEARCH')
+
+    async def run():
+        logger = get_logger(__name__)
+        index = _get_index()
+        report = await index.reconcile()
+        logger.info(f'{report["buckets"]} digest buckets ({report["sub_buckets"]} '
+                    f'sub-buckets) differed: '
+                    f'added {report["added"]}, moved {report["moved"]} and '
+                    f'removed {report["removed"]} annotations, corrected '
+                    f'{report["counters"]} counters')
+
+    run_async_task(run())
+
+
+@cli.command(help='Convert counters to the "hash" layout (see COUNTER_LAYOUT)')
+def migrate_counters():
+    async def run():
+        logger = get_logger(__name__)
+        index = _get_index()
+        moved = await index.migrate_counters_to_hash()
+        logger.info(f'moved {moved} counters, set COUNTER_LAYOUT=hash to use them')
+
+    run_async_task(run())
+
+
+@cli.command(help='Convert annotation records to the "registry" layout (see ANN_LAYOUT)')
+def migrate_anns():
+    async def run():
+        logger = get_logger(__name__)
+        index = _get_index()
+        before = await index.memory_report()
+        moved = await index.migrate_anns_to_registry()
+        after = await index.memory_report()
+        logger.info(f'moved {moved} annotation records, set ANN_LAYOUT=registry to use them')
+        _log_memory_report('before', before)
+        _log_memory_report('after', after)
+
+    run_async_task(run())
+
+
+@cli.command(help='Report memory used per indexed annotation')
+@click.option('--sample-size', default=1000, help='Number of keys to sample')
+def memory_report(sample_size):
+    async def run():
+        index = _get_index()
+        report = await index.memory_report(sample_size)
+        _log_memory_report('current', report)
+
+    run_async_task(run())
+
+
+def _log_memory_report(label, report):
+    logger = get_logger(__name__)
+    if not report:
+        logger.info(f'{label}: no indexed annotations found')
+    for layout, bytes_per_ann in report.items():
+        logger.info(f'{label}: {bytes_per_ann:.1f} bytes per annotation using "{layout}" layout')
+
+
 if __name__ == '__main__':
     cli()
@@ -0,0 +1,84 @@
+"""
+Coalescing of concurrent reads from the key-value store.
+"""
+
+from asyncio import ensure_future, get_event_loop
+
+from .metrics import REGISTRY
+
+READ_BATCH_KEYS = REGISTRY.histogram(
+    'badger_read_batch_keys', 'Number of distinct keys read by one coalesced batch',
+    buckets=(1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500))
+READ_BATCH_REQUESTS = REGISTRY.histogram(
+    'badger_read_batch_requests', 'Number of reads combined into one coalesced batch',
+    buckets=(1, 2, 5, 10, 25, 50, 100, 250))
+
+
+class ReadCoalescer:
+    """
+    Combines reads which arrive within a short window into one request.
+
+    Each read is a list of `(key, field)` tuples, as passed to
+    `KeyValueStore._get_counters`. Reads are queued until `window` seconds
+    after the first one, or until `max_keys` keys are queued, and are then
+    sent together, with duplicate keys read once. Each caller receives the
+    values for its own keys.
+    """
+
+    def __init__(self, fetch, window=0.0005, max_keys=1000):
+        """
+        :param fetch: Coroutine function which takes a list of `(key, field)`
+                      tuples and returns a list of their values
+        :param window: Maximum time in seconds to wait for other reads
+        :param max_keys: Number of queued keys at which reads are sent
+                         without waiting for the window to end
+        """
+        self.window = window
+        self.max_keys = max_keys
+        self._fetch = fetch
+
+        # List of (keys, Future) for queued reads.
+        self._queue = []
+        self._queued_keys = 0
+        self._timer = None
+
+    async def read(self, keys):
+        """
+        Return the values of `keys`, read together with any concurrent reads.
+        """
+        if not keys:
+            return []
+        future = get_event_loop().create_future()
+        self._queue.append((keys, future))
+        self._queued_keys += len(keys)
+        if self._queued_keys >= self.max_keys:
+            self._flush()
+        elif self._timer is None:
+            self._timer = get_event_loop().call_later(self.window, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        queue = self._queue
+        self._queue = []
+        self._queued_keys = 0
+        if queue:
+            ensure_future(self._send(queue))
+
+    async def _send(self, queue):
+        unique_keys = list(dict.fromkeys(key for keys, _ in queue for key in keys))
+        READ_BATCH_KEYS.observe(len(unique_keys))
+        READ_BATCH_REQUESTS.observe(len(queue))
+        try:
+            values = dict(zip(unique_keys, await self._fetch(unique_keys)))
+        except Exception as ex:
+            for _, future in queue:
+                if not future.done():
+                    future.set_exception(ex)
+            return
+        for keys, future in queue:
+            # The caller may have been cancelled while the batch was in flight.
+            if not future.done():
+                future.set_result([values[key] for key in keys])
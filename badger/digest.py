@@ -0,0 +1,173 @@
+"""
+Digests of the counters in the index, used to find where it has drifted from
+the annotations in h.
+"""
+
+from .util import get_logger
+
+logger = get_logger(__name__)
+
+# Number of sub-buckets which each digest bucket is split into. Sub-bucket `n`
+# holds the URIs whose hash is `n` modulo `buckets * SUB_BUCKETS`, so each is
+# contained in bucket `n % buckets`.
+SUB_BUCKETS = 16
+
+
+def java_string_hash(s):
+    """
+    Return Java's `String.hashCode` of `s`.
+
+    This is the hash used by the digest, since it is available to
+    Elasticsearch scripts. `_DIGEST_LUA` in `kv_store` computes the same hash
+    inside Redis.
+    """
+    data = s.encode('utf-16-be', 'surrogatepass')
+    h = 0
+    for i in range(0, len(data), 2):
+        h = (31 * h + (data[i] << 8 | data[i + 1])) & 0xffffffff
+    return h - 2**32 if h >= 2**31 else h
+
+
+class IndexDigest:
+    """
+    Digest of the index's counters, split into buckets by URI.
+
+    For each bucket the digest holds the number of indexed annotations on URIs
+    which hash to it and the sum of the hashes of their "{uri}|{scope}" keys.
+    The digest is updated atomically with the counters by the key-value store's
+    scripts, so comparing it with the same digest computed from the
+    annotations in h shows which buckets have drifted without reading the
+    counters.
+
+    Each bucket is also split into `SUB_BUCKETS` sub-buckets, stored in the
+    same hashes under fields named "s{sub-bucket}", so that reconciliation can
+    narrow a differing bucket down to the sub-buckets which differ.
+
+    As with the URI filter, a digest created for an index which already
+    contained annotations is incomplete until it has been built from the
+    existing counters. Digests built before sub-buckets existed have a
+    `sub_buckets` of 1 until they are rebuilt.
+    """
+
+    COUNTS_KEY = 'digest|counts'
+    SUMS_KEY = 'digest|sums'
+
+    # Number of buckets and sub-buckets and whether the digest covers every
+    # counter.
+    PARAMS_KEY = 'digest|params'
+
+    def __init__(self, kv_store, buckets=4096):
+        """
+        :param kv_store: Key-value store holding the digest
+        :param buckets: Number of buckets, if creating a new digest
+        """
+        self.kv_store = kv_store
+        self.buckets = buckets
+        self.sub_buckets = SUB_BUCKETS
+        self.complete = False
+        self._params_loaded = False
+
+    @property
+    def script_keys(self):
+        """
+        The `digest` argument for the key-value store's entry operations.
+        """
+        return (self.COUNTS_KEY, self.SUMS_KEY, self.buckets)
+
+    @property
+    def fine_buckets(self):
+        """
+        Total number of sub-buckets.
+        """
+        return self.buckets * self.sub_buckets
+
+    def bucket(self, uri):
+        return java_string_hash(uri) % self.buckets
+
+    def sub_bucket(self, uri):
+        return java_string_hash(uri) % self.fine_buckets
+
+    async def create(self, complete):
+        """
+        Create the digest in the key-value store if it does not exist.
+
+        :param complete: Whether the index is empty, so that the digest will
+                         cover every counter
+        """
+        await self._load_params(complete)
+
+    async def load(self):
+        await self._load_params()
+
+    async def read(self):
+        """
+        Return a dict of bucket => `(count, sum)` for non-empty buckets.
+        """
+        return await self._read_fields({bucket: str(bucket)
+                                        for bucket in range(self.buckets)})
+
+    async def read_sub_buckets(self, buckets):
+        """
+        Return a dict of sub-bucket => `(count, sum)` for the non-empty
+        sub-buckets of `buckets`.
+        """
+        if self.sub_buckets == 1:
+            return await self._read_fields({bucket: str(bucket) for bucket in buckets})
+        fields = {}
+        for bucket in buckets:
+            for i in range(self.sub_buckets):
+                sub_bucket = bucket + i * self.buckets
+                fields[sub_bucket] = f's{sub_bucket}'
+        return await self._read_fields(fields)
+
+    async def _read_fields(self, fields):
+        names = list(fields.values())
+        counts = await self.kv_store.get_hash_fields(self.COUNTS_KEY, names, typ=int)
+        sums = await self.kv_store.get_hash_fields(self.SUMS_KEY, names, typ=int)
+        return {bucket: (count or 0, sum_ or 0)
+                for bucket, count, sum_ in zip(fields, counts, sums)
+                if count or sum_}
+
+    async def build(self, counters):
+        """
+        Replace the digest with one computed from `counters` and mark it as
+        complete.
+
+        :param counters: Async iterable of `(uri_scope_key, count)` tuples
+        """
+        await self._load_params()
+        self.sub_buckets = SUB_BUCKETS
+        counts = {}
+        sums = {}
+        async for uri_scope_key, count in counters:
+            uri, _ = uri_scope_key.rsplit('|', 1)
+            key_hash = java_string_hash(uri_scope_key)
+            for field in (self.bucket(uri), f's{self.sub_bucket(uri)}'):
+                counts[field] = counts.get(field, 0) + count
+                sums[field] = sums.get(field, 0) + count * key_hash
+
+        await self.kv_store.delete(self.COUNTS_KEY)
+        await self.kv_store.delete(self.SUMS_KEY)
+        await self.kv_store.incr_hash_fields(self.COUNTS_KEY, counts)
+        await self.kv_store.incr_hash_fields(self.SUMS_KEY, sums)
+        self.complete = True
+        await self._save_params()
+
+    async def _load_params(self, complete=False):
+        if self._params_loaded:
+            return
+
+        params = await self.kv_store.get_dict(self.PARAMS_KEY)
+        if params:
+            self.buckets = params['buckets']
+            self.sub_buckets = params.get('sub_buckets', 1)
+            self.complete = params['complete']
+        else:
+            self.complete = complete
+            await self._save_params()
+        self._params_loaded = True
+
+    async def _save_params(self):
+        await self.kv_store.put_dict(self.PARAMS_KEY, {'buckets': self.buckets,
+                                                       'sub_buckets': self.sub_buckets,
+                                                       'complete': self.complete})
@@ -0,0 +1,874 @@
+"""
+Embedded key-value store for single-node deployments.
+
+The index is stored in a local SQLite database instead of Redis, so that
+lookups do not make a network request and the index can be larger than RAM.
+"""
+
+from asyncio import get_event_loop, sleep
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import json
+import sqlite3
+from time import monotonic, time
+
+from .kv_store import KeyValueStore, digest_changes, tostr
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS keys (
+  key TEXT PRIMARY KEY,
+  type TEXT NOT NULL,
+  value BLOB,
+  expires REAL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS keys_expires ON keys (expires) WHERE expires IS NOT NULL;
+CREATE TABLE IF NOT EXISTS fields (
+  key TEXT NOT NULL,
+  field BLOB NOT NULL,
+  value BLOB,
+  PRIMARY KEY (key, field)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS stream_entries (
+  key TEXT NOT NULL,
+  ms INTEGER NOT NULL,
+  seq INTEGER NOT NULL,
+  fields TEXT NOT NULL,
+  PRIMARY KEY (key, ms, seq)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS stream_groups (
+  key TEXT NOT NULL,
+  grp TEXT NOT NULL,
+  last_ms INTEGER NOT NULL,
+  last_seq INTEGER NOT NULL,
+  PRIMARY KEY (key, grp)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS stream_pending (
+  key TEXT NOT NULL,
+  grp TEXT NOT NULL,
+  ms INTEGER NOT NULL,
+  seq INTEGER NOT NULL,
+  consumer TEXT NOT NULL,
+  delivered REAL NOT NULL,
+  PRIMARY KEY (key, grp, ms, seq)
+) WITHOUT ROWID;
+"""
+
+# Bitmaps are stored in chunks of this many bytes, so that setting bits only
+# rewrites the chunks which contain them.
+BITMAP_CHUNK_SIZE = 4096
+
+# Maximum number of values in one `IN (...)` list. Older versions of SQLite
+# accept at most 999 variables per statement.
+_MAX_VARIABLES = 500
+
+# Types of keys, as reported by Redis' `TYPE` command, keyed by the type used
+# in the `keys` table.
+_REDIS_TYPES = {'string': 'string', 'bitmap': 'string', 'hash': 'hash',
+                'set': 'set', 'stream': 'stream'}
+
+
+def _encode(value):
+    """
+    Convert a value to the form in which it is stored, as Redis would.
+    """
+    if isinstance(value, str):
+        return value.encode()
+    if isinstance(value, float):
+        return repr(value).encode()
+    return value
+
+
+def _field(field):
+    """
+    Convert a hash field or set member to the form in which it is stored.
+
+    Fields are always stored as `bytes`, since some fields are binary and
+    SQLite does not consider text and binary values equal.
+    """
+    if isinstance(field, bytes):
+        return field
+    return str(field).encode()
+
+
+def _to_bytes(value):
+    """
+    Convert a stored value to `bytes`, as returned by Redis.
+    """
+    if value is None or isinstance(value, bytes):
+        return value
+    return str(value).encode()
+
+
+def _to_str(value):
+    """
+    Convert a stored value to `str`.
+    """
+    return tostr(_to_bytes(value))
+
+
+def _chunks(items, size=_MAX_VARIABLES):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def _placeholders(items):
+    return ','.join('?' * len(items))
+
+
+def _stream_id(ms, seq):
+    return f'{ms}-{seq}'
+
+
+def _parse_stream_id(id_):
+    ms, _, seq = id_.partition('-')
+    return int(ms), int(seq or 0)
+
+
+class _Commands:
+    """
+    Redis-like commands which run inside a write transaction.
+
+    These mirror the commands used by `kv_store`'s Lua scripts, so that the
+    scripts can be ported line by line.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.now = time()
+
+    def execute(self, sql, params=()):
+        return self.conn.execute(sql, params)
+
+    def type(self, key):
+        """
+        Return the type of `key` in the `keys` table, deleting it if it has
+        expired.
+        """
+        row = self.execute('SELECT type, expires FROM keys WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        type_, expires = row
+        if expires is not None and expires <= self.now:
+            self.delete(key)
+            return None
+        return type_
+
+    def create(self, key, type_):
+        """
+        Create `key` with type `type_` if it does not exist.
+        """
+        existing = self.type(key)
+        if existing is None:
+            self.execute('INSERT INTO keys (key, type) VALUES (?, ?)', (key, type_))
+        elif existing != type_:
+            raise ValueError(f'{key} holds a {existing}, not a {type_}')
+
+    def delete(self, key):
+        for table in ('keys', 'fields', 'stream_entries', 'stream_groups', 'stream_pending'):
+            self.execute(f'DELETE FROM {table} WHERE key = ?', (key,))
+
+    def expire(self, key, expiry):
+        self.execute('UPDATE keys SET expires = ? WHERE key = ?', (self.now + expiry, key))
+
+    def get(self, key):
+        if self.type(key) != 'string':
+            return None
+        return self.execute('SELECT value FROM keys WHERE key = ?', (key,)).fetchone()[0]
+
+    def set(self, key, value, expiry=None):
+        if self.type(key) not in (None, 'string'):
+            self.delete(key)
+        expires = None if expiry is None else self.now + expiry
+        self.execute('INSERT OR REPLACE INTO keys (key, type, value, expires) '
+                     'VALUES (?, \'string\', ?, ?)', (key, _encode(value), expires))
+
+    def setnx(self, key, value, expiry=None):
+        if self.type(key) is not None:
+            return False
+        self.set(key, value, expiry)
+        return True
+
+    def incrby(self, key, amount):
+        value = self.get(key)
+        if value is None:
+            self.set(key, amount)
+            return amount
+        value = int(value) + amount
+        self.execute('UPDATE keys SET value = ? WHERE key = ?', (value, key))
+        return value
+
+    def hget(self, key, field):
+        row = self.execute('SELECT value FROM fields WHERE key = ? AND field = ?',
+                           (key, _field(field))).fetchone()
+        return None if row is None else row[0]
+
+    def hset(self, key, field, value):
+        self.create(key, 'hash')
+        self.execute('INSERT OR REPLACE INTO fields (key, field, value) VALUES (?, ?, ?)',
+                     (key, _field(field), _encode(value)))
+
+    def hsetnx(self, key, field, value):
+        if self.hget(key, field) is not None:
+            return False
+        self.hset(key, field, value)
+        return True
+
+    def hincrby(self, key, field, amount):
+        value = self.hget(key, field)
+        value = amount if value is None else int(value) + amount
+        self.hset(key, field, value)
+        return value
+
+    def hdel(self, key, field):
+        self.execute('DELETE FROM fields WHERE key = ? AND field = ?', (key, _field(field)))
+        # As in Redis, a hash with no fields does not exist.
+        if self.execute('SELECT 1 FROM fields WHERE key = ? LIMIT 1', (key,)).fetchone() is None:
+            self.execute('DELETE FROM keys WHERE key = ?', (key,))
+
+    def incr_counter(self, key, field, amount):
+        """
+        Equivalent of `incr_counter` in `_INCR_COUNTER_LUA`.
+        """
+        if field is None:
+            return self.incrby(key, amount)
+        return self.hincrby(key, field, amount)
+
+    def intern(self, intern_keys, value):
+        """
+        Equivalent of `intern` in `_INTERN_LUA`.
+        """
+        ids_key, values_key, next_id_key = intern_keys
+        id_ = self.hget(ids_key, value)
+        if id_ is None:
+            id_ = self.incrby(next_id_key, 1)
+            self.hset(ids_key, value, id_)
+            self.hset(values_key, id_, value)
+        return id_
+
+    def record_changes(self, changes, digest, versions):
+        """
+        Update the digest and URI versions for changes to counters, as
+        `update_digest` and `bump_version` do in Redis.
+
+        :param changes: List of `(value, amount)` tuples
+        """
+        if digest is not None:
+            counts_key, sums_key, buckets = digest
+            counts, sums = digest_changes(changes, buckets)
+            for bucket, amount in counts.items():
+                self.hincrby(counts_key, str(bucket), amount)
+            for bucket, amount in sums.items():
+                self.hincrby(sums_key, str(bucket), amount)
+        if versions:
+            for value, _ in changes:
+                uri, _ = value.rsplit('|', 1)
+                self.incrby(versions + uri, 1)
+
+    def remove_entry_value(self, value, counter_prefix, hashed):
+        """
+        Decrement the counter of a removed entry's value, as
+        `_REMOVE_ENTRIES_SCRIPT` does.
+        """
+        if hashed:
+            suffix, field = value.rsplit('|', 1)
+            self.incr_counter(counter_prefix + suffix, field, -1)
+        else:
+            self.incr_counter(counter_prefix + value, None, -1)
+
+    def purge_expired(self):
+        expired = [key for (key,) in self.execute(
+            'SELECT key FROM keys WHERE expires <= ?', (self.now,)).fetchall()]
+        for key in expired:
+            self.delete(key)
+
+
+class EmbeddedKeyValueStore(KeyValueStore):
+    """
+    Key-value store backed by a local SQLite database.
+
+    This implements the same operations as `KeyValueStore`, with the same
+    atomicity, for deployments where the web server and indexer run on one
+    machine. The database uses a write-ahead log, so that any number of
+    processes, such as the web server's workers, can read it while one process
+    writes. It is also memory-mapped, so that the database's sorted B-tree
+    pages are read directly from the operating system's page cache, which all
+    of the processes share, without a system call or a copy into SQLite's own
+    cache. The index can be larger than RAM, in which case only the pages which
+    are used stay in memory.
+
+    Reads are made synchronously on the event loop's thread, since they do not
+    wait for the network and are served from memory in the common case.
+    Writes may wait for another process's transaction to finish, so they are
+    made on a separate thread and each call is one transaction.
+
+    Keys with an expiry time are removed lazily when they are next used and
+    periodically by writes.
+    """
+
+    # Interval in seconds between removals of expired keys.
+    PURGE_INTERVAL = 60.0
+
+    # Interval in seconds between checks for new entries while blocking in
+    # `read_stream_group`.
+    STREAM_POLL_INTERVAL = 0.05
+
+    def __init__(self, path, mmap_size=2**30, timeout=5.0):
+        """
+        :param path: Path of the database file, which is created if it does
+                     not exist
+        :param mmap_size: Maximum number of bytes of the database to memory-map.
+                          Larger databases are read partly using system calls.
+        :param timeout: Maximum time in seconds to wait for another process's
+                        write transaction to finish
+        """
+        self.path = path
+        self._writer = ThreadPoolExecutor(1)
+        self._write_conn = self._connect(mmap_size, timeout)
+        self._write_conn.execute('PRAGMA journal_mode = WAL')
+        self._write_conn.execute('PRAGMA synchronous = NORMAL')
+        self._write_conn.executescript(_SCHEMA)
+        self._read_conn = self._connect(mmap_size, timeout)
+        self._last_purge = 0.0
+        self._coalescer = None
+
+    def _connect(self, mmap_size, timeout):
+        # Both connections are used from a single thread, but not necessarily
+        # the one which created them.
+        conn = sqlite3.connect(self.path, timeout=timeout, isolation_level=None,
+                               check_same_thread=False)
+        conn.execute(f'PRAGMA mmap_size = {int(mmap_size)}')
+        return conn
+
+    async def _write(self, func, *args):
+        """
+        Run `func(commands, *args)` in a write transaction and return its
+        result.
+        """
+        return await get_event_loop().run_in_executor(
+            self._writer, partial(self._transaction, func, *args))
+
+    def _transaction(self, func, *args):
+        conn = self._write_conn
+        # Take the write lock at the start, so that the transaction does not
+        # fail if another process writes after it has read.
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            commands = _Commands(conn)
+            result = func(commands, *args)
+            if commands.now - self._last_purge >= self.PURGE_INTERVAL:
+                commands.purge_expired()
+                self._last_purge = commands.now
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        return result
+
+    def _query(self, sql, params=()):
+        return self._read_conn.execute(sql, params).fetchall()
+
+    def _live_keys(self, keys, types, column='value'):
+        """
+        Return a dict of key => value (or another column of the `keys` table)
+        for the keys in `keys` which exist, have one of `types` and have not
+        expired.
+        """
+        values = {}
+        now = time()
+        for chunk in _chunks(list(set(keys))):
+            rows = self._query(f'SELECT key, type, {column}, expires FROM keys '
+                               f'WHERE key IN ({_placeholders(chunk)})', chunk)
+            values.update((key, value) for key, type_, value, expires in rows
+                          if type_ in types and (expires is None or expires > now))
+        return values
+
+    def _hash_values(self, key, fields):
+        """
+        Return a dict of field => value for the fields of a hash.
+        """
+        stored = {_field(field): field for field in fields}
+        values = {}
+        for chunk in _chunks(list(stored)):
+            values.update((stored[field], value) for field, value in
+                          self._query(f'SELECT field, value FROM fields WHERE key = ? '
+                                      f'AND field IN ({_placeholders(chunk)})',
+                                      [key, *chunk]))
+        return values
+
+    async def ping(self):
+        self._query('SELECT 1')
+        return True
+
+    async def inc_counter(self, key, field=None):
+        return await self._write(_Commands.incr_counter, key, field, 1)
+
+    async def dec_counter(self, key, field=None):
+        return await self._write(_Commands.incr_counter, key, field, -1)
+
+    async def _get_counters(self, counters):
+        keys = self._live_keys([key for key, field in counters if field is None],
+                               ('string',))
+        hash_fields = {}
+        for key, field in counters:
+            if field is not None:
+                hash_fields.setdefault(key, []).append(field)
+        hash_values = {key: self._hash_values(key, fields)
+                       for key, fields in hash_fields.items()}
+        return [_to_bytes(keys.get(key) if field is None else hash_values[key].get(field))
+                for key, field in counters]
+
+    async def add_entries(self, entries, digest=None, versions=None):
+        if not entries:
+            return 0
+        return await self._write(self._add_entries, entries, digest, versions)
+
+    @staticmethod
+    def _add_entries(commands, entries, digest, versions):
+        changes = []
+        for key, value, counter_key, counter_field in entries:
+            if commands.setnx(key, value):
+                commands.incr_counter(counter_key, counter_field, 1)
+                changes.append((value, 1))
+        commands.record_changes(changes, digest, versions)
+        return len(changes)
+
+    async def remove_entries(self, keys, counter_prefix, hashed=False,
+                             digest=None, versions=None):
+        if not keys:
+            return []
+        return await self._write(self._remove_entries, keys, counter_prefix, hashed,
+                                 digest, versions)
+
+    @staticmethod
+    def _remove_entries(commands, keys, counter_prefix, hashed, digest, versions):
+        changes = []
+        removed = []
+        for key in keys:
+            value = commands.get(key)
+            if value is not None:
+                value = tostr(value)
+                commands.delete(key)
+                commands.remove_entry_value(value, counter_prefix, hashed)
+                changes.append((value, -1))
+            removed.append(value is not None)
+        commands.record_changes(changes, digest, versions)
+        return removed
+
+    async def move_counters_to_hash(self, moves):
+        if not moves:
+            return 0
+        return await self._write(self._move_counters_to_hash, moves)
+
+    @staticmethod
+    def _move_counters_to_hash(commands, moves):
+        moved = 0
+        for key, hash_key, field in moves:
+            value = commands.get(key)
+            if value is not None:
+                commands.hincrby(hash_key, field, int(value))
+                commands.delete(key)
+                moved += 1
+        return moved
+
+    async def add_interned_entries(self, entries, intern_keys, size_key,
+                                   digest=None, versions=None):
+        if not entries:
+            return 0
+        return await self._write(self._add_interned_entries, entries, intern_keys,
+                                 size_key, digest, versions)
+
+    @staticmethod
+    def _add_interned_entries(commands, entries, intern_keys, size_key, digest,
+                              versions):
+        changes = []
+        for key, field, value, counter_key, counter_field in entries:
+            if commands.hget(key, field) is None:
+                commands.hset(key, field, commands.intern(intern_keys, value))
+                commands.incr_counter(counter_key, counter_field, 1)
+                changes.append((value, 1))
+        commands.incrby(size_key, len(changes))
+        commands.record_changes(changes, digest, versions)
+        return len(changes)
+
+    async def remove_interned_entries(self, entries, intern_keys, size_key,
+                                      counter_prefix, hashed=False, digest=None,
+                                      versions=None):
+        if not entries:
+            return []
+        return await self._write(self._remove_interned_entries, entries, intern_keys,
+                                 size_key, counter_prefix, hashed, digest, versions)
+
+    @staticmethod
+    def _remove_interned_entries(commands, entries, intern_keys, size_key,
+                                 counter_prefix, hashed, digest, versions):
+        _, values_key, _ = intern_keys
+        changes = []
+        removed = []
+        for key, field in entries:
+            id_ = commands.hget(key, field)
+            if id_ is not None:
+                commands.hdel(key, field)
+                commands.incrby(size_key, -1)
+                value = _to_str(commands.hget(values_key, _to_str(id_)))
+                commands.remove_entry_value(value, counter_prefix, hashed)
+                changes.append((value, -1))
+            removed.append(id_ is not None)
+        commands.record_changes(changes, digest, versions)
+        return removed
+
+    async def move_to_interned_entries(self, moves, intern_keys, size_key):
+        if not moves:
+            return 0
+        return await self._write(self._move_to_interned_entries, moves, intern_keys,
+                                 size_key)
+
+    @staticmethod
+    def _move_to_interned_entries(commands, moves, intern_keys, size_key):
+        moved = 0
+        for key, hash_key, field in moves:
+            value = commands.get(key)
+            if value is not None:
+                if commands.hsetnx(hash_key, field,
+                                   commands.intern(intern_keys, tostr(value))):
+                    moved += 1
+                commands.delete(key)
+        commands.incrby(size_key, moved)
+        return moved
+
+    async def adjust_counters(self, adjustments, digest=None, versions=None):
+        if not adjustments:
+            return
+        await self._write(self._adjust_counters, adjustments, digest, versions)
+
+    @staticmethod
+    def _adjust_counters(commands, adjustments, digest, versions):
+        for counter_key, counter_field, _, amount in adjustments:
+            commands.incr_counter(counter_key, counter_field, amount)
+        commands.record_changes([(value, amount) for _, _, value, amount in adjustments],
+                                digest, versions)
+
+    async def get_entries(self, keys):
+        values = self._live_keys(keys, ('string',))
+        return [None if values.get(key) is None else _to_str(values[key])
+                for key in keys]
+
+    async def get_interned_entries(self, entries, intern_keys):
+        if not entries:
+            return []
+        ids = [self._hash_values(key, [field]).get(field) for key, field in entries]
+        _, values_key, _ = intern_keys
+        values = self._hash_values(values_key, [_to_str(id_) for id_ in ids if id_ is not None])
+        return [None if id_ is None else _to_str(values[_to_str(id_)]) for id_ in ids]
+
+    async def get_hash(self, key, typ=tostr):
+        if not self._live_keys([key], ('hash',)):
+            return {}
+        return {tostr(field): typ(_to_bytes(value)) for field, value in
+                self._query('SELECT field, value FROM fields WHERE key = ?', (key,))}
+
+    async def get_hash_fields(self, key, fields, typ=tostr):
+        if not fields or not self._live_keys([key], ('hash',)):
+            return [None] * len(fields)
+        values = self._hash_values(key, fields)
+        return [None if values.get(field) is None else typ(_to_bytes(values[field]))
+                for field in fields]
+
+    async def incr_hash_fields(self, key, amounts):
+        await self._write(self._incr_hash_fields, key, amounts)
+
+    @staticmethod
+    def _incr_hash_fields(commands, key, amounts):
+        for field, amount in amounts.items():
+            commands.hincrby(key, field, amount)
+
+    async def memory_usage(self, key):
+        """
+        Return the approximate number of bytes used to store `key`, or `None`.
+        """
+        [row] = self._query('SELECT (SELECT length(key) + ifnull(length(value), 0) '
+                            '        FROM keys WHERE key = ?), '
+                            '       (SELECT sum(length(field) + ifnull(length(value), 0)) '
+                            '        FROM fields WHERE key = ?)', (key, key))
+        key_bytes, field_bytes = row
+        if key_bytes is None:
+            return None
+        return key_bytes + (field_bytes or 0)
+
+    async def hash_length(self, key):
+        [(length,)] = self._query('SELECT count(*) FROM fields WHERE key = ?', (key,))
+        return length
+
+    async def set_bits(self, key, offsets):
+        if not offsets:
+            return []
+        return await self._write(self._set_bits, key, offsets)
+
+    async def get_ranges(self, key, ranges):
+        value = self._live_keys([key], ('string', 'bitmap'))
+        if key not in value:
+            return [b'' for _ in ranges]
+        if value[key] is not None:
+            data = _to_bytes(value[key])
+            return [data[start:end + 1] for start, end in ranges]
+        return [self._get_bitmap(key, start, end + 1) for start, end in ranges]
+
+    @staticmethod
+    def _set_bits(commands, key, offsets):
+        if commands.type(key) == 'string':
+            # Split a bitmap which was written as a string, eg. by
+            # `load_keys`, into chunks.
+            data = _to_bytes(commands.get(key))
+            commands.delete(key)
+            commands.create(key, 'bitmap')
+            for start in range(0, len(data), BITMAP_CHUNK_SIZE):
+                commands.execute('INSERT INTO fields (key, field, value) VALUES (?, ?, ?)',
+                                 (key, _field(f'{start // BITMAP_CHUNK_SIZE:010d}'),
+                                  data[start:start + BITMAP_CHUNK_SIZE]))
+        commands.create(key, 'bitmap')
+        # Bits are numbered from the most significant bit of the first byte,
+        # as in Redis.
+        chunk_offsets = {}
+        for offset in offsets:
+            chunk, bit = divmod(offset, BITMAP_CHUNK_SIZE * 8)
+            chunk_offsets.setdefault(chunk, []).append(bit)
+        added = []
+        for chunk, bits in chunk_offsets.items():
+            field = f'{chunk:010d}'
+            data = bytearray(commands.hget(key, field) or b'')
+            for bit in bits:
+                index = bit // 8
+                if index >= len(data):
+                    data.extend(bytes(index + 1 - len(data)))
+                mask = 0x80 >> (bit % 8)
+                if not data[index] & mask:
+                    added.append(chunk * BITMAP_CHUNK_SIZE * 8 + bit)
+                data[index] |= mask
+            commands.execute('INSERT OR REPLACE INTO fields (key, field, value) '
+                             'VALUES (?, ?, ?)', (key, _field(field), bytes(data)))
+        return added
+
+    def _get_bitmap(self, key, start=0, end=None):
+        """
+        Return bytes `start` to `end` (exclusive) of a bitmap, reading only
+        the chunks which overlap them.
+        """
+        first = start // BITMAP_CHUNK_SIZE
+        sql = 'SELECT field, value FROM fields WHERE key = ? AND field >= ?'
+        params = [key, _field(f'{first:010d}')]
+        if end is not None:
+            if end <= start:
+                return b''
+            sql += ' AND field <= ?'
+            params.append(_field(f'{(end - 1) // BITMAP_CHUNK_SIZE:010d}'))
+        base = first * BITMAP_CHUNK_SIZE
+        data = bytearray()
+        for field, chunk in self._query(sql + ' ORDER BY field', params):
+            chunk_start = int(field) * BITMAP_CHUNK_SIZE - base
+            if chunk_start > len(data):
+                data.extend(bytes(chunk_start - len(data)))
+            data[chunk_start:chunk_start + len(chunk)] = chunk
+        return bytes(data[start - base:None if end is None else end - base])
+
+    async def append_to_stream(self, key, entries, maxlen=None):
+        return await self._write(self._append_to_stream, key, entries, maxlen)
+
+    @staticmethod
+    def _append_to_stream(commands, key, entries, maxlen):
+        commands.create(key, 'stream')
+        last = commands.execute('SELECT ms, seq FROM stream_entries WHERE key = ? '
+                                'ORDER BY ms DESC, seq DESC LIMIT 1', (key,)).fetchone()
+        ms, seq = int(commands.now * 1000), -1
+        if last and last[0] >= ms:
+            ms, seq = last
+        ids = []
+        for fields in entries:
+            seq += 1
+            commands.execute('INSERT INTO stream_entries (key, ms, seq, fields) '
+                             'VALUES (?, ?, ?, ?)',
+                             (key, ms, seq, json.dumps({k: str(v) for k, v in fields.items()})))
+            ids.append(_stream_id(ms, seq))
+        if maxlen:
+            oldest = commands.execute('SELECT ms, seq FROM stream_entries WHERE key = ? '
+                                      'ORDER BY ms DESC, seq DESC LIMIT 1 OFFSET ?',
+                                      (key, maxlen - 1)).fetchone()
+            if oldest:
+                commands.execute('DELETE FROM stream_entries WHERE key = ? '
+                                 'AND (ms < ? OR (ms = ? AND seq < ?))',
+                                 (key, oldest[0], oldest[0], oldest[1]))
+        return ids
+
+    async def create_stream_group(self, key, group):
+        await self._write(self._create_stream_group, key, group)
+
+    @staticmethod
+    def _create_stream_group(commands, key, group):
+        commands.create(key, 'stream')
+        commands.execute('INSERT OR IGNORE INTO stream_groups (key, grp, last_ms, last_seq) '
+                         'VALUES (?, ?, 0, -1)', (key, group))
+
+    def _has_undelivered_entries(self, key, group):
+        rows = self._query('SELECT 1 FROM stream_groups g JOIN stream_entries e '
+                           'ON e.key = g.key AND (e.ms > g.last_ms OR '
+                           '(e.ms = g.last_ms AND e.seq > g.last_seq)) '
+                           'WHERE g.key = ? AND g.grp = ? LIMIT 1', (key, group))
+        return bool(rows)
+
+    async def read_stream_group(self, key, group, consumer, count, block=None):
+        deadline = monotonic() + (block or 0) / 1000
+        while not self._has_undelivered_entries(key, group) and monotonic() < deadline:
+            await sleep(self.STREAM_POLL_INTERVAL)
+        return await self._write(self._read_stream_group, key, group, consumer, count)
+
+    @staticmethod
+    def _read_stream_group(commands, key, group, consumer, count):
+        row = commands.execute('SELECT last_ms, last_seq FROM stream_groups '
+                               'WHERE key = ? AND grp = ?', (key, group)).fetchone()
+        if row is None:
+            raise ValueError(f'stream {key} has no consumer group {group}')
+        last_ms, last_seq = row
+        rows = commands.execute('SELECT ms, seq, fields FROM stream_entries WHERE key = ? '
+                                'AND (ms > ? OR (ms = ? AND seq > ?)) ORDER BY ms, seq LIMIT ?',
+                                (key, last_ms, last_ms, last_seq, count)).fetchall()
+        for ms, seq, _ in rows:
+            commands.execute('INSERT OR REPLACE INTO stream_pending '
+                             '(key, grp, ms, seq, consumer, delivered) VALUES (?, ?, ?, ?, ?, ?)',
+                             (key, group, ms, seq, consumer, commands.now))
+        if rows:
+            ms, seq, _ = rows[-1]
+            commands.execute('UPDATE stream_groups SET last_ms = ?, last_seq = ? '
+                             'WHERE key = ? AND grp = ?', (ms, seq, key, group))
+        return [(_stream_id(ms, seq), json.loads(fields)) for ms, seq, fields in rows]
+
+    async def claim_stream_entries(self, key, group, consumer, min_idle, count):
+        return await self._write(self._claim_stream_entries, key, group, consumer,
+                                 min_idle, count)
+
+    @staticmethod
+    def _claim_stream_entries(commands, key, group, consumer, min_idle, count):
+        rows = commands.execute('SELECT p.ms, p.seq, e.fields FROM stream_pending p '
+                                'LEFT JOIN stream_entries e '
+                                'ON e.key = p.key AND e.ms = p.ms AND e.seq = p.seq '
+                                'WHERE p.key = ? AND p.grp = ? AND p.delivered <= ? '
+                                'ORDER BY p.ms, p.seq LIMIT ?',
+                                (key, group, commands.now - min_idle / 1000, count)).fetchall()
+        claimed = []
+        for ms, seq, fields in rows:
+            if fields is None:
+                # The entry was trimmed from the stream, so it can never be
+                # processed.
+                commands.execute('DELETE FROM stream_pending WHERE key = ? AND grp = ? '
+                                 'AND ms = ? AND seq = ?', (key, group, ms, seq))
+                continue
+            commands.execute('UPDATE stream_pending SET consumer = ?, delivered = ? '
+                             'WHERE key = ? AND grp = ? AND ms = ? AND seq = ?',
+                             (consumer, commands.now, key, group, ms, seq))
+            claimed.append((_stream_id(ms, seq), json.loads(fields)))
+        return claimed
+
+    async def ack_stream_entries(self, key, group, ids):
+        if ids:
+            await self._write(self._ack_stream_entries, key, group, ids)
+
+    @staticmethod
+    def _ack_stream_entries(commands, key, group, ids):
+        for id_ in ids:
+            commands.execute('DELETE FROM stream_pending WHERE key = ? AND grp = ? '
+                             'AND ms = ? AND seq = ?', (key, group, *_parse_stream_id(id_)))
+
+    async def scan_keys(self, pattern, count=1000, type=None):
+        """
+        Iterate over keys matching `pattern`, optionally of a given `type`.
+
+        Patterns are matched using SQLite's `GLOB`, which supports the same
+        `*`, `?` and `[...]` wildcards as Redis but not escaping with `\\`.
+        """
+        types = [t for t, redis_type in _REDIS_TYPES.items()
+                 if type is None or redis_type == type]
+        last = ''
+        while True:
+            rows = self._query(f'SELECT key FROM keys WHERE key > ? AND key GLOB ? '
+                               f'AND type IN ({_placeholders(types)}) '
+                               f'AND (expires IS NULL OR expires > ?) ORDER BY key LIMIT ?',
+                               [last, pattern, *types, time(), count])
+            for (key,) in rows:
+                yield key
+            if len(rows) < count:
+                return
+            last = rows[-1][0]
+
+    async def dump_keys(self, keys):
+        types = self._live_keys(keys, ('string', 'bitmap', 'hash'), column='type')
+        records = []
+        for key in keys:
+            type_ = types.get(key)
+            if type_ == 'string':
+                [(value,)] = self._query('SELECT value FROM keys WHERE key = ?', (key,))
+                records.append((key, _to_bytes(value)))
+            elif type_ == 'bitmap':
+                records.append((key, self._get_bitmap(key)))
+            elif type_ == 'hash':
+                records.append((key, {field: _to_bytes(value) for field, value in
+                                      self._query('SELECT field, value FROM fields '
+                                                  'WHERE key = ?', (key,))}))
+        return records
+
+    async def load_keys(self, records, max_fields=1000):
+        await self._write(self._load_keys, records)
+
+    @staticmethod
+    def _load_keys(commands, records):
+        for key, value in records:
+            commands.delete(key)
+            if isinstance(value, dict):
+                commands.create(key, 'hash')
+                commands.conn.executemany(
+                    'INSERT INTO fields (key, field, value) VALUES (?, ?, ?)',
+                    ((key, _field(field), _encode(field_value))
+                     for field, field_value in value.items()))
+            else:
+                commands.set(key, value)
+
+    async def put_dict(self, key, value, expiry=None):
+        await self._write(_Commands.set, key, json.dumps(value), expiry)
+
+    async def put_if_absent(self, key, value, expiry=None):
+        return await self._write(_Commands.setnx, key, value, expiry)
+
+    async def add_to_set(self, key, members, expiry=None):
+        await self._write(self._add_to_set, key, members, expiry)
+
+    @staticmethod
+    def _add_to_set(commands, key, members, expiry):
+        commands.create(key, 'set')
+        for member in members:
+            commands.execute('INSERT OR IGNORE INTO fields (key, field) VALUES (?, ?)',
+                             (key, _field(member)))
+        if expiry is not None:
+            commands.expire(key, expiry)
+
+    async def pop_set(self, key):
+        return await self._write(self._pop_set, key)
+
+    @staticmethod
+    def _pop_set(commands, key):
+        if commands.type(key) != 'set':
+            return []
+        members = [tostr(member) for (member,) in commands.execute(
+            'SELECT field FROM fields WHERE key = ?', (key,)).fetchall()]
+        commands.delete(key)
+        return members
+
+    async def get(self, key, typ=tostr):
+        value = self._live_keys([key], ('string', 'bitmap'))
+        if key not in value:
+            return None
+        if value[key] is None:
+            # Bitmaps are stored in chunks rather than in the `keys` table.
+            return typ(self._get_bitmap(key))
+        return typ(_to_bytes(value[key]))
+
+    async def put(self, key, value):
+        await self._write(_Commands.set, key, value)
+
+    async def delete(self, key):
+        await self._write(_Commands.delete, key)
@@ -0,0 +1,221 @@
+"""
+Push-based indexing of annotation events.
+
+h (or a relay in front of it) appends an entry to a Redis stream whenever an
+annotation is created, updated or deleted, either directly or via the web
+server's `/events` endpoint. Indexer processes read the stream as members of a
+consumer group, so each event is applied by one of them, and acknowledge
+events once they have been applied.
+
+Each stream entry has the fields:
+
+  "action" => "create" | "update" | "delete"
+  "id" => "{annotation ID}"
+  "annotation" => "{annotation in h API format, as JSON}"  # Not for "delete"
+"""
+
+from asyncio import sleep
+import json
+import os
+import socket
+from time import monotonic, time
+
+from .fast_json import loads
+from .index_fetcher import Annotation
+from .metrics import REGISTRY
+from .util import get_logger
+
+logger = get_logger(__name__)
+
+EVENT_ACTIONS = ('create', 'update', 'delete')
+
+EVENTS_APPLIED = REGISTRY.counter(
+    'badger_events_applied_total', 'Annotation events applied to the index',
+    ['action'])
+EVENTS_REJECTED = REGISTRY.counter(
+    'badger_events_rejected_total', 'Annotation events which could not be decoded')
+EVENT_LAG_SECONDS = REGISTRY.histogram(
+    'badger_event_lag_seconds',
+    'Time between an event being added to the stream and being applied',
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0, 30.0,
+             60.0, 300.0))
+
+
+def encode_event(event):
+    """
+    Validate an event in the format accepted by the `/events` endpoint and
+    return the fields of its stream entry.
+
+    :param event: Dict with an "action" and either the "annotation" in h API
+                  format or, for "delete", the annotation's "id"
+    :raises ValueError: If the event is invalid
+    """
+    if not isinstance(event, dict):
+        raise ValueError('event must be an object')
+    action = event.get('action')
+    if action not in EVENT_ACTIONS:
+        raise ValueError(f'unknown event action "{action}"')
+
+    if action == 'delete':
+        id_ = event.get('id')
+        if not isinstance(id_, str):
+            raise ValueError('"delete" event must have an "id"')
+        return {'action': action, 'id': id_}
+
+    api_ann = event.get('annotation')
+    try:
+        ann = Annotation.from_api_ann(api_ann)
+    except (KeyError, IndexError, TypeError) as ex:
+        raise ValueError(f'invalid annotation in "{action}" event') from ex
+    return {'action': action, 'id': ann.id, 'annotation': json.dumps(api_ann)}
+
+
+def decode_event(fields):
+    """
+    Decode the fields of a stream entry.
+
+    Returns an `(action, annotation ID, Annotation)` tuple. The annotation is
+    `None` for "delete" events.
+
+    :raises ValueError: If the entry is not a valid event
+    """
+    action = fields.get('action')
+    if action not in EVENT_ACTIONS:
+        raise ValueError(f'unknown event action "{action}"')
+    if action == 'delete':
+        if not fields.get('id'):
+            raise ValueError('"delete" event has no "id"')
+        return (action, fields['id'], None)
+    try:
+        ann = Annotation.from_api_ann(loads(fields['annotation']))
+    except (KeyError, IndexError, TypeError, ValueError) as ex:
+        raise ValueError(f'invalid annotation in "{action}" event') from ex
+    return (action, ann.id, ann)
+
+
+async def apply_events(index, events):
+    """
+    Apply decoded events to `index`, in order.
+
+    Events are grouped into runs in which no annotation appears twice. Within
+    a run, the order of events does not matter, so all of the removals (for
+    deletes and updates) are applied as one batch followed by all of the
+    additions (for creates and updates).
+
+    :param events: List of `(action, annotation ID, Annotation)` tuples
+    """
+    start = 0
+    while start < len(events):
+        seen = set()
+        end = start
+        while end < len(events) and events[end][1] not in seen:
+            seen.add(events[end][1])
+            end += 1
+
+        run = events[start:end]
+        removed = [id_ for action, id_, _ in run if action != 'create']
+        added = [ann for action, _, ann in run if action != 'delete']
+        if removed:
+            await index.remove_annotations(removed)
+        if added:
+            await index.index_annotations(added)
+        for action, _, _ in run:
+            EVENTS_APPLIED.inc(action)
+
+        start = end
+
+
+def _entry_timestamp(entry_id):
+    """
+    Return the time in seconds since the epoch at which a stream entry was
+    added, from its ID.
+    """
+    return int(entry_id.split('-', 1)[0]) / 1000
+
+
+class EventConsumer:
+    """
+    Applies annotation events from a Redis stream to an index.
+    """
+
+    def __init__(self, index, stream, group='indexer', consumer=None,
+                 batch_size=1000, block=1.0, claim_after=60.0):
+        """
+        :param index: The `AnnotationCountIndex` to apply events to
+        :param stream: Key of the stream
+        :param group: Name of the consumer group shared by indexer processes
+        :param consumer: Name of this consumer within the group. Defaults to
+                         the host name and process ID.
+        :param batch_size: Maximum number of events to read at once
+        :param block: Maximum time in seconds to wait for new events
+        :param claim_after: Time in seconds after which events delivered to
+                            another consumer which have not been acknowledged,
+                            eg. because it crashed, are taken over
+        """
+        self.index = index
+        self.kv_store = index.kv_store
+        self.stream = stream
+        self.group = group
+        self.consumer = consumer or f'{socket.gethostname()}-{os.getpid()}'
+        self.batch_size = batch_size
+        self.block = block
+        self.claim_after = claim_after
+        self._last_claim = None
+
+    async def start(self):
+        await self.kv_store.create_stream_group(self.stream, self.group)
+
+    async def consume_once(self):
+        """
+        Read, apply and acknowledge one batch of events.
+
+        Returns the number of events read.
+        """
+        entries = []
+        now = monotonic()
+        if self._last_claim is None or now - self._last_claim >= self.claim_after:
+            self._last_claim = now
+            entries = await self.kv_store.claim_stream_entries(
+                self.stream, self.group, self.consumer,
+                min_idle=int(self.claim_after * 1000), count=self.batch_size)
+            if entries:
+                logger.info(f'claimed {len(entries)} unacknowledged events')
+        if not entries:
+            entries = await self.kv_store.read_stream_group(
+                self.stream, self.group, self.consumer, count=self.batch_size,
+                block=int(self.block * 1000))
+        if not entries:
+            return 0
+
+        events = []
+        for entry_id, fields in entries:
+            try:
+                events.append(decode_event(fields))
+            except ValueError as ex:
+                # Invalid events are acknowledged below so that they are not
+                # retried forever.
+                EVENTS_REJECTED.inc()
+                logger.warning(f'skipping event {entry_id}: {ex}')
+
+        await apply_events(self.index, events)
+        await self.kv_store.ack_stream_entries(self.stream, self.group,
+                                               [entry_id for entry_id, _ in entries])
+
+        applied_at = time()
+        for entry_id, _ in entries:
+            EVENT_LAG_SECONDS.observe(max(applied_at - _entry_timestamp(entry_id), 0.0))
+        return len(entries)
+
+    async def run(self, retry_delay=5.0):
+        """
+        Apply events as they arrive, until cancelled.
+        """
+        await self.start()
+        logger.info(f'consuming annotation events from "{self.stream}" as "{self.consumer}"')
+        while True:
+            try:
+                await self.consume_once()
+            except Exception as ex:
+                # Events which were not acknowledged are claimed again later.
+                logger.warning(f'failed to apply annotation events: {ex}')
+                await sleep(retry_delay)
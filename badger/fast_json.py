@@ -0,0 +1,26 @@
+"""
+JSON decoding using the fastest parser which is installed.
+
+orjson is used if it is installed, since it decodes annotations several times
+faster than the standard library and allocates less. It is optional because
+it needs a compiler toolchain to install on some platforms.
+"""
+
+import json
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+# Name of the parser in use, recorded with benchmark results.
+PARSER = 'orjson' if orjson else 'json'
+
+
+def loads(data):
+    """
+    Decode a JSON document from `bytes` or `str`.
+    """
+    if orjson:
+        return orjson.loads(data)
+    return json.loads(data)
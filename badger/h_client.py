@@ -1,35 +1,132 @@
-from asyncio import AbstractEventLoop
+from asyncio import AbstractEventLoop, Lock, sleep
+import json
+import os
+from time import perf_counter
+
 import aiohttp
-import requests
+
+from .metrics import REGISTRY
+from .util import get_logger
+
+logger = get_logger(__name__)
+
+UPSTREAM_REQUEST_SECONDS = REGISTRY.histogram(
+    'badger_upstream_request_seconds',
+    'Latency of requests to h and Elasticsearch', ['service', 'route'])
+UPSTREAM_ERRORS = REGISTRY.counter(
+    'badger_upstream_errors_total',
+    'Failed requests to h and Elasticsearch', ['service', 'route'])
 
 
 class HypothesisAPIClient:
     """
     API client for the "h" service.
+
+    The URLs of API routes are discovered from the API's root URL. The routes
+    are saved to a local file so that a client created while h is unavailable
+    can use the last known routes, and they are discovered lazily, so creating
+    a client does not wait for h.
     """
 
-    def __init__(self, url, loop: AbstractEventLoop=None):
-        self._routes = requests.get(url).json()['links']
+    def __init__(self, url, loop: AbstractEventLoop=None, routes_cache=None):
+        """
+        :param url: Root URL of the h API
+        :param loop: Event loop to use with `aiohttp`
+        :param routes_cache: Path of a file in which discovered routes are
+                             saved
+        """
+        self.url = url
+        self._routes_cache = routes_cache
+        self._routes = self._load_cached_routes()
+        self._routes_lock = Lock()
         self._session = aiohttp.ClientSession(loop=loop)
 
+    @property
+    def ready(self):
+        """
+        Whether the API's routes are known.
+        """
+        return self._routes is not None
+
+    async def refresh_routes(self):
+        """
+        Discover the API's routes and save them to the cache file.
+        """
+        rsp = await self._session.get(self.url)
+        if rsp.status >= 400:
+            raise Exception(f'GET {self.url} failed: {rsp.status}')
+        self._routes = (await rsp.json())['links']
+        self._save_cached_routes()
+
+    async def refresh_routes_periodically(self, interval):
+        """
+        Rediscover the API's routes every `interval` seconds, until cancelled.
+        """
+        while True:
+            try:
+                await self.refresh_routes()
+            except Exception as ex:
+                logger.warning(f'failed to discover h API routes: {ex}')
+            await sleep(interval)
+
+    def _load_cached_routes(self):
+        if not self._routes_cache:
+            return None
+        try:
+            with open(self._routes_cache) as file:
+                cached = json.load(file)
+        except (OSError, ValueError):
+            return None
+        if cached.get('url') != self.url:
+            return None
+        return cached['links']
+
+    def _save_cached_routes(self):
+        if not self._routes_cache:
+            return
+        # Write to a temporary file and rename it, so that other processes
+        # never read a partially written file.
+        tmp_path = f'{self._routes_cache}.{os.getpid()}.tmp'
+        try:
+            with open(tmp_path, 'w') as file:
+                json.dump({'url': self.url, 'links': self._routes}, file)
+            os.replace(tmp_path, self._routes_cache)
+        except OSError as ex:
+            logger.warning(f'failed to save h API routes: {ex}')
+
+    async def _get_routes(self):
+        if self._routes is None:
+            async with self._routes_lock:
+                if self._routes is None:
+                    await self.refresh_routes()
+        return self._routes
+
     async def search(self, params={}):
         return await self._request('search', params=params)
 
-    async def profile(self):
-        return await self._request('profile.read')
+    async def profile(self, auth=None):
+        return await self._request('profile.read', auth=auth)
 
-    async def groups(self):
-        return await self._request('groups.read')
+    async def groups(self, auth=None):
+        return await self._request('groups.read', auth=auth)
 
-    async def _request(self, route, params=None):
+    async def _request(self, route, params=None, auth=None):
         path = route.split('.')
-        entry = self._routes
+        entry = await self._get_routes()
         for p in path:
             entry = entry[p]
         url = entry['url']
-        rsp = await self._session.get(url, params=params)
+        headers = {'Authorization': auth} if auth else None
+        start = perf_counter()
+        try:
+            rsp = await self._session.get(url, params=params, headers=headers)
 
-        if rsp.status >= 400:
-            raise Exception(f'GET {url} failed: {rsp.status}')
+            if rsp.status >= 400:
+                raise Exception(f'GET {url} failed: {rsp.status}')
 
-        return await rsp.json()
+            return await rsp.json()
+        except Exception:
+            UPSTREAM_ERRORS.inc('h', route)
+            raise
+        finally:
+            UPSTREAM_REQUEST_SECONDS.observe(perf_counter() - start, 'h', route)
@@ -1,10 +1,85 @@
-from asyncio import gather
+from asyncio import ensure_future, gather
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+import binascii
+from datetime import datetime, timezone
+from hashlib import sha1
+from time import perf_counter, time
+from zlib import crc32
 
-from .util import get_logger, username_from_userid
+from .digest import IndexDigest
+from .metrics import REGISTRY
+from .principals import PrincipalsCache
+from .uri_filter import URIFilter
+from .util import get_logger, hash_tag, username_from_userid
 from .uri import normalize_uri
 
 logger = get_logger(__name__)
 
+# Maximum number of annotations to add or remove in one request to the store.
+INDEX_BATCH_SIZE = 1000
+
+# Supported ways of storing annotation counters. See `counter_for`.
+COUNTER_LAYOUTS = ('keys', 'hash')
+
+# Supported ways of recording which annotations have been indexed. See
+# `AnnotationCountIndex`.
+ANN_LAYOUTS = ('keys', 'registry')
+
+# Number of hashes that the annotation registry is split across. Each hash
+# should hold few enough entries to use Redis' compact hash encoding (128 by
+# default). This cannot be changed once annotations have been indexed.
+ANN_REGISTRY_BUCKETS = 2**20
+
+# Keys of the table which maps (URI, scope) keys to the integer IDs stored in
+# the annotation registry, and the count of registry entries.
+SCOPE_INTERN_KEYS = ('scope|ids', 'scope|keys', 'scope|next')
+ANN_REGISTRY_SIZE_KEY = 'annreg|size'
+
+# Creation date of the most recent annotation which has been indexed.
+LAST_INDEXED_KEY = 'indexer|last_indexed_date'
+
+# Partitions of a parallel backfill. See `AnnotationCountIndex.plan_backfill`.
+BACKFILL_PLAN_KEY = 'indexer|backfill|plan'
+
+# Number of digest buckets whose sub-buckets are computed with one request to
+# Elasticsearch during reconciliation.
+RECONCILE_BATCH_BUCKETS = 1024
+
+# Approximate number of annotations which are fetched with one request to
+# Elasticsearch during reconciliation.
+RECONCILE_BATCH_ANNOTATIONS = 5000
+
+# Number of seconds for which one process has the sole right to refresh a
+# user's stale profile and groups.
+PRINCIPALS_REFRESH_LOCK_SECONDS = 30
+
+FETCH_COUNT_SECONDS = REGISTRY.histogram(
+    'badger_fetch_count_phase_seconds',
+    'Time spent in each phase of looking up annotation counts', ['phase'])
+URI_FILTER_SKIPS = REGISTRY.counter(
+    'badger_uri_filter_skips_total',
+    'URLs whose lookup was skipped because they were never annotated')
+PRINCIPALS_LOADS = REGISTRY.counter(
+    'badger_principals_loads_total',
+    'Principals lookups which missed the in-process cache, by where they were found',
+    ['source'])
+PRINCIPALS_REFRESH_ERRORS = REGISTRY.counter(
+    'badger_principals_refresh_errors_total',
+    'Background refreshes of stale principals which failed')
+INDEXED_ANNOTATIONS = REGISTRY.counter(
+    'badger_indexer_annotations_total',
+    'Annotations processed by the indexer, including already indexed ones')
+NEW_ANNOTATIONS = REGISTRY.counter(
+    'badger_indexer_new_annotations_total', 'Annotations newly added to the index')
+INDEXED_BATCH_SIZE = REGISTRY.gauge(
+    'badger_indexer_batch_size', 'Number of annotations in the last indexed batch')
+INDEX_RATE = REGISTRY.gauge(
+    'badger_indexer_annotations_per_second',
+    'Rate at which the last batch of annotations was indexed')
+INDEXER_LAG = REGISTRY.gauge(
+    'badger_indexer_lag_seconds',
+    'Time between now and the creation of the last indexed annotation')
+
 
 def uri_scope_key(uri, userid=None, group=None):
     """
@@ -39,31 +114,246 @@ def count_key(uri_scope_key):
     return f'count|{uri_scope_key}'
 
 
+def counter_for(uri_scope_key, layout='keys', tagged=False):
+    """
+    Return the counter associated with a (URI, scope) key.
+
+    With the "keys" layout each (URI, scope) pair has its own counter key. With
+    the "hash" layout the counters for all scopes on a URI are fields of a
+    single hash.
+
+    Returns a `(key, field)` tuple where `field` is `None` for the "keys"
+    layout.
+
+    :param tagged: Whether the URI is wrapped in a hash tag, so that all of
+                   its counters are in the same Redis Cluster slot
+    """
+    uri, scope = uri_scope_key.rsplit('|', 1)
+    if tagged:
+        uri = hash_tag(uri)
+    if layout == 'hash':
+        return (count_key(uri), scope)
+    return (count_key(f'{uri}|{scope}'), None)
+
+
+def counter_key_suffix(key, layout='keys', tagged=False):
+    """
+    Return the (URI, scope) key, or for the "hash" layout the URI, of a
+    counter key returned by `counter_for`.
+    """
+    suffix = key[len(count_key('')):]
+    if not tagged:
+        return suffix
+    if layout == 'hash':
+        return suffix[1:-1]
+    uri, scope = suffix.rsplit('|', 1)
+    return f'{uri[1:-1]}|{scope}'
+
+
+def version_key(uri, tagged=False):
+    return f'version|{hash_tag(uri) if tagged else uri}'
+
+
+def principals_key(token):
+    return f'profile|{token}'
+
+
+def principals_tokens_key(userid):
+    return f'tokens|{userid}'
+
+
+def ann_key(id_):
+    return f'ann|{id_}'
+
+
+def backfill_key(partition):
+    return f'indexer|backfill|{partition}'
+
+
+def ann_id_field(id_):
+    """
+    Return the compact binary encoding of an annotation ID.
+
+    h's annotation IDs are URL-safe base64-encoded UUIDs, which are stored as
+    the 16 bytes of the UUID. Any other IDs are stored as UTF-8. A leading tag
+    byte distinguishes the two.
+    """
+    if len(id_) == 22:
+        try:
+            uuid_bytes = urlsafe_b64decode(id_ + '==')
+            if urlsafe_b64encode(uuid_bytes).rstrip(b'=').decode() == id_:
+                return b'\x01' + uuid_bytes
+        except (binascii.Error, ValueError):
+            pass
+    return b'\x02' + id_.encode()
+
+
+def ann_registry_location(id_):
+    """
+    Return the `(key, field)` under which an annotation is recorded in the
+    compact annotation registry.
+    """
+    field = ann_id_field(id_)
+    bucket = crc32(field) % ANN_REGISTRY_BUCKETS
+    return (f'annreg|{bucket}', field)
+
+
+def _date_timestamp(date):
+    """
+    Convert an annotation creation date to seconds since the epoch.
+
+    :param date: ISO date string in UTC, as stored by h, or milliseconds
+                 since the epoch
+    """
+    if isinstance(date, (int, float)) or date.isdigit():
+        return int(date) / 1000
+    parsed = datetime.strptime(date[:19], '%Y-%m-%dT%H:%M:%S')
+    return parsed.replace(tzinfo=timezone.utc).timestamp()
+
+
+def _scopes_hash(profile, groups):
+    """
+    Return a short hash of the scopes visible to a user.
+    """
+    scopes = sorted(g['id'] for g in groups)
+    scopes.insert(0, profile['userid'] or '')
+    return sha1('|'.join(scopes).encode()).hexdigest()[:16]
+
+
+def _counters(url, profile, groups, layout, tagged=False):
+    """
+    Return the counters for the scopes on `url` visible to a user.
+    """
+    counters = []
+    userid = profile['userid']
+    if userid:
+        counters.append(counter_for(uri_scope_key(url, userid=userid), layout, tagged))
+    for g in groups:
+        pubid = g['id']
+        counters.append(counter_for(uri_scope_key(url, group=pubid), layout, tagged))
+    return counters
+
+
 class AnnotationCountIndex:
     """
     Index of annotation counts made on URLs.
 
     The index has the following schema:
 
-      # Record of which URL scope an annotation has been indexed under.
+      # Record of which URL scope an annotation has been indexed under, stored
+      # either as one key per annotation ("keys" layout)...
       "ann|{ID}" => "{url_scope}"
 
+      # ...or in a compact registry of binary annotation IDs split across
+      # hashes, which maps each ID to an integer standing for the URL scope
+      # ("registry" layout). See `ann_registry_location`.
+      "annreg|{bucket}" => {"{binary ID}": "{scope ID}", ...}
+      "annreg|size" => "{number of annotations in the registry}"
+      "scope|ids" => {"{url_scope}": "{scope ID}", ...}
+      "scope|keys" => {"{scope ID}": "{url_scope}", ...}
+      "scope|next" => "{last allocated scope ID}"
+
       # Time-limited cache of profile + group info for a given API authorization
-      # token.
+      # token, with the time it was fetched from h.
       "profile|{token}" => "{'profile': {user profile},
-                             'groups': {groups}"
+                             'groups': {groups},
+                             'fetched': {timestamp}}"
 
-      # Count of the number of annotations indexed under a given URL and scope.
+      # Authorization tokens with cached profile + group info for a user.
+      "tokens|{userid}" => {"{token}", ...}
+
+      # Count of the number of annotations indexed under a given URL and scope,
+      # stored either as one key per scope ("keys" layout)...
       "count|{url_scope}" => "{annotation count}"
 
+      # ...or as one hash per URL with a field per scope ("hash" layout).
+      "count|{url}" => {"{scope}": "{annotation count}", ...}
+
+      # Version of a URL, incremented whenever any of its counters changes.
+      "version|{url}" => "{version}"
+
+      # With Redis Cluster, the URL in counter and version keys is wrapped in
+      # braces as a hash tag, eg. "count|{https://example.com/}|g:__world__",
+      # so that all of the keys for a URL are in the same slot.
+
+      # Digest of the counters, per bucket of URIs. See `IndexDigest`.
+      "digest|counts" => {"{bucket}": "{annotation count}",
+                          "s{sub-bucket}": "{annotation count}", ...}
+      "digest|sums" => {"{bucket}": "{sum of key hashes}",
+                        "s{sub-bucket}": "{sum of key hashes}", ...}
+      "digest|params" => "{'buckets': {count}, 'sub_buckets': {count},
+                           'complete': {bool}}"
+
+      # Bloom filter of normalized URIs which have been annotated, with its
+      # parameters, a version which changes when it is updated and the version
+      # of each chunk of the bitmap, so that readers fetch only changed chunks.
+      "filter|uris" => "{bitmap}"
+      "filter|uris|params" => "{'bits': {size}, 'hashes': {count},
+                                'complete': {bool}}"
+      "filter|uris|version" => "{version}"
+      "filter|uris|chunks" => {"{chunk}": "{version}", ...}
+
       # Book-keeping keys used by the indexer.
       "indexer|{name}" => "{value}"
     """
 
-    def __init__(self, h_api_client, ann_fetcher, kv_store):
+    def __init__(self, h_api_client, ann_fetcher, kv_store,
+                 principals_cache=None, uri_filter=None, counter_layout='keys',
+                 ann_layout='keys', digest=None, principals_soft_ttl=300.0,
+                 principals_hard_ttl=86400.0, anonymous_groups=('__world__',)):
+        """
+        :param counter_layout: How counters are stored in `kv_store`, either
+                               "keys" or "hash". See `counter_for`.
+        :param ann_layout: How the record of indexed annotations is stored in
+                           `kv_store`, either "keys" or "registry"
+        :param principals_soft_ttl: Age in seconds after which a user's cached
+                                    profile and groups are refreshed in the
+                                    background
+        :param principals_hard_ttl: Age in seconds after which a user's cached
+                                    profile and groups are discarded
+        :param anonymous_groups: IDs of the groups whose annotations are
+                                 visible to requests without an access token
+        """
+        if counter_layout not in COUNTER_LAYOUTS:
+            raise ValueError(f'unknown counter layout "{counter_layout}"')
+        if ann_layout not in ANN_LAYOUTS:
+            raise ValueError(f'unknown annotation layout "{ann_layout}"')
+        if ann_layout == 'registry' and kv_store.cluster:
+            raise ValueError('the "registry" annotation layout is not supported '
+                             'with Redis Cluster')
+        self.counter_layout = counter_layout
+        self.ann_layout = ann_layout
+        self.tagged = kv_store.cluster
         self.ann_fetcher = ann_fetcher
         self.h_api = h_api_client
         self.kv_store = kv_store
+        # An empty cache is falsy, so test for `None` explicitly.
+        self.principals_cache = (PrincipalsCache() if principals_cache is None
+                                 else principals_cache)
+        self.uri_filter = uri_filter or URIFilter(kv_store)
+        self.digest = digest or IndexDigest(kv_store)
+        self.principals_soft_ttl = principals_soft_ttl
+        self.principals_hard_ttl = principals_hard_ttl
+        self.anonymous_profile = {'userid': None}
+        self.anonymous_groups = [{'id': pubid} for pubid in anonymous_groups]
+        self._created = False
+
+        # Tokens whose principals are being refreshed by this process.
+        self._refreshing_principals = set()
+
+        cache = self.principals_cache
+        REGISTRY.add_callback('badger_principals_cache_hits_total',
+                              'Principals lookups served from the in-process cache',
+                              lambda: cache.hits, type='counter')
+        REGISTRY.add_callback('badger_principals_cache_misses_total',
+                              'Principals lookups which missed the in-process cache',
+                              lambda: cache.misses, type='counter')
+        REGISTRY.add_callback('badger_principals_cache_coalesced_total',
+                              'Principals lookups which waited for a concurrent lookup',
+                              lambda: cache.coalesced, type='counter')
+        REGISTRY.add_callback('badger_principals_cache_entries',
+                              'Number of entries in the in-process principals cache',
+                              lambda: len(cache))
 
     async def fetch_count(self, url, auth):
         """
@@ -72,68 +362,710 @@ class AnnotationCountIndex:
         Query the count index for the number of annotations made against `url`
         which are visible to a user identified by an authorization token `auth`.
         """
-        principals_key = f'profile|{auth}'
-        principals_val = self.kv_store.get_dict(principals_key)
-        if not principals_val:
-            [profile, groups] = await gather(self.h_api.profile(), self.h_api.groups())
-            principals = {'profile': profile, 'groups': groups}
-            self.kv_store.put_dict(principals_key, principals, expiry=10)
+        count, _ = await self._fetch_count(url, auth, with_tag=False)
+        return count
+
+    async def fetch_count_and_tag(self, url, auth):
+        """
+        Retrieve the result of `fetch_count` together with a tag which changes
+        whenever that result may have changed.
+
+        The tag combines the version of `url` with a hash of the scopes visible
+        to the user. The version is read in the same request as the counters,
+        so answering a conditional request costs at most one round trip to the
+        store. URLs which are not in the URI filter have a count of 0 for
+        every user, so they get a fixed tag without looking up principals.
+
+        Returns a tuple of (count, tag).
+        """
+        return await self._fetch_count(url, auth, with_tag=True)
+
+    async def _fetch_count(self, url, auth, with_tag):
+        start = perf_counter()
+        normalized_uri = normalize_uri(url)
+        might_contain = self.uri_filter.might_contain(normalized_uri)
+        filtered = perf_counter()
+        FETCH_COUNT_SECONDS.observe(filtered - start, 'uri_filter')
+        if not might_contain:
+            URI_FILTER_SKIPS.inc()
+            # Stored versions are never empty, so this tag changes when the URI
+            # is added to the filter.
+            return 0, '-0'
+
+        profile, groups = await self._fetch_principals(auth)
+        fetched = perf_counter()
+        FETCH_COUNT_SECONDS.observe(fetched - filtered, 'principals')
+
+        counters = _counters(url, profile, groups, self.counter_layout, self.tagged)
+        if not with_tag:
+            count = await self.kv_store.sum_counters(counters)
+            FETCH_COUNT_SECONDS.observe(perf_counter() - fetched, 'counters')
+            return count, None
+
+        # The version is read like a counter, so that it is fetched in the same
+        # request as the counters.
+        version_counter = (version_key(normalized_uri, self.tagged), None)
+        [version, count] = await self.kv_store.sum_counter_groups(
+            [[version_counter], counters])
+        FETCH_COUNT_SECONDS.observe(perf_counter() - fetched, 'counters')
+        return count, f'{version}-{_scopes_hash(profile, groups)}'
+
+    async def fetch_counts(self, urls, auth):
+        """
+        Retrieve counts of annotations made on each of `urls`.
+
+        This is equivalent to calling `fetch_count` for each URL but looks up
+        the user's principals once and fetches the counters for all URLs using
+        a single round trip to the store.
+
+        Returns a dict of URL => count.
+        """
+        start = perf_counter()
+        counts = {url: 0 for url in urls}
+        urls = [url for url in counts
+                if self.uri_filter.might_contain(normalize_uri(url))]
+        filtered = perf_counter()
+        FETCH_COUNT_SECONDS.observe(filtered - start, 'uri_filter')
+        URI_FILTER_SKIPS.inc(amount=len(counts) - len(urls))
+        if not urls:
+            return counts
+
+        profile, groups = await self._fetch_principals(auth)
+        fetched = perf_counter()
+        FETCH_COUNT_SECONDS.observe(fetched - filtered, 'principals')
+
+        counter_groups = [_counters(url, profile, groups, self.counter_layout,
+                                    self.tagged)
+                          for url in urls]
+        totals = await self.kv_store.sum_counter_groups(counter_groups)
+        FETCH_COUNT_SECONDS.observe(perf_counter() - fetched, 'counters')
+        counts.update(zip(urls, totals))
+        return counts
+
+    async def _fetch_principals(self, auth):
+        """
+        Return the profile and groups of the user identified by `auth`.
+
+        Principals are looked up in the in-process cache, then the key-value
+        store and finally fetched from h. Requests without an access token can
+        only see public groups, so their principals are fixed.
+        """
+        if not auth:
+            return self.anonymous_profile, self.anonymous_groups
+        principals = await self.principals_cache.get_or_fetch(
+            auth, lambda: self._load_principals(auth))
+        return principals['profile'], principals['groups']
+
+    async def _load_principals(self, auth):
+        """
+        Return the principals for `auth` from the key-value store or h.
+
+        Principals older than the soft TTL are returned as they are and
+        refreshed in the background, so that h is only waited for when a
+        token is first seen or has not been used for the hard TTL.
+        """
+        principals = await self.kv_store.get_dict(principals_key(auth))
+        if not principals:
+            PRINCIPALS_LOADS.inc('h')
+            return await self._fetch_principals_from_h(auth)
+
+        if time() - principals.get('fetched', 0) > self.principals_soft_ttl:
+            PRINCIPALS_LOADS.inc('stale')
+            self._refresh_principals(auth)
         else:
-            profile = principals_val['profile']
-            groups = principals_val['groups']
+            PRINCIPALS_LOADS.inc('store')
+        return principals
 
-        keys = []
-        userid = profile['userid']
+    async def _fetch_principals_from_h(self, auth):
+        [profile, groups] = await gather(self.h_api.profile(auth),
+                                         self.h_api.groups(auth))
+        principals = {'profile': profile, 'groups': groups, 'fetched': time()}
+        await self.kv_store.put_dict(principals_key(auth), principals,
+                                     expiry=self.principals_hard_ttl)
+        userid = profile.get('userid')
         if userid:
-            keys.append(count_key(uri_scope_key(url, userid=userid)))
-        for g in groups:
-            pubid = g['id']
-            keys.append(count_key(uri_scope_key(url, group=pubid)))
+            await self.kv_store.add_to_set(principals_tokens_key(userid), [auth],
+                                           expiry=self.principals_hard_ttl)
+        return principals
 
-        return self.kv_store.sum_counters(keys)
+    def _refresh_principals(self, auth):
+        """
+        Refresh the principals for `auth` in the background.
 
-    async def incremental_index(self):
-        last_indexed_key = 'indexer|last_indexed_date'
-        last_indexed_date = self.kv_store.get(last_indexed_key)
+        Only one process refreshes a token at a time. If the refresh fails,
+        the stale principals are used until the next attempt.
+        """
+        if auth in self._refreshing_principals:
+            return
+        self._refreshing_principals.add(auth)
+
+        async def refresh():
+            try:
+                lock_key = f'{principals_key(auth)}|refresh'
+                if await self.kv_store.put_if_absent(lock_key, '1',
+                                                     expiry=PRINCIPALS_REFRESH_LOCK_SECONDS):
+                    principals = await self._fetch_principals_from_h(auth)
+                    self.principals_cache.put(auth, principals)
+            except Exception as ex:
+                PRINCIPALS_REFRESH_ERRORS.inc()
+                logger.warning(f'failed to refresh principals: {ex}')
+            finally:
+                self._refreshing_principals.discard(auth)
+
+        ensure_future(refresh())
+
+    async def invalidate_principals(self, userid):
+        """
+        Discard the cached principals of every token belonging to `userid`.
 
-        async for ann in self.ann_fetcher.fetch_added_since(last_indexed_date):
-            self.index_annotations([ann])
-            if last_indexed_date is None or ann.created > last_indexed_date:
-                self.kv_store.put(last_indexed_key, ann.created)
+        h calls this, via the web service, when the user's group memberships
+        change. Entries in the in-process caches of other processes expire
+        after their (short) TTL.
 
-        async for id_ in self.ann_fetcher.fetch_deleted_since(last_indexed_date):
-            self.remove_annotation(id_)
+        Returns the number of tokens whose principals were discarded.
+        """
+        tokens = await self.kv_store.pop_set(principals_tokens_key(userid))
+        await gather(*[self.kv_store.delete(principals_key(token)) for token in tokens])
+        self.principals_cache.invalidate_user(userid)
+        return len(tokens)
+
+    async def indexer_lag(self):
+        """
+        Return the number of seconds between now and the creation of the last
+        indexed annotation, or `None` if nothing has been indexed.
+
+        This is also recorded in the "badger_indexer_lag_seconds" metric.
+        """
+        last_indexed_date = await self.kv_store.get(LAST_INDEXED_KEY)
+        if not last_indexed_date:
+            return None
+        lag = max(time() - _date_timestamp(last_indexed_date), 0.0)
+        INDEXER_LAG.set(lag)
+        return lag
+
+    async def build_uri_filter(self):
+        """
+        Add the URIs of all indexed annotations to the URI filter.
+
+        This is needed to create the filter for an index which was built
+        before the filter existed.
+
+        Returns the number of counters scanned.
+        """
+        scanned = 0
+        uris = set()
+        async for key in self.kv_store.scan_keys(count_key('*')):
+            uri = counter_key_suffix(key, self.counter_layout, self.tagged)
+            if self.counter_layout == 'keys':
+                uri, _ = uri.rsplit('|', 1)
+            uris.add(uri)
+            scanned += 1
+            if len(uris) >= INDEX_BATCH_SIZE:
+                await self.uri_filter.add(uris)
+                uris = set()
+        await self.uri_filter.add(uris)
+        await self.uri_filter.mark_complete()
+        return scanned
+
+    async def _has_counters(self):
+        async for _ in self.kv_store.scan_keys(count_key('*')):
+            return True
+        return False
+
+    async def incremental_index(self):
+        """
+        Index annotations added since the last run.
 
-    def index_annotations(self, anns):
+        The indexer's position is checkpointed once per batch, after the batch
+        has been indexed.
+
+        Returns the number of newly indexed annotations.
+        """
+        since = await self.kv_store.get(LAST_INDEXED_KEY)
+        last_indexed_date = since
         new_anns = 0
 
-        for ann in anns:
-            # Check if annotation is already indexed.
-            ann_key = f'ann|{ann.id}'
-            indexed_uri = self.kv_store.get(ann_key)
-            if indexed_uri:
-                continue
+        async for anns in self.ann_fetcher.fetch_batches_since(since):
+            new_anns += await self.index_annotations(anns)
+            latest = max((ann.created for ann in anns), default=None)
+            if latest and (last_indexed_date is None or latest > last_indexed_date):
+                last_indexed_date = latest
+                await self.kv_store.put(LAST_INDEXED_KEY, last_indexed_date)
 
-            # Index annotation.
-            # TODO - Make the `inc_counter` and `put` commands below an atomic
-            # op.
-            new_anns += 1
-            uri_scope_key = uri_scope_key_for_ann(ann)
-            new_count = self.kv_store.inc_counter(count_key(uri_scope_key))
-            self.kv_store.put(ann_key, uri_scope_key)
-            logger.debug(f'incremented {uri_scope_key} to {new_count}')
+        # Deletions are fetched from the position before this run, as those
+        # made while it was indexing would otherwise be skipped.
+        async for id_ in self.ann_fetcher.fetch_deleted_since(since):
+            await self.remove_annotation(id_)
 
+        await self.indexer_lag()
         return new_anns
 
-    def remove_annotation(self, id_):
-        ann_key = f'ann|{id_}'
-        uri_scope_key = self.kv_store.get(ann_key)
-        if not uri_scope_key:
-            return False
-
-        # TODO - Make the `delete` and `dec_counter` commands below an atomic
-        # op.
-        self.kv_store.delete(ann_key)
-        new_count = self.kv_store.dec_counter(count_key(uri_scope_key))
-        logger.debug(f'incremented {uri_scope_key} to {new_count}')
+    async def plan_backfill(self, partitions, restart=False):
+        """
+        Split the annotations in h into partitions for a parallel backfill.
+
+        The plan is saved so that an interrupted backfill can be resumed with
+        the same partitions, unless `restart` is true.
+
+        Returns a list of `(start, end)` creation date ranges, in milliseconds
+        since the epoch. The first range has no start and the last no end.
+        """
+        plan = None if restart else await self.kv_store.get_dict(BACKFILL_PLAN_KEY)
+        if plan:
+            return [tuple(bounds) for bounds in plan]
+
+        for key in [k async for k in self.kv_store.scan_keys(backfill_key('*'))]:
+            await self.kv_store.delete(key)
+        boundaries = await self.ann_fetcher.fetch_created_quantiles(partitions)
+        starts = [None] + boundaries
+        ends = boundaries + [None]
+        plan = list(zip(starts, ends))
+        await self.kv_store.put_dict(BACKFILL_PLAN_KEY, plan)
+        return plan
+
+    async def backfill_partition(self, partition, start, end):
+        """
+        Index annotations created between `start` (inclusive) and `end`.
+
+        Progress is checkpointed after each batch so that the partition can be
+        resumed if the backfill is interrupted.
+
+        Returns the creation date of the last annotation fetched.
+        """
+        checkpoint_key = backfill_key(partition)
+        checkpoint = await self.kv_store.get_dict(checkpoint_key) or {}
+        if checkpoint.get('done'):
+            return checkpoint.get('last_created')
+
+        since = checkpoint.get('last_created') or start
+        async for anns in self.ann_fetcher.fetch_batches_since(since, until=end):
+            new_anns = await self.index_annotations(anns)
+            if anns:
+                checkpoint['last_created'] = anns[-1].created
+                await self.kv_store.put_dict(checkpoint_key, checkpoint)
+            logger.info(f'partition {partition}: indexed {new_anns} new annotations')
+
+        checkpoint['done'] = True
+        await self.kv_store.put_dict(checkpoint_key, checkpoint)
+        return checkpoint.get('last_created')
+
+    async def finish_backfill(self):
+        """
+        Record the end of a backfill so that incremental indexing continues
+        from the last annotation which was backfilled.
+
+        Returns `False` if some partitions have not been completed.
+        """
+        plan = await self.kv_store.get_dict(BACKFILL_PLAN_KEY) or []
+        last_created = []
+        for partition in range(len(plan)):
+            checkpoint = await self.kv_store.get_dict(backfill_key(partition)) or {}
+            if not checkpoint.get('done'):
+                return False
+            if checkpoint.get('last_created'):
+                last_created.append(checkpoint['last_created'])
+
+        last_indexed_date = await self.kv_store.get(LAST_INDEXED_KEY)
+        if last_indexed_date:
+            last_created.append(last_indexed_date)
+        if last_created:
+            await self.kv_store.put(LAST_INDEXED_KEY, max(last_created))
+
+        for partition in range(len(plan)):
+            await self.kv_store.delete(backfill_key(partition))
+        await self.kv_store.delete(BACKFILL_PLAN_KEY)
         return True
+
+    async def index_annotations(self, anns):
+        """
+        Add `anns` to the index, skipping any which are already indexed.
+
+        Annotations are indexed in batches. Each batch is checked and applied
+        atomically with a single request to the store, so the counters always
+        agree with the "ann|{ID}" records even if the indexer is interrupted.
+
+        Returns the number of newly indexed annotations.
+        """
+        new_anns = 0
+        started = perf_counter()
+
+        for start in range(0, len(anns), INDEX_BATCH_SIZE):
+            batch = anns[start:start + INDEX_BATCH_SIZE]
+
+            # URIs are added to the filter first so that it never reports a
+            # URI with indexed annotations as unannotated.
+            await self._ensure_created()
+            await self.uri_filter.add({normalize_uri(ann.uri) for ann in batch})
+
+            entries = []
+            for ann in batch:
+                uri_scope_key = uri_scope_key_for_ann(ann)
+                counter = counter_for(uri_scope_key, self.counter_layout, self.tagged)
+                if self.ann_layout == 'registry':
+                    entries.append((*ann_registry_location(ann.id),
+                                    uri_scope_key, *counter))
+                else:
+                    entries.append((ann_key(ann.id), uri_scope_key, *counter))
+
+            if self.ann_layout == 'registry':
+                new_anns += await self.kv_store.add_interned_entries(
+                    entries, SCOPE_INTERN_KEYS, ANN_REGISTRY_SIZE_KEY,
+                    digest=self.digest.script_keys, versions=version_key(''))
+            else:
+                new_anns += await self.kv_store.add_entries(
+                    entries, digest=self.digest.script_keys,
+                    versions=version_key(''))
+
+        elapsed = perf_counter() - started
+        INDEXED_ANNOTATIONS.inc(amount=len(anns))
+        NEW_ANNOTATIONS.inc(amount=new_anns)
+        INDEXED_BATCH_SIZE.set(len(anns))
+        if anns and elapsed > 0:
+            INDEX_RATE.set(len(anns) / elapsed)
+
+        logger.debug(f'indexed {new_anns} of {len(anns)} annotations')
+        return new_anns
+
+    async def remove_annotation(self, id_):
+        [found] = await self.remove_annotations([id_])
+        return found
+
+    async def remove_annotations(self, ids):
+        """
+        Remove the annotations with the given IDs from the index.
+
+        As with `index_annotations`, each batch is applied atomically.
+
+        Returns a list of booleans indicating whether each annotation was
+        indexed.
+        """
+        found = []
+        hashed = self.counter_layout == 'hash'
+        await self._ensure_created()
+        for start in range(0, len(ids), INDEX_BATCH_SIZE):
+            batch = ids[start:start + INDEX_BATCH_SIZE]
+            if self.ann_layout == 'registry':
+                entries = [ann_registry_location(id_) for id_ in batch]
+                found += await self.kv_store.remove_interned_entries(
+                    entries, SCOPE_INTERN_KEYS, ANN_REGISTRY_SIZE_KEY,
+                    count_key(''), hashed=hashed, digest=self.digest.script_keys,
+                    versions=version_key(''))
+            else:
+                keys = [ann_key(id_) for id_ in batch]
+                found += await self.kv_store.remove_entries(
+                    keys, count_key(''), hashed=hashed,
+                    digest=self.digest.script_keys, versions=version_key(''))
+        return found
+
+    async def _ensure_created(self):
+        """
+        Create the URI filter and digest if they do not exist.
+
+        They are complete, and so usable immediately, only if they are created
+        before anything is indexed.
+        """
+        if self._created:
+            return
+        is_empty = not await self._has_counters()
+        await self.uri_filter.create(complete=is_empty)
+        await self.digest.create(complete=is_empty)
+        self._created = True
+
+    async def _get_records(self, ids):
+        """
+        Return the (URI, scope) key which each annotation is indexed under, or
+        `None` for annotations which are not indexed.
+        """
+        if self.ann_layout == 'registry':
+            return await self.kv_store.get_interned_entries(
+                [ann_registry_location(id_) for id_ in ids], SCOPE_INTERN_KEYS)
+        return await self.kv_store.get_entries([ann_key(id_) for id_ in ids])
+
+    async def _scan_counters(self):
+        """
+        Iterate over `(uri_scope_key, count)` for every counter.
+        """
+        layout = self.counter_layout
+        if layout == 'hash':
+            async for key in self.kv_store.scan_keys(count_key('*'), type='hash'):
+                uri = counter_key_suffix(key, layout, self.tagged)
+                for scope, count in (await self.kv_store.get_hash(key, typ=int)).items():
+                    yield (f'{uri}|{scope}', count)
+        else:
+            async for key in self.kv_store.scan_keys(count_key('*'), type='string'):
+                yield (counter_key_suffix(key, layout, self.tagged),
+                       int(await self.kv_store.get(key) or 0))
+
+    async def build_digest(self):
+        """
+        Compute the digest from the existing counters.
+
+        This is needed for an index which was built before the digest
+        existed. The indexer should be stopped while the digest is built.
+        """
+        await self._ensure_created()
+        await self.digest.build(self._scan_counters())
+
+    async def reconcile(self):
+        """
+        Find and correct differences between the index and the annotations in
+        h.
+
+        The digest of the index is compared with the same digest computed by
+        Elasticsearch, and the buckets which differ are narrowed down to the
+        sub-buckets which differ. Only the annotations in those sub-buckets
+        are examined in detail: annotations which are missing from the index
+        are added, annotations which are indexed under the wrong URL or scope
+        are moved, annotations which h has deleted are removed and finally any
+        counters which still disagree with h are corrected.
+
+        Returns a dict with the number of buckets and sub-buckets which
+        differed and the number of annotations and counters which were
+        corrected.
+        """
+        await self._ensure_created()
+        await self.digest.load()
+        if not self.digest.complete:
+            raise Exception('digest is incomplete, run "build-digest" first')
+
+        buckets = self.digest.buckets
+        expected = await self.ann_fetcher.fetch_digest(buckets)
+        actual = await self.digest.read()
+        differing = sorted(bucket for bucket in expected.keys() | actual.keys()
+                           if expected.get(bucket) != actual.get(bucket))
+        report = {'buckets': len(differing), 'sub_buckets': 0, 'added': 0,
+                  'moved': 0, 'removed': 0, 'counters': 0}
+        if not differing:
+            return report
+        logger.info(f'{len(differing)} of {buckets} digest buckets differ')
+
+        fine_buckets = self.digest.fine_buckets
+        if fine_buckets != buckets:
+            expected = {}
+            for start in range(0, len(differing), RECONCILE_BATCH_BUCKETS):
+                expected.update(await self.ann_fetcher.fetch_digest(
+                    fine_buckets, parent_buckets=buckets,
+                    selected=differing[start:start + RECONCILE_BATCH_BUCKETS]))
+            actual = await self.digest.read_sub_buckets(differing)
+            differing = sorted(bucket for bucket in expected.keys() | actual.keys()
+                               if expected.get(bucket) != actual.get(bucket))
+        report['sub_buckets'] = len(differing)
+
+        for selected in self._reconcile_batches(differing, expected):
+            anns = await self.ann_fetcher.fetch_bucket_annotations(fine_buckets, selected)
+            await self._reconcile_anns(anns, report)
+        remaining = await self._differing_buckets(differing, expected)
+
+        if remaining:
+            report['removed'] += await self._remove_deleted(remaining, expected)
+            remaining = await self._differing_buckets(remaining, expected)
+
+        for selected in self._reconcile_batches(remaining, expected):
+            anns = await self.ann_fetcher.fetch_bucket_annotations(fine_buckets, selected)
+            report['counters'] += await self._reconcile_counters(anns)
+
+        unresolved = await self._differing_buckets(remaining, expected)
+        if unresolved:
+            logger.warning(f'{len(unresolved)} digest sub-buckets still differ, '
+                           'possibly due to counters of URLs which no longer '
+                           'have any annotations')
+        return report
+
+    def _reconcile_batches(self, buckets, expected):
+        """
+        Split digest sub-buckets into batches which each hold about
+        `RECONCILE_BATCH_ANNOTATIONS` annotations in h.
+        """
+        batch = []
+        size = 0
+        for bucket in buckets:
+            count, _ = expected.get(bucket, (0, 0))
+            if batch and size + count > RECONCILE_BATCH_ANNOTATIONS:
+                yield batch
+                batch = []
+                size = 0
+            batch.append(bucket)
+            size += count
+        if batch:
+            yield batch
+
+    async def _remove_deleted(self, buckets, expected):
+        """
+        Remove annotations which h has marked as deleted from the digest
+        sub-buckets `buckets`.
+
+        h only keeps the ID of a deleted annotation, so deleted annotations
+        cannot be selected by URI in Elasticsearch. Instead their IDs are
+        looked up in the index a page at a time, only those indexed under a
+        URI in one of `buckets` are removed, and the scan stops once no
+        sub-bucket holds more annotations than h has.
+
+        Returns the number of annotations which were removed.
+        """
+        excess = await self._excess_buckets(buckets, expected)
+        removed = 0
+        if not excess:
+            return removed
+        async for ids in self.ann_fetcher.fetch_deleted_ids():
+            records = await self._get_records(ids)
+            stale = [id_ for id_, record in zip(ids, records)
+                     if record is not None and
+                     self.digest.sub_bucket(record.rsplit('|', 1)[0]) in excess]
+            if not stale:
+                continue
+            removed += sum(await self.remove_annotations(stale))
+            excess = await self._excess_buckets(excess, expected)
+            if not excess:
+                break
+        return removed
+
+    async def _excess_buckets(self, buckets, expected):
+        """
+        Return the digest sub-buckets of `buckets` which hold more annotations
+        in the index than in h.
+        """
+        actual = await self._read_sub_buckets(buckets)
+        return {bucket for bucket in buckets
+                if actual.get(bucket, (0, 0))[0] > expected.get(bucket, (0, 0))[0]}
+
+    async def _reconcile_anns(self, anns, report):
+        """
+        Index annotations which are missing from the index or are indexed
+        under the wrong (URI, scope) key.
+        """
+        missing = []
+        moved = []
+        for start in range(0, len(anns), INDEX_BATCH_SIZE):
+            batch = anns[start:start + INDEX_BATCH_SIZE]
+            records = await self._get_records([ann.id for ann in batch])
+            for ann, record in zip(batch, records):
+                if record is None:
+                    missing.append(ann)
+                elif record != uri_scope_key_for_ann(ann):
+                    moved.append(ann)
+
+        await self.remove_annotations([ann.id for ann in moved])
+        await self.index_annotations(missing + moved)
+        report['added'] += len(missing)
+        report['moved'] += len(moved)
+
+    async def _reconcile_counters(self, anns):
+        """
+        Set the counters of the (URI, scope) keys which `anns` are indexed
+        under to the number of annotations.
+
+        Returns the number of counters which were changed.
+        """
+        expected = {}
+        for ann in anns:
+            key = uri_scope_key_for_ann(ann)
+            expected[key] = expected.get(key, 0) + 1
+
+        keys = list(expected)
+        counters = [counter_for(key, self.counter_layout, self.tagged) for key in keys]
+        values = await self.kv_store.sum_counter_groups([[counter] for counter in counters])
+        adjustments = []
+        for key, counter, value in zip(keys, counters, values):
+            delta = expected[key] - value
+            if delta:
+                adjustments.append((*counter, key, delta))
+        await self.kv_store.adjust_counters(adjustments,
+                                            digest=self.digest.script_keys,
+                                            versions=version_key(''))
+        return len(adjustments)
+
+    async def _differing_buckets(self, buckets, expected):
+        actual = await self._read_sub_buckets(buckets)
+        return [bucket for bucket in buckets
+                if expected.get(bucket) != actual.get(bucket)]
+
+    async def _read_sub_buckets(self, sub_buckets):
+        """
+        Read the digest of the index for the given sub-buckets.
+        """
+        parents = {sub_bucket % self.digest.buckets for sub_bucket in sub_buckets}
+        return await self.digest.read_sub_buckets(sorted(parents))
+
+    async def migrate_counters_to_hash(self):
+        """
+        Convert counters stored using the "keys" layout to the "hash" layout.
+
+        Counters are moved in batches, each of which is applied atomically, so
+        the migration can be interrupted and resumed.
+
+        Returns the number of counters which were moved.
+        """
+        moved = 0
+        moves = []
+        async for key in self.kv_store.scan_keys(count_key('*'), type='string'):
+            uri_scope_key = counter_key_suffix(key, 'keys', self.tagged)
+            moves.append((key, *counter_for(uri_scope_key, 'hash', self.tagged)))
+            if len(moves) >= INDEX_BATCH_SIZE:
+                moved += await self.kv_store.move_counters_to_hash(moves)
+                moves = []
+                logger.info(f'moved {moved} counters')
+        moved += await self.kv_store.move_counters_to_hash(moves)
+        return moved
+
+    async def migrate_anns_to_registry(self):
+        """
+        Convert "ann|{ID}" records to the compact annotation registry.
+
+        As with `migrate_counters_to_hash`, records are moved in atomic
+        batches.
+
+        Returns the number of records which were moved.
+        """
+        moved = 0
+        moves = []
+        async for key in self.kv_store.scan_keys(ann_key('*'), type='string'):
+            id_ = key[len(ann_key('')):]
+            moves.append((key, *ann_registry_location(id_)))
+            if len(moves) >= INDEX_BATCH_SIZE:
+                moved += await self.kv_store.move_to_interned_entries(
+                    moves, SCOPE_INTERN_KEYS, ANN_REGISTRY_SIZE_KEY)
+                moves = []
+                logger.info(f'moved {moved} annotation records')
+        moved += await self.kv_store.move_to_interned_entries(
+            moves, SCOPE_INTERN_KEYS, ANN_REGISTRY_SIZE_KEY)
+        return moved
+
+    async def memory_report(self, sample_size=1000):
+        """
+        Estimate the memory used per indexed annotation by each annotation
+        layout which is present in the store.
+
+        Up to `sample_size` keys of each layout are sampled.
+
+        Returns a dict of layout => bytes per annotation.
+        """
+        report = {}
+
+        total_bytes = 0
+        sampled = 0
+        async for key in self.kv_store.scan_keys(ann_key('*'), type='string'):
+            total_bytes += await self.kv_store.memory_usage(key) or 0
+            sampled += 1
+            if sampled >= sample_size:
+                break
+        if sampled:
+            report['keys'] = total_bytes / sampled
+
+        total_bytes = 0
+        entries = 0
+        sampled = 0
+        async for key in self.kv_store.scan_keys('annreg|*', type='hash'):
+            total_bytes += await self.kv_store.memory_usage(key) or 0
+            entries += await self.kv_store.hash_length(key)
+            sampled += 1
+            if sampled >= sample_size:
+                break
+        registry_size = int(await self.kv_store.get(ANN_REGISTRY_SIZE_KEY) or 0)
+        if entries and registry_size:
+            # Include a share of the table of interned scopes.
+            intern_bytes = 0
+            for key in SCOPE_INTERN_KEYS:
+                intern_bytes += await self.kv_store.memory_usage(key) or 0
+            report['registry'] = total_bytes / entries + intern_bytes / registry_size
+
+        return report
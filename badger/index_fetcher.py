@@ -1,8 +1,11 @@
-from asyncio import AbstractEventLoop, sleep
+from asyncio import AbstractEventLoop, CancelledError, ensure_future
+from time import perf_counter
 
 import aiohttp
 
-from .h_client import HypothesisAPIClient
+from .fast_json import loads
+from .h_client import HypothesisAPIClient, UPSTREAM_ERRORS, UPSTREAM_REQUEST_SECONDS
+from .scheduler import RateLimiter
 from .util import get_logger
 
 logger = get_logger(__name__)
@@ -13,9 +16,12 @@ class Annotation:
     An annotation fetched from h.
 
     This representation contains only the fields that are needed by the
-    badger service.
+    badger service. Annotations are created in large numbers by the indexer,
+    so instances have no `__dict__`.
     """
 
+    __slots__ = ('id', 'created', 'groupid', 'is_shared', 'uri', 'userid')
+
     def __init__(self, id, uri, groupid, userid, is_shared, created):
         self.id = id
 
@@ -30,8 +36,7 @@ class Annotation:
         """
         Decode an annotation from the H API into an `Annotation`.
         """
-        is_shared = bool([item for item in api_ann['permissions']['read'] if
-                         item.startswith('group')])
+        is_shared = any(item.startswith('group') for item in api_ann['permissions']['read'])
         uri = api_ann['target'][0]['source']
         return cls(api_ann['id'], uri=uri, userid=api_ann['user'], groupid=api_ann['group'],
                    is_shared=is_shared, created=api_ann['created'])
@@ -47,6 +52,29 @@ class Annotation:
                    created=content['created'])
 
 
+def decode_es_hits(body):
+    """
+    Decode an Elasticsearch search response into `Annotation`s.
+
+    Hits for annotations which h has marked as deleted are skipped. The decoded
+    response is not kept once the batch has been converted, so that only the
+    `Annotation`s of a batch outlive the call.
+
+    :param body: Response body as `bytes`, which should be filtered to the
+                 `_id`, `_source` and `sort` fields of hits
+    :return: Tuple of (list of `Annotation`, number of hits, `sort` value of
+             the last hit or `None` if there were no hits)
+    """
+    hits = loads(body).get('hits', {}).get('hits', [])
+    if not hits:
+        return [], 0, None
+    anns = []
+    for hit in hits:
+        if hit['_source'].get('deleted') is not True:
+            anns.append(Annotation.from_es_ann(hit))
+    return anns, len(hits), hits[-1]['sort']
+
+
 class AnnotationFetcher:
     """
     Interface for fetching annotations from h.
@@ -62,6 +90,16 @@ class AnnotationFetcher:
         """
         ...
 
+    async def fetch_batches_since(self, date):
+        """
+        Fetch annotations added since `date` in batches.
+
+        Returns iterable of lists of `Annotation`.
+        """
+        anns = [ann async for ann in self.fetch_added_since(date)]
+        if anns:
+            yield anns
+
     async def fetch_deleted_since(self, date):
         """
         Fetch annotations deleted since `date`.
@@ -113,67 +151,293 @@ class HypothesisAPIFetcher(AnnotationFetcher):
         yield  # Make this method a generator
 
 
+# Painless code which computes the "{uri}|{scope}" key and digest bucket of the
+# annotation in `params._source`, matching `uri_scope_key_for_ann` and
+# `IndexDigest.bucket`. `key` is null for deleted annotations.
+_PAINLESS_DIGEST_KEY = """
+def src = params._source;
+String key = null;
+int bucket = 0;
+if (src.deleted != true && src.uri != null) {
+  String scope;
+  if (src.shared == true) {
+    scope = 'g:' + src.group;
+  } else {
+    String user = src.user == null ? '' : src.user;
+    int at = user.indexOf('@');
+    boolean valid = user.startsWith('acct:') && at > 5 && at == user.lastIndexOf('@')
+                    && at < user.length() - 1;
+    scope = 'u:' + (valid ? user.substring(5, at) : 'None');
+  }
+  key = src.uri + '|' + scope;
+  bucket = Math.floorMod(src.uri.hashCode(), params.buckets);
+}
+"""
+
+# Scripted metric aggregation which computes the digest of all annotations,
+# or only of the buckets which are contained in one of `params.selected`
+# buckets of a coarser digest with `params.parent_buckets` buckets. The result
+# maps bucket => [count, sum of key hashes].
+_DIGEST_AGGREGATION = {
+    'init_script': """
+state.counts = new HashMap();
+state.sums = new HashMap();
+state.selected = params.containsKey('selected') ? new HashSet(params.selected) : null;
+""",
+    'map_script': _PAINLESS_DIGEST_KEY + """
+if (key != null && (state.selected == null ||
+                    state.selected.contains(bucket % params.parent_buckets))) {
+  state.counts.put(bucket, state.counts.getOrDefault(bucket, 0L) + 1);
+  state.sums.put(bucket, state.sums.getOrDefault(bucket, 0L) + key.hashCode());
+}
+""",
+    'combine_script': 'return state;',
+    'reduce_script': """
+Map result = new HashMap();
+for (s in states) {
+  if (s == null) { continue; }
+  for (bucket in s.counts.keySet()) {
+    String k = String.valueOf(bucket);
+    long[] entry = result.containsKey(k) ? result.get(k) : new long[] {0L, 0L};
+    entry[0] += s.counts.get(bucket);
+    entry[1] += s.sums.get(bucket);
+    result.put(k, entry);
+  }
+}
+return result;
+""",
+}
+
+# Scripted metric aggregation which returns the annotations in the digest
+# buckets listed in `params.selected`, as lists of the fields of `Annotation`.
+_BUCKET_ANNOTATIONS_AGGREGATION = {
+    'init_script': 'state.anns = new ArrayList(); state.selected = new HashSet(params.selected);',
+    'map_script': _PAINLESS_DIGEST_KEY + """
+if (key != null && state.selected.contains(bucket)) {
+  state.anns.add([src.id, src.uri, src.group, src.user, src.shared, src.created]);
+}
+""",
+    'combine_script': 'return state.anns;',
+    'reduce_script': """
+List result = new ArrayList();
+for (s in states) {
+  if (s != null) { result.addAll(s); }
+}
+return result;
+""",
+}
+
+
 class ElasticsearchFetcher(AnnotationFetcher):
     """
     Fetch annotations directly from the Elasticsearch index maintained by h.
+
+    Results are paged through using a `search_after` cursor over a stable sort
+    order (creation date, then a unique tiebreaker field), so that no
+    annotations are skipped when several share a creation date. While one batch
+    is being processed, the next one is fetched in the background.
+
+    Requests are limited to a maximum average rate so that a large backlog
+    does not overload Elasticsearch.
     """
+
+    # Fields of `_source` which are needed to decode an `Annotation`.
+    SOURCE_FIELDS = ['uri', 'user', 'group', 'shared', 'created', 'deleted']
+
     def __init__(self, es_url, loop: AbstractEventLoop=None,
-                 batch_fetch_delay=None):
+                 max_request_rate=None, batch_size=1000,
+                 tiebreaker_field='_id', es_index='hypothesis'):
         """
         :param es_url: Root URL of Elasticsearch server
         :param loop: Event loop to use with `aiohttp`
-        :param batch_fetch_delay: Amount of time to sleep between fetching
-                                  result batches. Use to reduce load on
-                                  Elasticsearch service.
+        :param max_request_rate: Maximum average number of requests per
+                                 second, or `None` for no limit. Use to reduce
+                                 load on Elasticsearch service.
+        :param batch_size: Number of hits to fetch from ES at once
+        :param tiebreaker_field: Unique field used to order annotations with the
+                                 same creation date
+        :param es_index: Name of the Elasticsearch index
         """
         self._session = aiohttp.ClientSession(loop=loop)
-        self._batch_fetch_delay = batch_fetch_delay
-
-        # Number of hits to fetch from ES at once.
-        self._batch_size = 1000
+        self._rate_limiter = RateLimiter(max_request_rate)
+        self._batch_size = batch_size
+        self._tiebreaker_field = tiebreaker_field
+        self._es_index = es_index
 
         self.es_url = es_url
 
     async def fetch_added_since(self, date):
-        while True:
-            params = {'sort': [{'created': {'order': 'asc'}}],
-                      'size': self._batch_size}
-            if date:
-                params['query'] = {'range': {'created': {'gt': date}}}
-
-            es_hits = await self._es_query(params)
-            if len(es_hits) == 0:
-                return
+        async for anns in self.fetch_batches_since(date):
+            for ann in anns:
+                yield ann
 
-            if date:
-                logger.info(f'fetched {len(es_hits)} annotations from ES added since {date}')
-            else:
-                logger.info(f'fetched {len(es_hits)} annotations from ES')
+    async def fetch_batches_since(self, date, until=None):
+        """
+        Fetch annotations added since `date` in batches.
 
-            def is_deleted(hit):
-                return hit['_source'].get('deleted') is True
+        Annotations created at exactly `date` are included, since others may
+        have been created at the same time as the last one seen. The index
+        ignores annotations which it has already indexed.
 
-            anns = [Annotation.from_es_ann(hit) for hit in es_hits
-                    if not is_deleted(hit)]
-            date = sorted([ann.created for ann in anns])[-1]
-            for ann in anns:
-                yield ann
+        :param date: Creation date to fetch from, as an ISO date string or
+                     milliseconds since the epoch
+        :param until: If set, only annotations created before this date are
+                      fetched
 
-            if self._batch_fetch_delay:
-                await sleep(self._batch_fetch_delay)
+        Returns iterable of lists of `Annotation`.
+        """
+        params = {'sort': [{'created': {'order': 'asc'}},
+                           {self._tiebreaker_field: {'order': 'asc'}}],
+                  'size': self._batch_size,
+                  '_source': self.SOURCE_FIELDS}
+        created_range = {}
+        if date:
+            created_range['gte'] = date
+        if until:
+            created_range['lt'] = until
+        if created_range:
+            params['query'] = {'range': {'created': created_range}}
+
+        pending = ensure_future(self._es_query(params))
+        try:
+            while True:
+                anns, hit_count, last_sort = await pending
+                if hit_count == 0:
+                    return
+
+                if date:
+                    logger.info(f'fetched {hit_count} annotations from ES added since {date}')
+                else:
+                    logger.info(f'fetched {hit_count} annotations from ES')
+
+                # Start fetching the next batch while this one is processed.
+                params = {**params, 'search_after': last_sort}
+                pending = ensure_future(self._es_query(params))
+
+                yield anns
+        finally:
+            pending.cancel()
 
     async def fetch_deleted_since(self, date):
         # Not supported
-        yield []
+        return
+        yield  # Make this method a generator
+
+    async def fetch_created_quantiles(self, count):
+        """
+        Split annotations into `count` groups of similar size by creation date.
+
+        Returns a list of `count - 1` creation dates, in milliseconds since the
+        epoch, which separate the groups.
+        """
+        if count < 2:
+            return []
+        percents = [100 * i / count for i in range(1, count)]
+        params = {'size': 0,
+                  'aggs': {'created': {'percentiles': {'field': 'created',
+                                                       'percents': percents}}}}
+        result = await self._es_request(params, {'filter_path': 'aggregations'})
+        values = result.get('aggregations', {}).get('created', {}).get('values', {})
+        return sorted({int(value) for value in values.values() if value is not None})
+
+    async def fetch_digest(self, buckets, parent_buckets=None, selected=None):
+        """
+        Compute the digest of all annotations, as stored by `IndexDigest`.
+
+        :param buckets: Number of buckets
+        :param parent_buckets: Number of buckets of a coarser digest, in which
+                               bucket `n % parent_buckets` contains bucket `n`
+        :param selected: If set, only buckets contained in these buckets of
+                         the coarser digest are computed
+        :return: Dict of bucket => `(count, sum)`
+        """
+        params = {'buckets': buckets}
+        if selected is not None:
+            params.update(parent_buckets=parent_buckets, selected=sorted(selected))
+        script = {**_DIGEST_AGGREGATION, 'params': params}
+        result = await self._es_aggregate(script)
+        return {int(bucket): (int(count), int(sum_))
+                for bucket, (count, sum_) in (result or {}).items()}
+
+    async def fetch_bucket_annotations(self, buckets, selected):
+        """
+        Fetch the annotations in the `selected` digest buckets.
+
+        The annotations are returned in one response, so the caller should
+        select buckets which together hold a modest number of annotations.
+
+        :param buckets: Number of buckets, eg. the number of sub-buckets of an
+                        `IndexDigest`
+        :return: List of `Annotation`
+        """
+        script = {**_BUCKET_ANNOTATIONS_AGGREGATION,
+                  'params': {'buckets': buckets, 'selected': sorted(selected)}}
+        result = await self._es_aggregate(script)
+        return [Annotation(id_, uri=uri, groupid=groupid, userid=userid,
+                           is_shared=bool(is_shared), created=created)
+                for id_, uri, groupid, userid, is_shared, created in result or []]
+
+    async def fetch_deleted_ids(self):
+        """
+        Fetch the IDs of annotations which h has marked as deleted.
+
+        Returns iterable of lists of annotation IDs.
+        """
+        params = {'query': {'term': {'deleted': True}},
+                  'sort': [{self._tiebreaker_field: {'order': 'asc'}}],
+                  'size': self._batch_size,
+                  '_source': False}
+        while True:
+            query = {'filter_path': 'hits.hits._id,hits.hits.sort'}
+            result = await self._es_request(params, query)
+            hits = result.get('hits', {}).get('hits', [])
+            if not hits:
+                return
+            yield [hit['_id'] for hit in hits]
+            params = {**params, 'search_after': hits[-1]['sort']}
+
+    async def _es_aggregate(self, script):
+        """
+        Run a scripted metric aggregation over all annotations and return its
+        value.
+        """
+        params = {'size': 0, 'aggs': {'result': {'scripted_metric': script}}}
+        result = await self._es_request(params, {'filter_path': 'aggregations'})
+        return result.get('aggregations', {}).get('result', {}).get('value')
 
     async def _es_query(self, params):
-        es_index = 'hypothesis'
-        url = f'{self.es_url}/{es_index}/_search'
-        rsp = await self._session.post(url, json=params)
+        """
+        Fetch a batch of annotations.
 
-        if rsp.status >= 400:
-            details = await rsp.text()
-            raise Exception(f'POST {url} with {params} failed: {rsp.status}, {details}')
+        Returns the result of `decode_es_hits`.
+        """
+        query = {'filter_path': 'hits.hits._id,hits.hits._source,hits.hits.sort'}
+        body = await self._es_request(params, query, decode=False)
+        return decode_es_hits(body)
 
-        result = await rsp.json()
-        return result['hits']['hits']
+    async def _es_request(self, params, query=None, decode=True):
+        """
+        Make a search request and return the decoded response, or the raw body
+        if `decode` is false.
+        """
+        url = f'{self.es_url}/{self._es_index}/_search'
+        await self._rate_limiter.acquire()
+        start = perf_counter()
+        try:
+            rsp = await self._session.post(url, params=query, json=params)
+
+            if rsp.status >= 400:
+                details = await rsp.text()
+                raise Exception(f'POST {url} with {params} failed: {rsp.status}, {details}')
+
+            body = await rsp.read()
+            return loads(body) if decode else body
+        except CancelledError:
+            # Prefetches are cancelled when the caller stops paging.
+            raise
+        except Exception:
+            UPSTREAM_ERRORS.inc('elasticsearch', 'search')
+            raise
+        finally:
+            UPSTREAM_REQUEST_SECONDS.observe(perf_counter() - start,
+                                             'elasticsearch', 'search')
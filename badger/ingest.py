@@ -0,0 +1,179 @@
+"""
+Streaming ingest of annotation dump files.
+
+Two dump formats are supported, either of which may be gzip-compressed:
+
+ - "ndjson": One JSON document per line. Each document is either an
+   annotation in h API format or an `/api/search` response with a "rows" list.
+ - "legacy": Pretty-printed `/api/search` responses separated by marker
+   lines of four double quotes, as written by older versions of
+   `tools/dump_public.py`.
+
+The file is read in chunks and the chunks are decoded in a pool of worker
+processes, so that memory use does not depend on the size of the file and
+JSON decoding is spread across cores.
+"""
+
+from asyncio import get_event_loop
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import gzip
+from multiprocessing import get_context
+import os
+
+from .fast_json import loads
+from .index_fetcher import Annotation
+
+FORMATS = ('ndjson', 'legacy')
+
+# Marker separating search responses in legacy dump files.
+LEGACY_MARKER = b'""""'
+
+GZIP_MAGIC = b'\x1f\x8b'
+
+
+def open_dump(path):
+    """
+    Open a dump file for reading in binary mode, decompressing it if needed.
+    """
+    with open(path, 'rb') as file:
+        magic = file.read(2)
+    if magic == GZIP_MAGIC:
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+
+def detect_format(path):
+    """
+    Return the format of a dump file, based on its first line.
+
+    Legacy dumps start with the opening brace of a pretty-printed JSON object
+    on a line of its own.
+    """
+    with open_dump(path) as file:
+        for line in file:
+            if line.strip():
+                return 'legacy' if line.strip() == b'{' else 'ndjson'
+    return 'ndjson'
+
+
+def read_chunks(file, format, chunk_size=4 * 1024 * 1024):
+    """
+    Split a dump file into chunks which can be decoded independently.
+
+    Chunks are approximately `chunk_size` bytes and end at a line boundary,
+    or for legacy dumps, a marker.
+
+    Returns iterable of bytes.
+    """
+    if format == 'legacy':
+        yield from _read_legacy_chunks(file, chunk_size)
+        return
+
+    remainder = b''
+    while True:
+        data = file.read(chunk_size)
+        if not data:
+            break
+        data = remainder + data
+        end = data.rfind(b'\n') + 1
+        if end == 0:
+            remainder = data
+            continue
+        remainder = data[end:]
+        yield data[:end]
+
+    if remainder.strip():
+        yield remainder
+
+
+def _read_legacy_chunks(file, chunk_size):
+    lines = []
+    size = 0
+    for line in file:
+        lines.append(line)
+        size += len(line)
+        if LEGACY_MARKER in line and size >= chunk_size:
+            yield b''.join(lines)
+            lines = []
+            size = 0
+    if lines:
+        yield b''.join(lines)
+
+
+def decode_chunk(chunk, format):
+    """
+    Decode the annotations in a chunk returned by `read_chunks`.
+
+    Each document is converted as soon as it is decoded, so that only one
+    decoded document is held in memory at a time.
+
+    Returns a list of `Annotation`.
+    """
+    if format == 'legacy':
+        blocks = chunk.split(LEGACY_MARKER)
+    else:
+        blocks = chunk.splitlines()
+
+    anns = []
+    for block in blocks:
+        if not block.strip():
+            continue
+        doc = loads(block)
+        if 'rows' in doc:
+            anns.extend(Annotation.from_api_ann(ann) for ann in doc['rows'])
+        else:
+            anns.append(Annotation.from_api_ann(doc))
+    return anns
+
+
+async def ingest_file(index, path, format=None, workers=None,
+                      chunk_size=4 * 1024 * 1024, on_progress=None):
+    """
+    Index all of the annotations in a dump file.
+
+    :param index: The `AnnotationCountIndex` to add annotations to
+    :param path: Path of the dump file
+    :param format: Format of the dump file. Detected from its contents if not
+                   set.
+    :param workers: Number of processes used to decode the file
+    :param chunk_size: Approximate size in bytes of each decoded chunk
+    :param on_progress: Callback invoked with the number of annotations read
+                        so far after each chunk is indexed
+    :return: Number of annotations read from the file
+    """
+    format = format or detect_format(path)
+    workers = workers or os.cpu_count()
+    loop = get_event_loop()
+    read_count = 0
+
+    # Worker processes are spawned rather than forked so that they do not
+    # inherit the event loop and connections of this process.
+    pool = ProcessPoolExecutor(workers, mp_context=get_context('spawn'))
+    with pool, open_dump(path) as file:
+        # Limit the number of chunks being decoded at once so that memory use
+        # stays bounded when decoding is faster than indexing.
+        max_pending = 2 * workers
+        chunks = read_chunks(file, format, chunk_size)
+        pending = deque()
+
+        def next_chunk():
+            return next(chunks, None)
+
+        while True:
+            while len(pending) < max_pending:
+                chunk = await loop.run_in_executor(None, next_chunk)
+                if chunk is None:
+                    break
+                pending.append(loop.run_in_executor(pool, decode_chunk, chunk, format))
+
+            if not pending:
+                break
+
+            anns = await pending.popleft()
+            await index.index_annotations(anns)
+            read_count += len(anns)
+            if on_progress:
+                on_progress(read_count)
+
+    return read_count
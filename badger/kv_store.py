@@ -1,48 +1,1050 @@
+from asyncio import gather
 import json
-from redis import StrictRedis
+from redis.asyncio import BlockingConnectionPool, StrictRedis
+from redis.asyncio.cluster import RedisCluster
+from redis.crc import key_slot
+from redis.exceptions import ResponseError
+
+from .coalescer import ReadCoalescer
+from .digest import SUB_BUCKETS, java_string_hash
+from .util import hash_tag
+
+
+# Lua function which adds `amount` to a counter. Counters are either plain
+# keys or, if `field` is non-empty, fields of a hash.
+_INCR_COUNTER_LUA = """
+local function incr_counter(key, field, amount)
+  if field == '' then
+    return redis.call('INCRBY', key, amount)
+  else
+    return redis.call('HINCRBY', key, field, amount)
+  end
+end
+"""
+
+# Lua functions which maintain a digest of the counters, split into buckets.
+# Each bucket holds the total of the counters whose value (a "{uri}|{scope}"
+# string) hashes to it and the sum of their values' hashes, weighted by count.
+# The hash is Java's `String.hashCode` so that Elasticsearch scripts can
+# compute the same digest. Each bucket's sub-bucket is updated as well, in a
+# field named "s{sub-bucket}". See `badger.digest`.
+#
+# `update_digest` does nothing if `buckets` is 0.
+_DIGEST_LUA = f"local SUB_BUCKETS = {SUB_BUCKETS}\n" + """
+local function java_hash(s)
+  local h, i, n = 0, 1, #s
+  while i <= n do
+    local c, len = string.byte(s, i), 1
+    if c >= 0xF0 then c, len = c % 0x08, 4
+    elseif c >= 0xE0 then c, len = c % 0x10, 3
+    elseif c >= 0xC0 then c, len = c % 0x20, 2 end
+    for j = i + 1, i + len - 1 do
+      c = c * 64 + string.byte(s, j) % 64
+    end
+    i = i + len
+    if c >= 0x10000 then
+      c = c - 0x10000
+      h = (h * 31 + 0xD800 + math.floor(c / 1024)) % 4294967296
+      c = 0xDC00 + c % 1024
+    end
+    h = (h * 31 + c) % 4294967296
+  end
+  if h >= 2147483648 then h = h - 4294967296 end
+  return h
+end
+
+local function update_digest(counts, sums, buckets, value, amount)
+  if buckets == 0 then return end
+  local uri_hash = java_hash(string.match(value, '^(.*)|[^|]*$'))
+  local sum = string.format('%.0f', java_hash(value) * amount)
+  local sub_bucket = string.format('s%d', uri_hash % (buckets * SUB_BUCKETS))
+  for _, field in ipairs({string.format('%d', uri_hash % buckets), sub_bucket}) do
+    redis.call('HINCRBY', counts, field, amount)
+    redis.call('HINCRBY', sums, field, sum)
+  end
+end
+"""
+
+# Lua function which increments the version of the URI of an entry value (a
+# "{uri}|{scope}" string), so that clients can tell whether any count for the
+# URI may have changed.
+#
+# `bump_version` does nothing if `prefix` is empty.
+_VERSION_LUA = """
+local function bump_version(prefix, value)
+  if prefix == '' then return end
+  redis.call('INCR', prefix .. string.match(value, '^(.*)|[^|]*$'))
+end
+"""
+
+# Lua script which records a batch of entries and increments the counter
+# associated with each entry that was not already present.
+#
+# KEYS: the digest's count and sum keys, then the entry key and counter key of
+#       each entry, interleaved
+# ARGV: the number of digest buckets and the URI version prefix, then the
+#       value and counter field of each entry, interleaved
+_ADD_ENTRIES_SCRIPT = _INCR_COUNTER_LUA + _DIGEST_LUA + _VERSION_LUA + """
+local digest_counts, digest_sums, buckets = KEYS[1], KEYS[2], tonumber(ARGV[1])
+local versions = ARGV[2]
+local added = 0
+for i = 3, #KEYS, 2 do
+  if redis.call('SETNX', KEYS[i], ARGV[i]) == 1 then
+    incr_counter(KEYS[i + 1], ARGV[i + 1], 1)
+    update_digest(digest_counts, digest_sums, buckets, ARGV[i], 1)
+    bump_version(versions, ARGV[i])
+    added = added + 1
+  end
+end
+return added
+"""
+
+# Lua script which deletes a batch of entries and decrements the counter
+# associated with each entry that was present.
+#
+# KEYS: the digest's count and sum keys, then the entry keys
+# ARGV: prefix which maps an entry's value to the key of its counter, whether
+#       counters are hash fields, the number of digest buckets and the URI
+#       version prefix. If counters are hash fields, the value is split at its
+#       last "|" into the counter key suffix and the field.
+_REMOVE_ENTRIES_SCRIPT = _INCR_COUNTER_LUA + _DIGEST_LUA + _VERSION_LUA + """
+local digest_counts, digest_sums = KEYS[1], KEYS[2]
+local prefix, hashed, buckets = ARGV[1], ARGV[2] == '1', tonumber(ARGV[3])
+local versions = ARGV[4]
+local removed = {}
+for i = 3, #KEYS do
+  local key = KEYS[i]
+  local value = redis.call('GET', key)
+  if value then
+    redis.call('DEL', key)
+    if hashed then
+      local suffix, field = string.match(value, '^(.*)|([^|]*)$')
+      incr_counter(prefix .. suffix, field, -1)
+    else
+      incr_counter(prefix .. value, '', -1)
+    end
+    update_digest(digest_counts, digest_sums, buckets, value, -1)
+    bump_version(versions, value)
+    removed[i - 2] = 1
+  else
+    removed[i - 2] = 0
+  end
+end
+return removed
+"""
+
+# Lua function which maps a value to a small integer ID, assigning a new ID
+# from the `next_id` counter the first time a value is seen. `ids` and
+# `values` are hashes mapping values to IDs and vice versa.
+_INTERN_LUA = """
+local function intern(ids, values, next_id, value)
+  local id = redis.call('HGET', ids, value)
+  if not id then
+    id = redis.call('INCR', next_id)
+    redis.call('HSET', ids, value, id)
+    redis.call('HSET', values, id, value)
+  end
+  return id
+end
+"""
+
+# Lua script which records a batch of entries as hash fields with interned
+# values and increments the counter associated with each new entry.
+#
+# KEYS: the intern table's ID, value and next ID keys, a counter of the number
+#       of entries, the digest's count and sum keys, then the hash key and
+#       counter key of each entry, interleaved
+# ARGV: the number of digest buckets and the URI version prefix, then the
+#       field, value and counter field of each entry, interleaved
+_ADD_INTERNED_ENTRIES_SCRIPT = (_INCR_COUNTER_LUA + _INTERN_LUA + _DIGEST_LUA +
+                                _VERSION_LUA + """
+local ids, values, next_id, size = KEYS[1], KEYS[2], KEYS[3], KEYS[4]
+local digest_counts, digest_sums, buckets = KEYS[5], KEYS[6], tonumber(ARGV[1])
+local versions = ARGV[2]
+local added = 0
+for i = 7, #KEYS, 2 do
+  local j = (i - 7) / 2 * 3 + 3
+  local hash, field = KEYS[i], ARGV[j]
+  if redis.call('HEXISTS', hash, field) == 0 then
+    redis.call('HSET', hash, field, intern(ids, values, next_id, ARGV[j + 1]))
+    incr_counter(KEYS[i + 1], ARGV[j + 2], 1)
+    update_digest(digest_counts, digest_sums, buckets, ARGV[j + 1], 1)
+    bump_version(versions, ARGV[j + 1])
+    added = added + 1
+  end
+end
+redis.call('INCRBY', size, added)
+return added
+""")
+
+# Lua script which deletes a batch of entries stored as hash fields with
+# interned values and decrements the counter associated with each entry that
+# was present.
+#
+# KEYS: the intern table's value key, a counter of the number of entries, the
+#       digest's count and sum keys, then the hash key of each entry
+# ARGV: the counter prefix, hashed flag, number of digest buckets and URI
+#       version prefix, as for `_REMOVE_ENTRIES_SCRIPT`, then the field of each
+#       entry
+_REMOVE_INTERNED_ENTRIES_SCRIPT = _INCR_COUNTER_LUA + _DIGEST_LUA + _VERSION_LUA + """
+local values, size, digest_counts, digest_sums = KEYS[1], KEYS[2], KEYS[3], KEYS[4]
+local prefix, hashed, buckets = ARGV[1], ARGV[2] == '1', tonumber(ARGV[3])
+local versions = ARGV[4]
+local removed = {}
+for i = 5, #KEYS do
+  local hash, field = KEYS[i], ARGV[i]
+  local id = redis.call('HGET', hash, field)
+  if id then
+    redis.call('HDEL', hash, field)
+    redis.call('DECR', size)
+    local value = redis.call('HGET', values, id)
+    if hashed then
+      local suffix, counter_field = string.match(value, '^(.*)|([^|]*)$')
+      incr_counter(prefix .. suffix, counter_field, -1)
+    else
+      incr_counter(prefix .. value, '', -1)
+    end
+    update_digest(digest_counts, digest_sums, buckets, value, -1)
+    bump_version(versions, value)
+    removed[i - 4] = 1
+  else
+    removed[i - 4] = 0
+  end
+end
+return removed
+"""
+
+# Lua script which moves entries stored as plain keys into hash fields with
+# interned values.
+#
+# KEYS: as for `_ADD_INTERNED_ENTRIES_SCRIPT`, followed by the source key and
+#       destination hash of each entry, interleaved
+# ARGV: the destination field of each entry
+_MOVE_TO_INTERNED_ENTRIES_SCRIPT = _INTERN_LUA + """
+local ids, values, next_id, size = KEYS[1], KEYS[2], KEYS[3], KEYS[4]
+local moved = 0
+for i = 5, #KEYS, 2 do
+  local src, hash, field = KEYS[i], KEYS[i + 1], ARGV[(i - 3) / 2]
+  local value = redis.call('GET', src)
+  if value then
+    if redis.call('HSETNX', hash, field, intern(ids, values, next_id, value)) == 1 then
+      moved = moved + 1
+    end
+    redis.call('DEL', src)
+  end
+end
+redis.call('INCRBY', size, moved)
+return moved
+"""
+
+# Lua script which adds an amount to each of a batch of counters.
+#
+# KEYS: the digest's count and sum keys, then the key of each counter
+# ARGV: the number of digest buckets and the URI version prefix, then the
+#       field, value (as used to maintain the digest and versions) and amount
+#       of each counter, interleaved
+_ADJUST_COUNTERS_SCRIPT = _INCR_COUNTER_LUA + _DIGEST_LUA + _VERSION_LUA + """
+local digest_counts, digest_sums, buckets = KEYS[1], KEYS[2], tonumber(ARGV[1])
+local versions = ARGV[2]
+for i = 3, #KEYS do
+  local j = (i - 3) * 3 + 3
+  local amount = tonumber(ARGV[j + 2])
+  incr_counter(KEYS[i], ARGV[j], amount)
+  update_digest(digest_counts, digest_sums, buckets, ARGV[j + 1], amount)
+  bump_version(versions, ARGV[j + 1])
+end
+return #KEYS - 2
+"""
+
+# Lua script which moves counters stored as plain keys into hash fields.
+#
+# KEYS: source key and destination hash of each counter, interleaved
+# ARGV: destination field of each counter
+_MOVE_COUNTERS_SCRIPT = """
+local moved = 0
+for i, field in ipairs(ARGV) do
+  local src, dest = KEYS[2 * i - 1], KEYS[2 * i]
+  local value = redis.call('GET', src)
+  if value then
+    redis.call('HINCRBY', dest, field, value)
+    redis.call('DEL', src)
+    moved = moved + 1
+  end
+end
+return moved
+"""
+
+
+# Lua script which adds an amount to each of a batch of counters in one Redis
+# Cluster slot and increments the version of each counter's URI, which is in the
+# same slot. This is the cluster equivalent of `_ADJUST_COUNTERS_SCRIPT`.
+#
+# KEYS: the counter key and URI version key of each counter, interleaved
+# ARGV: whether to increment versions, then the field and amount of each
+#       counter, interleaved
+_CLUSTER_ADJUST_COUNTERS_SCRIPT = _INCR_COUNTER_LUA + """
+local bump = ARGV[1] == '1'
+for i = 1, #KEYS, 2 do
+  incr_counter(KEYS[i], ARGV[i + 1], tonumber(ARGV[i + 2]))
+  if bump then
+    redis.call('INCR', KEYS[i + 1])
+  end
+end
+return #KEYS / 2
+"""
+
+
+# Lua script which deletes a set and returns its members. A script is atomic
+# on both a single server and a cluster, unlike a `MULTI` transaction which
+# Redis Cluster clients do not support.
+#
+# KEYS: the set
+_POP_SET_SCRIPT = """
+local members = redis.call('SMEMBERS', KEYS[1])
+redis.call('DEL', KEYS[1])
+return members
+"""
 
 
 def tostr(bytes):
     return bytes.decode()
 
 
+def _change_args(digest, versions):
+    """
+    Return the initial script keys and arguments which identify the digest
+    and URI versions to update when counters change. See `_DIGEST_LUA` and
+    `_VERSION_LUA`.
+    """
+    if digest is None:
+        # Placeholder keys, which are not used since the bucket count is 0.
+        keys, args = ['', ''], [0]
+    else:
+        counts_key, sums_key, buckets = digest
+        keys, args = [counts_key, sums_key], [buckets]
+    return keys, args + [versions or '']
+
+
+def digest_changes(changes, buckets):
+    """
+    Compute the changes to the digest's buckets caused by changes to counters,
+    as `_DIGEST_LUA` does inside Redis.
+
+    :param changes: List of `(value, amount)` tuples, where `value` is the
+                    "{uri}|{scope}" value of a counter and `amount` is the
+                    amount added to it
+    :param buckets: Number of digest buckets
+    :return: Tuple of dicts of field => amount to add to the digest's counts
+             and sums, where the fields are bucket numbers and "s{sub-bucket}"
+    """
+    counts = {}
+    sums = {}
+    for value, amount in changes:
+        uri, _ = value.rsplit('|', 1)
+        uri_hash = java_string_hash(uri)
+        key_hash = java_string_hash(value)
+        for field in (uri_hash % buckets, f's{uri_hash % (buckets * SUB_BUCKETS)}'):
+            counts[field] = counts.get(field, 0) + amount
+            sums[field] = sums.get(field, 0) + amount * key_hash
+    return counts, sums
+
+
+def _decode_stream_entry(entry):
+    id_, fields = entry
+    return (tostr(id_), {tostr(k): tostr(v) for k, v in fields.items()})
+
+
 class KeyValueStore:
     """
     Interface to the Redis store used by the annotation count index.
 
     This provides an abstraction over the Redis store to facilitate testing etc.
+
+    All operations are coroutines which use a non-blocking Redis client, so that
+    a slow Redis reply only delays the request which is waiting for it rather
+    than every request being handled by the event loop.
     """
 
-    def __init__(self, redis_host, redis_port):
-        self.redis = StrictRedis(redis_host, redis_port, db=0)
+    # Whether keys are spread across the slots of a Redis Cluster. See
+    # `ClusterKeyValueStore`.
+    cluster = False
+
+    def __init__(self, redis_host, redis_port, max_connections=50,
+                 timeout=5.0, pool_timeout=1.0, redis_db=0, batch_window=None,
+                 batch_max_keys=1000):
+        """
+        :param redis_host: Hostname of Redis server
+        :param redis_port: Port of Redis server
+        :param max_connections: Maximum number of connections in the pool.
+                                Operations wait for a free connection once
+                                this is reached.
+        :param timeout: Timeout in seconds for connecting to Redis and for
+                        individual commands
+        :param pool_timeout: Maximum time in seconds to wait for a free
+                             connection from the pool
+        :param redis_db: Number of the Redis database to use
+        :param batch_window: If set, counter and principals reads which arrive
+                             within this many seconds of each other are sent
+                             to Redis together. See `ReadCoalescer`.
+        :param batch_max_keys: Number of keys at which a batch of reads is sent
+                               without waiting for the window to end
+        """
+        pool = BlockingConnectionPool(host=redis_host, port=redis_port, db=redis_db,
+                                      max_connections=max_connections,
+                                      timeout=pool_timeout,
+                                      socket_timeout=timeout,
+                                      socket_connect_timeout=timeout)
+        self.redis = StrictRedis(connection_pool=pool)
+        self._add_entries = self.redis.register_script(_ADD_ENTRIES_SCRIPT)
+        self._remove_entries = self.redis.register_script(_REMOVE_ENTRIES_SCRIPT)
+        self._move_counters = self.redis.register_script(_MOVE_COUNTERS_SCRIPT)
+        self._add_interned_entries = self.redis.register_script(
+            _ADD_INTERNED_ENTRIES_SCRIPT)
+        self._remove_interned_entries = self.redis.register_script(
+            _REMOVE_INTERNED_ENTRIES_SCRIPT)
+        self._move_to_interned_entries = self.redis.register_script(
+            _MOVE_TO_INTERNED_ENTRIES_SCRIPT)
+        self._adjust_counters = self.redis.register_script(_ADJUST_COUNTERS_SCRIPT)
+        self._pop_set = self.redis.register_script(_POP_SET_SCRIPT)
+        self._coalescer = (ReadCoalescer(self._get_counters, batch_window, batch_max_keys)
+                           if batch_window else None)
+
+    async def ping(self):
+        """
+        Check that the Redis server is reachable.
+        """
+        return await self.redis.ping()
+
+    async def inc_counter(self, key, field=None):
+        if field is None:
+            return await self.redis.incr(key)
+        return await self.redis.hincrby(key, field, 1)
+
+    async def dec_counter(self, key, field=None):
+        if field is None:
+            return await self.redis.decr(key)
+        return await self.redis.hincrby(key, field, -1)
+
+    async def sum_counters(self, counters):
+        """
+        Sum the values of `counters`.
+
+        :param counters: List of `(key, field)` tuples identifying counters.
+                         `field` is `None` for counters stored as plain keys or
+                         the field name for counters stored in a hash.
+        """
+        [total] = await self.sum_counter_groups([counters])
+        return total
+
+    async def sum_counter_groups(self, counter_groups):
+        """
+        Sum the counters in each of `counter_groups` using a single request.
+
+        Returns a list with the total for each group of counters.
+        """
+        counters = [counter for counters in counter_groups for counter in counters]
+        if not counters:
+            return [0] * len(counter_groups)
+        counts = iter(await self._read(counters))
+
+        totals = []
+        for counters in counter_groups:
+            group_counts = [next(counts) for _ in counters]
+            totals.append(sum(int(count) for count in group_counts if count))
+        return totals
+
+    async def _read(self, counters):
+        """
+        Fetch the values of `counters`, together with concurrent reads if
+        reads are coalesced.
+        """
+        if self._coalescer:
+            return await self._coalescer.read(counters)
+        return await self._get_counters(counters)
+
+    async def _get_counters(self, counters):
+        """
+        Fetch the values of `counters` with a single round trip.
+
+        Plain keys are fetched using one `MGET` and the fields of each hash
+        using an `HMGET`, sent together in a pipeline.
+        """
+        keys = [key for key, field in counters if field is None]
+        hash_fields = {}
+        for key, field in counters:
+            if field is not None:
+                hash_fields.setdefault(key, []).append(field)
+
+        if not hash_fields:
+            return await self.redis.mget(keys)
+
+        pipeline = self.redis.pipeline(transaction=False)
+        if keys:
+            pipeline.mget(keys)
+        for key, fields in hash_fields.items():
+            pipeline.hmget(key, fields)
+        results = await pipeline.execute()
+
+        key_values = iter(results.pop(0) if keys else [])
+        hash_values = {key: iter(values) for key, values in zip(hash_fields, results)}
+        return [next(key_values) if field is None else next(hash_values[key])
+                for key, field in counters]
+
+    async def add_entries(self, entries, digest=None, versions=None):
+        """
+        Atomically record a batch of entries and increment their counters.
+
+        :param entries: List of `(key, value, counter_key, counter_field)`
+                        tuples. For each entry whose `key` is not already set,
+                        `key` is set to `value` and the counter is incremented.
+                        `counter_field` is `None` for counters stored as plain
+                        keys.
+        :param digest: `(counts_key, sums_key, buckets)` tuple naming the
+                       digest of the counters to update, if any. Entry values
+                       must have the form "{uri}|{scope}". See
+                       `badger.digest`.
+        :param versions: Key prefix of the per-URI version counters to
+                         increment, if any. As with `digest`, entry values
+                         must have the form "{uri}|{scope}".
+        :return: Number of entries which were added
+        """
+        if not entries:
+            return 0
+        keys, args = _change_args(digest, versions)
+        for key, value, counter_key, counter_field in entries:
+            keys += [key, counter_key]
+            args += [value, counter_field or '']
+        return await self._add_entries(keys=keys, args=args)
+
+    async def remove_entries(self, keys, counter_prefix, hashed=False,
+                             digest=None, versions=None):
+        """
+        Atomically delete a batch of entries and decrement their counters.
+
+        :param keys: Keys of the entries to remove
+        :param counter_prefix: Prefix which, combined with an entry's value,
+                               gives the key of the counter to decrement
+        :param hashed: If true, counters are hash fields. An entry's value is
+                       split at its last "|" into the part which is combined
+                       with `counter_prefix` and the field name.
+        :param digest: See `add_entries`
+        :param versions: See `add_entries`
+        :return: List of booleans indicating whether each entry was present
+        """
+        if not keys:
+            return []
+        change_keys, change_args = _change_args(digest, versions)
+        removed = await self._remove_entries(keys=change_keys + keys,
+                                             args=[counter_prefix, int(hashed), *change_args])
+        return [bool(flag) for flag in removed]
+
+    async def move_counters_to_hash(self, moves):
+        """
+        Atomically move a batch of counters from plain keys into hash fields.
+
+        :param moves: List of `(key, hash_key, field)` tuples. The value of
+                      each `key` is added to `field` of `hash_key` and `key` is
+                      deleted.
+        :return: Number of counters which were moved
+        """
+        if not moves:
+            return 0
+        keys = []
+        fields = []
+        for key, hash_key, field in moves:
+            keys += [key, hash_key]
+            fields.append(field)
+        return await self._move_counters(keys=keys, args=fields)
+
+    async def add_interned_entries(self, entries, intern_keys, size_key,
+                                   digest=None, versions=None):
+        """
+        Atomically record a batch of entries in hashes, with interned values.
+
+        This is like `add_entries` except that each entry is a field of a hash
+        and its value is replaced with a small integer ID. Entries with the
+        same value share one ID.
+
+        :param entries: List of `(key, field, value, counter_key,
+                        counter_field)` tuples
+        :param intern_keys: `(ids_key, values_key, next_id_key)` tuple naming
+                            the hashes which map values to IDs and IDs to
+                            values, and the counter used to allocate IDs
+        :param size_key: Counter of the total number of entries
+        :param digest: See `add_entries`
+        :param versions: See `add_entries`
+        :return: Number of entries which were added
+        """
+        if not entries:
+            return 0
+        change_keys, args = _change_args(digest, versions)
+        keys = [*intern_keys, size_key, *change_keys]
+        for key, field, value, counter_key, counter_field in entries:
+            keys += [key, counter_key]
+            args += [field, value, counter_field or '']
+        return await self._add_interned_entries(keys=keys, args=args)
+
+    async def remove_interned_entries(self, entries, intern_keys, size_key,
+                                      counter_prefix, hashed=False, digest=None,
+                                      versions=None):
+        """
+        Atomically delete a batch of entries added by `add_interned_entries`.
+
+        :param entries: List of `(key, field)` tuples
+        :param intern_keys: See `add_interned_entries`
+        :param size_key: See `add_interned_entries`
+        :param counter_prefix: See `remove_entries`
+        :param hashed: See `remove_entries`
+        :param digest: See `add_entries`
+        :param versions: See `add_entries`
+        :return: List of booleans indicating whether each entry was present
+        """
+        if not entries:
+            return []
+        _, values_key, _ = intern_keys
+        change_keys, change_args = _change_args(digest, versions)
+        keys = [values_key, size_key, *change_keys]
+        args = [counter_prefix, int(hashed), *change_args]
+        for key, field in entries:
+            keys.append(key)
+            args.append(field)
+        removed = await self._remove_interned_entries(keys=keys, args=args)
+        return [bool(flag) for flag in removed]
 
-    def inc_counter(self, key):
-        return self.redis.incr(key)
+    async def move_to_interned_entries(self, moves, intern_keys, size_key):
+        """
+        Atomically move a batch of entries from plain keys into hash fields.
 
-    def dec_counter(self, key):
-        return self.redis.decr(key)
+        :param moves: List of `(key, hash_key, field)` tuples. The value of
+                      each `key` is interned and stored in `field` of
+                      `hash_key`, and `key` is deleted.
+        :param intern_keys: See `add_interned_entries`
+        :param size_key: See `add_interned_entries`
+        :return: Number of entries which were moved
+        """
+        if not moves:
+            return 0
+        keys = [*intern_keys, size_key]
+        fields = []
+        for key, hash_key, field in moves:
+            keys += [key, hash_key]
+            fields.append(field)
+        return await self._move_to_interned_entries(keys=keys, args=fields)
 
-    def sum_counters(self, keys):
-        counts = [int(count) for count in self.redis.mget(keys) if count]
-        return sum(counts)
+    async def adjust_counters(self, adjustments, digest=None, versions=None):
+        """
+        Atomically add amounts to a batch of counters.
 
-    def put_dict(self, key, value, expiry=None):
+        :param adjustments: List of `(counter_key, counter_field, value,
+                            amount)` tuples, where `value` is the entry value
+                            associated with the counter
+        :param digest: See `add_entries`
+        :param versions: See `add_entries`
+        """
+        if not adjustments:
+            return
+        keys, args = _change_args(digest, versions)
+        for counter_key, counter_field, value, amount in adjustments:
+            keys.append(counter_key)
+            args += [counter_field or '', value, amount]
+        await self._adjust_counters(keys=keys, args=args)
+
+    async def get_entries(self, keys):
+        """
+        Return the values of entries added by `add_entries`, or `None` for
+        entries which are not present.
+        """
+        if not keys:
+            return []
+        return [None if value is None else tostr(value)
+                for value in await self.redis.mget(keys)]
+
+    async def get_interned_entries(self, entries, intern_keys):
+        """
+        Return the values of entries added by `add_interned_entries`, or
+        `None` for entries which are not present.
+
+        :param entries: List of `(key, field)` tuples
+        :param intern_keys: See `add_interned_entries`
+        """
+        if not entries:
+            return []
+        pipeline = self.redis.pipeline(transaction=False)
+        for key, field in entries:
+            pipeline.hget(key, field)
+        ids = await pipeline.execute()
+
+        _, values_key, _ = intern_keys
+        present = [id_ for id_ in ids if id_ is not None]
+        values = iter(await self.redis.hmget(values_key, present) if present else [])
+        return [None if id_ is None else tostr(next(values)) for id_ in ids]
+
+    async def get_hash(self, key, typ=tostr):
+        """
+        Return the fields of a hash as a dict of field => value.
+        """
+        return {tostr(field): typ(value)
+                for field, value in (await self.redis.hgetall(key)).items()}
+
+    async def get_hash_fields(self, key, fields, typ=tostr):
+        """
+        Return the values of `fields` of a hash, with `None` for missing fields.
+        """
+        if not fields:
+            return []
+        return [None if value is None else typ(value)
+                for value in await self.redis.hmget(key, fields)]
+
+    async def incr_hash_fields(self, key, amounts):
+        """
+        Add amounts to fields of a hash.
+
+        :param amounts: Dict of field => amount
+        """
+        pipeline = self.redis.pipeline(transaction=False)
+        for field, amount in amounts.items():
+            pipeline.hincrby(key, field, amount)
+        await pipeline.execute()
+
+    async def memory_usage(self, key):
+        """
+        Return the number of bytes used to store `key`, or `None`.
+        """
+        return await self.redis.memory_usage(key, samples=0)
+
+    async def hash_length(self, key):
+        return await self.redis.hlen(key)
+
+    async def set_bits(self, key, offsets):
+        """
+        Set the bits at each of `offsets` in the bitmap stored at `key`.
+
+        :return: List of the offsets whose bits were not already set
+        """
+        if not offsets:
+            return []
+        args = []
+        for offset in offsets:
+            args += ['SET', 'u1', offset, 1]
+        old_values = await self.redis.execute_command('BITFIELD', key, *args)
+        return [offset for offset, old in zip(offsets, old_values) if not old]
+
+    async def get_ranges(self, key, ranges):
+        """
+        Read byte ranges of the string stored at `key` using a single request.
+
+        :param ranges: List of `(start, end)` tuples of byte offsets, where
+                       `end` is inclusive as in `GETRANGE`
+        :return: List of the `bytes` in each range
+        """
+        pipeline = self.redis.pipeline(transaction=False)
+        for start, end in ranges:
+            pipeline.getrange(key, start, end)
+        return await pipeline.execute()
+
+    async def append_to_stream(self, key, entries, maxlen=None):
+        """
+        Append entries to a stream.
+
+        :param entries: List of dicts of field => value
+        :param maxlen: Approximate number of entries to trim the stream to
+        :return: List of the IDs of the new entries
+        """
+        pipe = self.redis.pipeline(transaction=False)
+        for fields in entries:
+            pipe.xadd(key, fields, maxlen=maxlen, approximate=True)
+        return [tostr(id_) for id_ in await pipe.execute()]
+
+    async def create_stream_group(self, key, group):
+        """
+        Create a consumer group which reads a stream from its start, if it
+        does not already exist.
+        """
+        try:
+            await self.redis.xgroup_create(key, group, id='0', mkstream=True)
+        except ResponseError as ex:
+            if 'BUSYGROUP' not in str(ex):
+                raise
+
+    async def read_stream_group(self, key, group, consumer, count, block=None):
+        """
+        Read stream entries which have not been delivered to any consumer in
+        `group`.
+
+        :param block: Maximum time in milliseconds to wait for entries
+        :return: List of `(entry ID, {field: value})` tuples
+        """
+        result = await self.redis.xreadgroup(group, consumer, {key: '>'},
+                                             count=count, block=block)
+        if not result:
+            return []
+        [(_, entries)] = result
+        return [_decode_stream_entry(entry) for entry in entries]
+
+    async def claim_stream_entries(self, key, group, consumer, min_idle, count):
+        """
+        Take over entries which were delivered to a consumer in `group` more
+        than `min_idle` milliseconds ago and have not been acknowledged.
+
+        :return: List of `(entry ID, {field: value})` tuples
+        """
+        result = await self.redis.xautoclaim(key, group, consumer, min_idle,
+                                             count=count)
+        return [_decode_stream_entry(entry) for entry in result[1]
+                if entry[1] is not None]
+
+    async def ack_stream_entries(self, key, group, ids):
+        if ids:
+            await self.redis.xack(key, group, *ids)
+
+    async def scan_keys(self, pattern, count=1000, type=None):
+        """
+        Iterate over keys matching `pattern`, optionally of a given `type`.
+        """
+        async for key in self.redis.scan_iter(match=pattern, count=count,
+                                              _type=type):
+            yield tostr(key)
+
+    async def dump_keys(self, keys):
+        """
+        Read the contents of string and hash keys, for copying to another
+        store with `load_keys`.
+
+        :return: List of `(key, value)` tuples, where `value` is `bytes` for a
+                 string or a dict of field => value, as `bytes`, for a hash.
+                 Keys which do not exist or have other types are omitted.
+        """
+        pipeline = self.redis.pipeline(transaction=False)
+        for key in keys:
+            pipeline.type(key)
+        types = [tostr(type_) if isinstance(type_, bytes) else type_
+                 for type_ in await pipeline.execute()]
+
+        present = [(key, type_) for key, type_ in zip(keys, types)
+                   if type_ in ('string', 'hash')]
+        pipeline = self.redis.pipeline(transaction=False)
+        for key, type_ in present:
+            if type_ == 'string':
+                pipeline.get(key)
+            else:
+                pipeline.hgetall(key)
+        return [(key, value) for (key, _), value in zip(present, await pipeline.execute())
+                if value is not None]
+
+    async def load_keys(self, records, max_fields=1000):
+        """
+        Write keys read by `dump_keys`, replacing any existing values, using a
+        pipeline.
+
+        :param records: List of `(key, value)` tuples as returned by
+                        `dump_keys`
+        :param max_fields: Maximum number of hash fields to set with one
+                           command
+        """
+        pipeline = self.redis.pipeline(transaction=False)
+        for key, value in records:
+            if isinstance(value, dict):
+                pipeline.delete(key)
+                fields = list(value.items())
+                for i in range(0, len(fields), max_fields):
+                    pipeline.hset(key, mapping=dict(fields[i:i + max_fields]))
+            else:
+                pipeline.set(key, value)
+        await pipeline.execute()
+
+    async def put_dict(self, key, value, expiry=None):
         if expiry is None:
-            self.redis.set(key, expiry, json.dumps(value))
+            await self.redis.set(key, json.dumps(value))
         else:
-            self.redis.setex(key, expiry, json.dumps(value))
+            await self.redis.setex(key, int(expiry), json.dumps(value))
+
+    async def get_dict(self, key):
+        [value] = await self._read([(key, None)])
+        return json.loads(value or 'null')
+
+    async def put_if_absent(self, key, value, expiry=None):
+        """
+        Set `key` to `value` unless it is already set.
+
+        :return: True if the key was set
+        """
+        return bool(await self.redis.set(key, value, nx=True,
+                                         ex=None if expiry is None else int(expiry)))
 
-    def get_dict(self, key):
-        return json.loads(self.redis.get(key) or 'null')
+    async def add_to_set(self, key, members, expiry=None):
+        """
+        Add members to a set and optionally reset its expiry time.
+        """
+        pipeline = self.redis.pipeline(transaction=False)
+        pipeline.sadd(key, *members)
+        if expiry is not None:
+            pipeline.expire(key, int(expiry))
+        await pipeline.execute()
 
-    def get(self, key, typ=tostr):
-        val = self.redis.get(key)
+    async def pop_set(self, key):
+        """
+        Delete a set and return its members.
+        """
+        members = await self._pop_set(keys=[key])
+        return [tostr(member) for member in members]
+
+    async def get(self, key, typ=tostr):
+        val = await self.redis.get(key)
         if val is None:
             return None
         return typ(val)
 
-    def put(self, key, value):
-        self.redis.set(key, value)
+    async def put(self, key, value):
+        await self.redis.set(key, value)
+
+    async def delete(self, key):
+        await self.redis.delete(key)
+
+
+class ClusterKeyValueStore(KeyValueStore):
+    """
+    Interface to a Redis Cluster used by the annotation count index.
+
+    A command or script which uses several keys is only accepted by a cluster
+    if the keys are in the same slot. The index therefore wraps the URI in the
+    keys of counters and URI versions in a hash tag (see `util.hash_tag`), so
+    that the count for a URI is read from one shard with one request, while
+    annotation records and cached principals are spread across the cluster.
+
+    An entry's record and its counter are in different slots, so adding and
+    removing entries is not atomic as it is with `KeyValueStore`. Records are
+    written first and counters are then updated atomically per slot, followed
+    by the digest. An interrupted batch can leave counters which disagree with
+    the records, which `AnnotationCountIndex.reconcile` corrects.
+
+    Compact annotation records (the "registry" layout) are not supported,
+    since the intern table is shared by every entry.
+    """
+
+    cluster = True
 
-    def delete(self, key):
-        self.redis.delete(key)
+    def __init__(self, redis_host, redis_port, max_connections=50,
+                 timeout=5.0, batch_window=None, batch_max_keys=1000):
+        """
+        :param redis_host: Hostname of any node of the cluster
+        :param redis_port: Port of the node
+        :param max_connections: Maximum number of connections to each node
+        :param timeout: Timeout in seconds for connecting to Redis and for
+                        individual commands
+        :param batch_window: See `KeyValueStore`
+        :param batch_max_keys: See `KeyValueStore`
+        """
+        self.redis = RedisCluster(host=redis_host, port=redis_port,
+                                  max_connections=max_connections,
+                                  socket_timeout=timeout,
+                                  socket_connect_timeout=timeout)
+        self._move_counters = self.redis.register_script(_MOVE_COUNTERS_SCRIPT)
+        self._cluster_adjust_counters = self.redis.register_script(
+            _CLUSTER_ADJUST_COUNTERS_SCRIPT)
+        self._pop_set = self.redis.register_script(_POP_SET_SCRIPT)
+        self._coalescer = (ReadCoalescer(self._get_counters, batch_window, batch_max_keys)
+                           if batch_window else None)
+
+    async def _get_counters(self, counters):
+        """
+        Fetch the values of `counters` with one `MGET` or `HMGET` per slot,
+        sent together in a pipeline.
+        """
+        slot_keys = {}
+        hash_fields = {}
+        for key, field in counters:
+            if field is None:
+                slot_keys.setdefault(key_slot(key.encode()), set()).add(key)
+            else:
+                hash_fields.setdefault(key, set()).add(field)
+
+        pipeline = self.redis.pipeline()
+        key_groups = [list(keys) for keys in slot_keys.values()]
+        field_groups = [(key, list(fields)) for key, fields in hash_fields.items()]
+        for keys in key_groups:
+            pipeline.mget(keys)
+        for key, fields in field_groups:
+            pipeline.hmget(key, fields)
+        results = iter(await pipeline.execute())
+
+        values = {}
+        for keys in key_groups:
+            values.update(((key, None), value) for key, value in zip(keys, next(results)))
+        for key, fields in field_groups:
+            values.update(((key, field), value) for field, value in zip(fields, next(results)))
+        return [values[counter] for counter in counters]
+
+    async def add_entries(self, entries, digest=None, versions=None):
+        if not entries:
+            return 0
+        pipeline = self.redis.pipeline()
+        for key, value, _, _ in entries:
+            pipeline.set(key, value, nx=True)
+        added = [(counter_key, counter_field, value, 1)
+                 for (_, value, counter_key, counter_field), is_new
+                 in zip(entries, await pipeline.execute()) if is_new]
+        await self.adjust_counters(added, digest=digest, versions=versions)
+        return len(added)
+
+    async def remove_entries(self, keys, counter_prefix, hashed=False,
+                             digest=None, versions=None):
+        if not keys:
+            return []
+        pipeline = self.redis.pipeline()
+        for key in keys:
+            pipeline.getdel(key)
+        values = [None if value is None else tostr(value)
+                  for value in await pipeline.execute()]
+        removed = [(*_tagged_counter(counter_prefix, value, hashed), value, -1)
+                   for value in values if value is not None]
+        await self.adjust_counters(removed, digest=digest, versions=versions)
+        return [value is not None for value in values]
+
+    async def adjust_counters(self, adjustments, digest=None, versions=None):
+        if not adjustments:
+            return
+        slot_args = {}
+        for counter_key, counter_field, value, amount in adjustments:
+            uri, _ = value.rsplit('|', 1)
+            version_key = versions + hash_tag(uri) if versions else counter_key
+            keys, args = slot_args.setdefault(key_slot(counter_key.encode()), ([], []))
+            keys += [counter_key, version_key]
+            args += [counter_field or '', amount]
+        await gather(*[self._cluster_adjust_counters(keys=keys,
+                                                     args=[int(bool(versions)), *args])
+                       for keys, args in slot_args.values()])
+
+        if digest is not None:
+            counts_key, sums_key, buckets = digest
+            counts, sums = digest_changes(
+                [(value, amount) for _, _, value, amount in adjustments], buckets)
+            await self.incr_hash_fields(counts_key, counts)
+            await self.incr_hash_fields(sums_key, sums)
+
+    async def move_counters_to_hash(self, moves):
+        # The source and destination of each move share a hash tag, so each
+        # slot's moves can be applied by one script.
+        slot_moves = {}
+        for move in moves:
+            slot_moves.setdefault(key_slot(move[0].encode()), []).append(move)
+        moved = await gather(*[KeyValueStore.move_counters_to_hash(self, group)
+                               for group in slot_moves.values()])
+        return sum(moved)
+
+    async def get_entries(self, keys):
+        if not keys:
+            return []
+        return [None if value is None else tostr(value)
+                for value in await self.redis.mget_nonatomic(keys)]
+
+
+def _tagged_counter(counter_prefix, value, hashed):
+    """
+    Return the `(key, field)` of the counter of an entry value in a cluster.
+
+    This matches `index.counter_for` with `tagged=True`.
+    """
+    uri, scope = value.rsplit('|', 1)
+    if hashed:
+        return (counter_prefix + hash_tag(uri), scope)
+    return (f'{counter_prefix}{hash_tag(uri)}|{scope}', None)
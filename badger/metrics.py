@@ -0,0 +1,194 @@
+"""
+In-process metrics, exposed in the Prometheus text format.
+
+Metrics are plain Python objects which are updated in place, so recording a
+measurement costs a dict lookup and an addition. Values which are already
+tracked elsewhere, such as the hit count of the principals cache, are read
+when the metrics are rendered using `Registry.add_callback`.
+"""
+
+from bisect import bisect_left
+from contextlib import contextmanager
+from time import perf_counter
+
+# Default histogram buckets, in seconds.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [*zip(names, values), *extra]
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        # Map of label values => value.
+        self._values = {}
+
+    def samples(self):
+        """
+        Return `(name, labels, value)` tuples for the current values.
+        """
+        for label_values, value in sorted(self._values.items()):
+            yield (self.name, _format_labels(self.label_names, label_values), value)
+
+
+class Counter(_Metric):
+    """
+    A value which only increases, such as a number of requests.
+    """
+
+    type = 'counter'
+
+    def inc(self, *label_values, amount=1):
+        self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def value(self, *label_values):
+        return self._values.get(label_values, 0)
+
+
+class Gauge(_Metric):
+    """
+    A value which can go up and down, such as a queue length.
+    """
+
+    type = 'gauge'
+
+    def set(self, value, *label_values):
+        self._values[label_values] = value
+
+    def value(self, *label_values):
+        return self._values.get(label_values)
+
+
+class Histogram(_Metric):
+    """
+    A distribution of observed values, such as request latencies.
+    """
+
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *label_values):
+        entry = self._values.get(label_values)
+        if entry is None:
+            # Per-bucket (not cumulative) counts, then the sum of values.
+            entry = self._values[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+        entry[bisect_left(self.buckets, value)] += 1
+        entry[-1] += value
+
+    @contextmanager
+    def time(self, *label_values):
+        """
+        Observe the time taken by the body of a `with` block.
+        """
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(perf_counter() - start, *label_values)
+
+    def count(self, *label_values):
+        entry = self._values.get(label_values)
+        return sum(entry[:-1]) if entry else 0
+
+    def samples(self):
+        for label_values, entry in sorted(self._values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), entry):
+                cumulative += count
+                labels = _format_labels(self.label_names, label_values,
+                                        [('le', _format_value(bound))])
+                yield (f'{self.name}_bucket', labels, cumulative)
+            labels = _format_labels(self.label_names, label_values)
+            yield (f'{self.name}_count', labels, cumulative)
+            yield (f'{self.name}_sum', labels, entry[-1])
+
+
+class _Callback:
+    def __init__(self, name, help, type, func):
+        self.name = name
+        self.help = help
+        self.type = type
+        self._func = func
+
+    def samples(self):
+        value = self._func()
+        if value is not None:
+            yield (self.name, '', value)
+
+
+class Registry:
+    """
+    A collection of metrics which are rendered together.
+    """
+
+    def __init__(self):
+        # Map of name => metric, in registration order.
+        self._metrics = {}
+
+    def _register(self, metric):
+        existing = self._metrics.get(metric.name)
+        if existing is not None:
+            if type(existing) is not type(metric):
+                raise ValueError(f'metric "{metric.name}" is already registered')
+            return existing
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self._register(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels=()):
+        return self._register(Gauge(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self._register(Histogram(name, help, labels, buckets))
+
+    def add_callback(self, name, help, func, type='gauge'):
+        """
+        Add a metric whose value is read by calling `func()` on each render.
+
+        Replaces any existing callback with the same name, so that the metric
+        follows the most recently created object which it reports on.
+        """
+        self._metrics[name] = _Callback(name, help, type, func)
+
+    def render(self):
+        """
+        Return all metrics in the Prometheus text exposition format.
+        """
+        lines = []
+        for metric in self._metrics.values():
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            for name, labels, value in metric.samples():
+                lines.append(f'{name}{labels} {_format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+# Registry used by the web server and indexer.
+REGISTRY = Registry()
@@ -0,0 +1,105 @@
+from asyncio import ensure_future, shield
+from collections import OrderedDict
+from time import monotonic
+
+
+class PrincipalsCache:
+    """
+    In-process cache of the principals (profile + groups) for access tokens.
+
+    This sits in front of the "profile|{token}" entries in the key-value store.
+    It holds up to `maxsize` entries, evicting the least recently used, and
+    each entry expires `ttl` seconds after it was added.
+
+    Concurrent lookups of the same token which miss the cache are coalesced so
+    that only one of them fetches the principals and the others wait for its
+    result.
+    """
+
+    def __init__(self, maxsize=10000, ttl=10.0, clock=monotonic):
+        """
+        :param maxsize: Maximum number of entries to hold
+        :param ttl: Number of seconds after which an entry expires
+        :param clock: Function returning the current time in seconds
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._clock = clock
+
+        # Map of token => (principals, expiry time), in LRU order.
+        self._entries = OrderedDict()
+
+        # Map of token => Future for lookups that are in progress.
+        self._in_flight = {}
+
+        # Number of lookups served from the cache.
+        self.hits = 0
+        # Number of lookups which fetched the principals.
+        self.misses = 0
+        # Number of lookups which waited for another lookup's fetch.
+        self.coalesced = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, token):
+        """
+        Return the cached principals for `token` or `None`.
+        """
+        entry = self._entries.get(token)
+        if entry is None:
+            return None
+
+        principals, expires = entry
+        if expires <= self._clock():
+            del self._entries[token]
+            return None
+
+        self._entries.move_to_end(token)
+        return principals
+
+    def put(self, token, principals):
+        self._entries[token] = (principals, self._clock() + self.ttl)
+        self._entries.move_to_end(token)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, token):
+        self._entries.pop(token, None)
+
+    def invalidate_user(self, userid):
+        """
+        Remove the entries for all tokens belonging to `userid`.
+        """
+        tokens = [token for token, (principals, _) in self._entries.items()
+                  if principals['profile'].get('userid') == userid]
+        for token in tokens:
+            del self._entries[token]
+
+    async def get_or_fetch(self, token, fetch):
+        """
+        Return the principals for `token`, calling `fetch()` on a cache miss.
+
+        :param fetch: Coroutine function which returns the principals for
+                      `token`
+        """
+        principals = self.get(token)
+        if principals is not None:
+            self.hits += 1
+            return principals
+
+        pending = self._in_flight.get(token)
+        if pending is not None:
+            self.coalesced += 1
+            return await shield(pending)
+
+        self.misses += 1
+        pending = ensure_future(fetch())
+        self._in_flight[token] = pending
+        pending.add_done_callback(lambda future: self._fetched(token, future))
+        return await shield(pending)
+
+    def _fetched(self, token, future):
+        del self._in_flight[token]
+        if not future.cancelled() and future.exception() is None:
+            self.put(token, future.result())
@@ -0,0 +1,86 @@
+"""
+Sampling profiler which can be switched on in a running process.
+"""
+
+from asyncio import sleep
+from collections import Counter
+import sys
+from threading import Event, Thread, get_ident
+
+
+class SamplingProfiler:
+    """
+    Periodically sample the call stack of one thread.
+
+    Samples are taken from a background thread, so the profiled thread is not
+    instrumented and runs at full speed except for the brief pauses while the
+    sampler holds the GIL. Results are returned in the "folded stacks" format
+    used by flame graph tools (`frame;frame;frame count` per line).
+    """
+
+    def __init__(self, interval=0.005, thread_id=None):
+        """
+        :param interval: Time in seconds between samples
+        :param thread_id: ID of the thread to sample. Defaults to the thread
+                          which creates the profiler.
+        """
+        self.interval = interval
+        self.thread_id = thread_id or get_ident()
+        self._stacks = Counter()
+        self._stopped = Event()
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self):
+        if self.running:
+            raise Exception('profiler is already running')
+        self._stacks.clear()
+        self._stopped.clear()
+        self._thread = Thread(target=self._run, name='badger-profiler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop sampling and return the folded stacks which were collected.
+        """
+        if not self.running:
+            return ''
+        self._stopped.set()
+        self._thread.join()
+        self._thread = None
+        return self.folded_stacks()
+
+    def folded_stacks(self):
+        return ''.join(f'{stack} {count}\n'
+                       for stack, count in self._stacks.most_common())
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{code.co_name} ({code.co_filename}:{code.co_firstlineno})')
+                frame = frame.f_back
+            self._stacks[';'.join(reversed(stack))] += 1
+
+
+async def profile(seconds, interval=0.005):
+    """
+    Sample the current thread for `seconds` and return the folded stacks.
+
+    The calling coroutine sleeps while samples are taken, so this profiles
+    whatever else the event loop is running in the meantime.
+    """
+    profiler = SamplingProfiler(interval)
+    profiler.start()
+    try:
+        await sleep(seconds)
+    finally:
+        stacks = profiler.stop()
+    return stacks
@@ -0,0 +1,103 @@
+"""
+Scheduling of the indexer's work and of its requests to Elasticsearch.
+"""
+
+from asyncio import sleep
+from time import monotonic
+
+from .metrics import REGISTRY
+from .util import get_logger
+
+logger = get_logger(__name__)
+
+IDLE_DELAY = REGISTRY.gauge(
+    'badger_indexer_idle_delay_seconds',
+    'Time the indexer waits before its next pass')
+
+
+class AdaptiveScheduler:
+    """
+    Run a task repeatedly, back to back while it finds work to do and with an
+    exponentially increasing delay while it does not.
+    """
+
+    def __init__(self, min_delay=1.0, max_delay=60.0, factor=2.0,
+                 retry_delay=5.0):
+        """
+        :param min_delay: Delay in seconds after the first pass which finds no
+                          work
+        :param max_delay: Maximum delay in seconds between passes
+        :param factor: Factor by which the delay grows after each idle pass
+        :param retry_delay: Delay in seconds after a pass which fails
+        """
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.factor = factor
+        self.retry_delay = retry_delay
+        self.delay = 0.0
+
+    def next_delay(self, work_done):
+        """
+        Update and return the delay before the next pass.
+
+        :param work_done: Whether the last pass found anything to do
+        """
+        if work_done:
+            self.delay = 0.0
+        else:
+            self.delay = min(max(self.delay * self.factor, self.min_delay),
+                             self.max_delay)
+        IDLE_DELAY.set(self.delay)
+        return self.delay
+
+    async def run(self, task):
+        """
+        Run `task` until cancelled.
+
+        :param task: Coroutine function which returns a truthy value if it
+                     found work to do
+        """
+        while True:
+            try:
+                delay = self.next_delay(await task())
+            except Exception as ex:
+                logger.warning(f'indexer pass failed: {ex}')
+                delay = max(self.retry_delay, self.delay)
+            if delay:
+                await sleep(delay)
+
+
+class RateLimiter:
+    """
+    Token bucket which limits the rate of an operation.
+    """
+
+    def __init__(self, rate, burst=1, clock=monotonic):
+        """
+        :param rate: Maximum average number of operations per second, or
+                     `None` for no limit
+        :param burst: Number of operations which may happen back to back after
+                      a quiet period
+        :param clock: Function returning the current time in seconds
+        """
+        self.rate = rate
+        self.burst = burst
+        self._clock = clock
+        self._tokens = burst
+        self._updated = clock()
+
+    async def acquire(self):
+        """
+        Wait until the operation may go ahead.
+        """
+        if not self.rate:
+            return
+        while True:
+            now = self._clock()
+            self._tokens = min(self.burst,
+                               self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await sleep((1 - self._tokens) / self.rate)
@@ -0,0 +1,236 @@
+"""
+Snapshots of the index, for seeding a new key-value store without re-indexing
+every annotation.
+
+A snapshot file consists of:
+
+ - `MAGIC`, followed by a header frame holding a JSON object which describes
+   the index, including the indexer's position when the export started.
+ - Frames of records, each a zlib-compressed run of string and hash keys.
+ - An empty frame, which marks the end of the snapshot so that a truncated
+   file is detected.
+
+Each frame starts with the length of its compressed data and the number of
+records it contains, as big-endian unsigned 32-bit integers. A record is a
+type byte (`s` for a string, `h` for a hash) followed by the key and either
+the value or the number of fields and each field and value. Keys, values and
+fields are each preceded by their length.
+
+Snapshots only depend on the operations of `KeyValueStore`, so a snapshot of
+an index in Redis can also be loaded into an `EmbeddedKeyValueStore` and vice
+versa.
+"""
+
+from datetime import datetime, timezone
+import json
+import struct
+import zlib
+
+from .index import LAST_INDEXED_KEY
+
+MAGIC = b'BADGER-SNAPSHOT\x01'
+
+# Patterns matching the keys which make up the index. Cached principals,
+# events and backfill progress are not included.
+SNAPSHOT_PATTERNS = ('count|*', 'ann|*', 'annreg|*', 'scope|*', 'version|*',
+                     'digest|*', 'filter|*')
+
+_FRAME_HEADER = struct.Struct('>II')
+_LENGTH = struct.Struct('>I')
+
+
+def _encode_bytes(out, data):
+    out += _LENGTH.pack(len(data))
+    out += data
+
+
+def encode_records(records):
+    """
+    Encode a list of `(key, value)` records, as returned by
+    `KeyValueStore.dump_keys`.
+    """
+    out = bytearray()
+    for key, value in records:
+        if isinstance(value, dict):
+            out += b'h'
+            _encode_bytes(out, key.encode())
+            out += _LENGTH.pack(len(value))
+            for field, field_value in value.items():
+                _encode_bytes(out, field)
+                _encode_bytes(out, field_value)
+        else:
+            out += b's'
+            _encode_bytes(out, key.encode())
+            _encode_bytes(out, value)
+    return bytes(out)
+
+
+def decode_records(data, count):
+    """
+    Decode `count` records encoded by `encode_records`.
+    """
+    view = memoryview(data)
+    pos = 0
+
+    def read_bytes():
+        nonlocal pos
+        [length] = _LENGTH.unpack_from(view, pos)
+        start = pos + _LENGTH.size
+        pos = start + length
+        return bytes(view[start:pos])
+
+    records = []
+    for _ in range(count):
+        type_ = view[pos:pos + 1].tobytes()
+        pos += 1
+        key = read_bytes().decode()
+        if type_ == b'h':
+            [length] = _LENGTH.unpack_from(view, pos)
+            pos += _LENGTH.size
+            value = {}
+            for _ in range(length):
+                field = read_bytes()
+                value[field] = read_bytes()
+        elif type_ == b's':
+            value = read_bytes()
+        else:
+            raise ValueError(f'unknown snapshot record type {type_!r}')
+        records.append((key, value))
+    return records
+
+
+def _write_frame(file, data, count, level=6):
+    compressed = zlib.compress(data, level) if data else b''
+    file.write(_FRAME_HEADER.pack(len(compressed), count))
+    file.write(compressed)
+    return len(compressed)
+
+
+def _read_frame(file):
+    header = file.read(_FRAME_HEADER.size)
+    if len(header) < _FRAME_HEADER.size:
+        raise ValueError('snapshot is truncated')
+    length, count = _FRAME_HEADER.unpack(header)
+    compressed = file.read(length)
+    if len(compressed) < length:
+        raise ValueError('snapshot is truncated')
+    return (zlib.decompress(compressed) if length else b''), count
+
+
+async def export_snapshot(index, path, batch_size=1000, frame_size=1024 * 1024,
+                          on_progress=None):
+    """
+    Write a snapshot of the index to a file.
+
+    Keys are read with `SCAN`, so a snapshot taken while the indexer is
+    running is not a consistent copy. The indexer's position is read before
+    any keys, so that annotations indexed during the export are indexed again
+    after an import, but their counters may be counted twice or not at all.
+    Stop the indexer during the export, or run `reconcile` after importing.
+
+    :param index: The `AnnotationCountIndex` to export
+    :param path: Path of the file to write
+    :param batch_size: Number of keys to read at once
+    :param frame_size: Approximate uncompressed size in bytes of each frame
+    :param on_progress: Callback invoked with the number of keys exported so
+                        far after each frame is written
+    :return: Number of keys exported
+    """
+    kv_store = index.kv_store
+    header = {'created': datetime.now(timezone.utc).isoformat(),
+              'last_indexed_date': await kv_store.get(LAST_INDEXED_KEY),
+              'counter_layout': index.counter_layout,
+              'ann_layout': index.ann_layout,
+              'tagged': index.tagged}
+    exported = 0
+
+    with open(path, 'wb') as file:
+        file.write(MAGIC)
+        _write_frame(file, json.dumps(header).encode(), 0)
+
+        frame = bytearray()
+        frame_count = 0
+
+        async def export_keys(keys):
+            nonlocal frame, frame_count, exported
+            records = await kv_store.dump_keys(keys)
+            frame += encode_records(records)
+            frame_count += len(records)
+            if len(frame) >= frame_size:
+                _write_frame(file, frame, frame_count)
+                exported += frame_count
+                frame = bytearray()
+                frame_count = 0
+                if on_progress:
+                    on_progress(exported)
+
+        for pattern in SNAPSHOT_PATTERNS:
+            keys = []
+            async for key in kv_store.scan_keys(pattern, count=batch_size):
+                keys.append(key)
+                if len(keys) >= batch_size:
+                    await export_keys(keys)
+                    keys = []
+            if keys:
+                await export_keys(keys)
+
+        if frame_count:
+            _write_frame(file, frame, frame_count)
+            exported += frame_count
+        # Mark the end of the snapshot.
+        _write_frame(file, b'', 0)
+
+    return exported
+
+
+def read_snapshot_header(file):
+    """
+    Read the header of a snapshot from the start of `file`.
+    """
+    if file.read(len(MAGIC)) != MAGIC:
+        raise ValueError('not a badger snapshot')
+    data, _ = _read_frame(file)
+    return json.loads(data.decode())
+
+
+async def import_snapshot(index, path, batch_size=1000, on_progress=None):
+    """
+    Load a snapshot written by `export_snapshot` into the index.
+
+    Existing keys which are also in the snapshot are replaced. The indexer's
+    position is written last, so if an import is interrupted, running it again
+    completes it.
+
+    :param index: The `AnnotationCountIndex` to load the snapshot into. Its
+                  counter and annotation layouts must match the snapshot's.
+    :param path: Path of the snapshot file
+    :param batch_size: Number of keys to write with one pipeline
+    :param on_progress: Callback invoked with the number of keys imported so
+                        far after each frame is loaded
+    :return: The snapshot's header
+    """
+    kv_store = index.kv_store
+    imported = 0
+
+    with open(path, 'rb') as file:
+        header = read_snapshot_header(file)
+        for setting in ('counter_layout', 'ann_layout', 'tagged'):
+            if header[setting] != getattr(index, setting):
+                raise ValueError(f'snapshot has {setting} {header[setting]!r} but the '
+                                 f'index has {getattr(index, setting)!r}')
+
+        while True:
+            data, count = _read_frame(file)
+            if not data:
+                break
+            records = decode_records(data, count)
+            for i in range(0, len(records), batch_size):
+                await kv_store.load_keys(records[i:i + batch_size])
+            imported += count
+            if on_progress:
+                on_progress(imported)
+
+    if header['last_indexed_date'] is not None:
+        await kv_store.put(LAST_INDEXED_KEY, header['last_indexed_date'])
+    header['keys'] = imported
+    return header
@@ -0,0 +1,200 @@
+from hashlib import blake2b
+
+from .util import get_logger
+
+logger = get_logger(__name__)
+
+
+class URIFilter:
+    """
+    Bloom filter of the normalized URIs which have ever been annotated.
+
+    The indexer adds URIs to a bitmap in the key-value store. Web server
+    processes keep a copy of the bitmap in memory, refreshed periodically, and
+    use it to answer "definitely zero" for URIs which have never been
+    annotated without any I/O.
+
+    Being a Bloom filter, a URI which has never been annotated may be reported
+    as possibly annotated, but never the reverse. A filter which was created
+    for an index that already contained annotations is not used until it has
+    been marked as complete, after the URIs of the existing annotations have
+    been added.
+    """
+
+    BITMAP_KEY = 'filter|uris'
+
+    # Counter which is incremented whenever the bitmap changes.
+    VERSION_KEY = 'filter|uris|version'
+
+    # Hash of chunk number => counter which is incremented whenever bits are
+    # set in that chunk of the bitmap, so that copies can be refreshed by
+    # reading only the chunks which changed.
+    CHUNKS_KEY = 'filter|uris|chunks'
+
+    # Size in bytes of the chunks which are versioned and refreshed separately.
+    CHUNK_SIZE = 2**14
+
+    # Size and number of hash functions used to create the bitmap.
+    PARAMS_KEY = 'filter|uris|params'
+
+    def __init__(self, kv_store, bits=2**27, hashes=7):
+        """
+        :param kv_store: Key-value store holding the filter
+        :param bits: Size of the bitmap in bits, if creating a new filter
+        :param hashes: Number of hash functions, if creating a new filter
+        """
+        self.kv_store = kv_store
+        self.bits = bits
+        self.hashes = hashes
+
+        self.complete = False
+        self._params_loaded = False
+
+        # In-memory copy of the bitmap and the versions it corresponds to.
+        self._bitmap = None
+        self._version = None
+        self._chunk_versions = {}
+
+    @property
+    def loaded(self):
+        return self._bitmap is not None
+
+    def might_contain(self, uri):
+        """
+        Return `False` if `uri` has definitely never been annotated.
+
+        If the filter has not been loaded, this always returns `True`.
+        """
+        bitmap = self._bitmap
+        if bitmap is None:
+            return True
+
+        for offset in self._offsets(uri):
+            byte = offset >> 3
+            if byte >= len(bitmap) or not bitmap[byte] & (0x80 >> (offset & 7)):
+                return False
+        return True
+
+    async def create(self, complete):
+        """
+        Create the filter in the key-value store if it does not exist.
+
+        :param complete: Whether the filter will contain every annotated URI
+                         once the caller starts adding URIs to it. This should
+                         only be true if the index is empty.
+        """
+        await self._load_params(complete)
+
+    async def mark_complete(self):
+        """
+        Record that every annotated URI has been added to the filter.
+        """
+        await self._load_params()
+        self.complete = True
+        await self._save_params()
+        await self.kv_store.inc_counter(self.VERSION_KEY)
+
+    async def add(self, uris):
+        """
+        Add normalized URIs to the filter in the key-value store.
+        """
+        if not uris:
+            return
+        await self._load_params()
+        offsets = set()
+        for uri in uris:
+            offsets.update(self._offsets(uri))
+        added = await self.kv_store.set_bits(self.BITMAP_KEY, sorted(offsets))
+        if not added:
+            # Every URI was already in the filter, so copies are up to date.
+            return
+        chunks = {offset // (self.CHUNK_SIZE * 8) for offset in added}
+        await self.kv_store.incr_hash_fields(self.CHUNKS_KEY,
+                                             {str(chunk): 1 for chunk in chunks})
+        await self.kv_store.inc_counter(self.VERSION_KEY)
+
+    async def refresh(self):
+        """
+        Update the in-memory copy of the filter if it has changed.
+
+        Only the chunks of the bitmap whose version has changed are read,
+        unless there is no copy yet or the filter may have been rebuilt. The
+        copy and the versions it corresponds to are only updated once every
+        read has succeeded, so a refresh which fails is retried in full by the
+        next one.
+        """
+        version = await self.kv_store.get(self.VERSION_KEY)
+        if version is None or version == self._version:
+            return
+
+        # Re-read the parameters in case the filter was rebuilt.
+        params = await self.kv_store.get_dict(self.PARAMS_KEY)
+        if not params or not params['complete']:
+            logger.warning('URI filter is incomplete, run "build-uri-filter" to enable it')
+            bitmap = None
+            chunk_versions = {}
+        else:
+            # Read the chunk versions before the bitmap, so that the copy is
+            # never older than the versions recorded for it.
+            chunk_versions = await self.kv_store.get_hash(self.CHUNKS_KEY, typ=int)
+            changed = sorted(int(chunk) for chunk, chunk_version in chunk_versions.items()
+                             if chunk_version != self._chunk_versions.get(chunk))
+            rebuilt = any(chunk_version < self._chunk_versions.get(chunk, 0)
+                          for chunk, chunk_version in chunk_versions.items())
+
+            if (self._bitmap is None or not chunk_versions or rebuilt or
+                    (params['bits'], params['hashes']) != (self.bits, self.hashes)):
+                # Filters written before chunks were versioned have no chunk
+                # versions, so they are always read in full.
+                bitmap = bytearray(await self.kv_store.get(self.BITMAP_KEY, typ=bytes) or b'')
+                logger.info(f'loaded URI filter version {version} ({len(bitmap)} bytes)')
+            else:
+                bitmap = self._bitmap
+                if changed:
+                    ranges = [(chunk * self.CHUNK_SIZE, (chunk + 1) * self.CHUNK_SIZE - 1)
+                              for chunk in changed]
+                    chunks = await self.kv_store.get_ranges(self.BITMAP_KEY, ranges)
+                    # Bits are only ever set, so updating the copy in place is
+                    # safe while lookups are using it.
+                    for (start, _), data in zip(ranges, chunks):
+                        if len(bitmap) < start + len(data):
+                            bitmap.extend(bytes(start + len(data) - len(bitmap)))
+                        bitmap[start:start + len(data)] = data
+                    logger.info(f'loaded URI filter version {version} '
+                                f'({len(changed)} changed chunks)')
+
+        # Nothing is awaited from here on, so lookups never see a copy which
+        # does not match the parameters and versions.
+        if params:
+            self.bits = params['bits']
+            self.hashes = params['hashes']
+            self.complete = params['complete']
+            self._params_loaded = True
+        self._bitmap = bitmap
+        self._chunk_versions = chunk_versions
+        self._version = version
+
+    async def _load_params(self, complete=False):
+        if self._params_loaded:
+            return
+
+        params = await self.kv_store.get_dict(self.PARAMS_KEY)
+        if params:
+            self.bits = params['bits']
+            self.hashes = params['hashes']
+            self.complete = params['complete']
+        else:
+            self.complete = complete
+            await self._save_params()
+        self._params_loaded = True
+
+    async def _save_params(self):
+        await self.kv_store.put_dict(self.PARAMS_KEY, {'bits': self.bits,
+                                                       'hashes': self.hashes,
+                                                       'complete': self.complete})
+
+    def _offsets(self, uri):
+        digest = blake2b(uri.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'big')
+        h2 = int.from_bytes(digest[8:], 'big') | 1
+        return [(h1 + i * h2) % self.bits for i in range(self.hashes)]
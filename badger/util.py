@@ -22,6 +22,16 @@ def optional_env(name, typ, default):
         return typ(val)
 
 
+def parse_flag(val):
+    """
+    Parse a boolean flag from an environment variable, eg. "1" or "false".
+
+    `bool` cannot be used as the type for `optional_env` since any non-empty
+    string, including "0", is true.
+    """
+    return val.strip().lower() in ('1', 'true', 'yes')
+
+
 def error_response(msg, status=400):
     return json({'error': msg}, status=status)
 
@@ -33,6 +43,14 @@ def username_from_userid(userid):
     return m.group(1)
 
 
+def hash_tag(s):
+    """
+    Wrap `s` in a Redis Cluster hash tag, so that all keys containing the same
+    tag are stored in the same slot.
+    """
+    return '{' + s + '}'
+
+
 # Map of (module path => Logger)
 loggers = {}
 
@@ -61,4 +79,4 @@ def get_logger(name):
 
 def run_async_task(coro):
     loop = asyncio.get_event_loop()
-    loop.run_until_complete(coro)
+    return loop.run_until_complete(coro)
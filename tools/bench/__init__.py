@@ -0,0 +1,7 @@
+"""
+Benchmarks for the badger web service and indexer.
+
+These run against local stand-ins for h and Elasticsearch, serving a synthetic
+corpus of annotations, and a real Redis server. See `python -m tools.bench
+--help`.
+"""
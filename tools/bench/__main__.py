@@ -0,0 +1,358 @@
+"""
+Run badger benchmarks against local stand-ins for h and Elasticsearch.
+
+A real Redis server is required. Its location is configured using the same
+environment variables as badger itself, and the benchmarks use (and empty)
+the Redis database selected by `--redis-db`.
+
+Usage:
+
+    python -m tools.bench count --output results.json
+    python -m tools.bench lookup --output results.json
+    python -m tools.bench index --output results.json
+    python -m tools.bench decode --output results.json
+    python -m tools.bench all --output results.json
+
+Results are written as JSON so that runs can be compared between releases.
+"""
+
+from asyncio import get_event_loop, sleep
+from datetime import datetime, timezone
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+from time import perf_counter
+import tracemalloc
+
+import aiohttp
+import click
+
+from .corpus import Corpus
+from .driver import drive_count
+from .fakes import FakeServices
+from .stats import latency_summary, rate_summary
+
+# Settings which affect results and are recorded with them.
+RECORDED_SETTINGS = ['COUNTER_LAYOUT', 'ANN_LAYOUT', 'REDIS_HOST', 'REDIS_PORT',
+                     'REDIS_MAX_CONNECTIONS', 'REDIS_BATCH_WINDOW',
+                     'REDIS_BATCH_MAX_KEYS', 'PRINCIPALS_CACHE_SIZE',
+                     'PRINCIPALS_CACHE_TTL', 'URI_FILTER_BITS', 'ES_BATCH_SIZE']
+
+
+def _run(coro):
+    return get_event_loop().run_until_complete(coro)
+
+
+def _configure_env(services, redis_db):
+    """
+    Point badger at the fake services and the benchmark Redis database.
+    """
+    os.environ['H_API_URL'] = services.h_api_url
+    os.environ['ELASTICSEARCH_URL'] = services.es_url
+    os.environ['FETCH_FROM_ELASTICSEARCH'] = '1'
+    os.environ['ES_MAX_REQUEST_RATE'] = '0'
+    os.environ['REDIS_DB'] = str(redis_db)
+
+
+def _get_index():
+    # Imported here so that the environment is configured first.
+    from badger.app import _get_index
+    return _get_index()
+
+
+async def _reset(index):
+    await index.kv_store.redis.flushdb()
+
+
+async def _redis_commands(index):
+    """
+    Return the number of commands the Redis server has processed.
+    """
+    stats = await index.kv_store.redis.info('stats')
+    return stats['total_commands_processed']
+
+
+async def bench_index(corpus, workers):
+    """
+    Measure indexing throughput of each indexing path.
+    """
+    from badger.index_fetcher import Annotation
+    from badger.ingest import ingest_file
+
+    results = {}
+    index = _get_index()
+    anns = [Annotation.from_api_ann(corpus.api_annotation(ann))
+            for ann in corpus.annotations]
+
+    await _reset(index)
+    start = perf_counter()
+    await index.index_annotations(anns)
+    results['index_annotations'] = rate_summary(len(anns), perf_counter() - start)
+
+    # Indexing annotations which are already indexed, as happens when the
+    # indexer resumes.
+    start = perf_counter()
+    await index.index_annotations(anns)
+    results['index_annotations_duplicates'] = rate_summary(len(anns),
+                                                           perf_counter() - start)
+
+    await _reset(index)
+    start = perf_counter()
+    await index.incremental_index()
+    results['incremental_index'] = rate_summary(len(anns), perf_counter() - start)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for compress in (False, True):
+            path = os.path.join(tmpdir, 'dump.ndjson' + ('.gz' if compress else ''))
+            corpus.write_dump(path, compress=compress)
+            await _reset(index)
+            start = perf_counter()
+            count = await ingest_file(index, path, workers=workers)
+            name = 'index_from_file_gzip' if compress else 'index_from_file'
+            results[name] = rate_summary(count, perf_counter() - start)
+            results[name]['file_bytes'] = os.path.getsize(path)
+
+    return results
+
+
+async def _wait_for_server(url, timeout=30.0):
+    deadline = perf_counter() + timeout
+    async with aiohttp.ClientSession() as session:
+        while perf_counter() < deadline:
+            try:
+                async with session.get(f'{url}/count', params={'url': 'x'}) as rsp:
+                    if rsp.status == 200:
+                        return
+            except aiohttp.ClientError:
+                pass
+            await sleep(0.2)
+    raise click.ClickException(f'server at {url} did not start within {timeout}s')
+
+
+async def bench_count(corpus, services, server_url, start_server, duration,
+                      concurrency, unannotated_ratio, anonymous_ratio):
+    """
+    Measure `/count` latency and throughput against an index of `corpus`.
+    """
+    index = _get_index()
+    await _reset(index)
+    await index.incremental_index()
+
+    server = None
+    if start_server:
+        server = subprocess.Popen([sys.executable, '-m', 'badger.app', 'server'])
+    try:
+        await _wait_for_server(server_url)
+        h_requests_before = dict(services.requests)
+        commands_before = await _redis_commands(index)
+        results = await drive_count(server_url, corpus, duration=duration,
+                                    concurrency=concurrency,
+                                    unannotated_ratio=unannotated_ratio,
+                                    anonymous_ratio=anonymous_ratio)
+        # Less one for the first `INFO` command.
+        commands = await _redis_commands(index) - commands_before - 1
+        results['redis_commands_per_request'] = (commands / results['requests']
+                                                 if results['requests'] else None)
+        results['h_requests'] = {
+            name: count - h_requests_before.get(name, 0)
+            for name, count in services.requests.items() if name.startswith('h.')}
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+
+    return {'count': results}
+
+
+async def bench_lookup(corpus, iterations):
+    """
+    Measure the latency of in-process count lookups, one at a time, against
+    that of a bare Redis `GET`.
+
+    This isolates the cost of `fetch_count` from the web server. Anonymous
+    lookups should cost about the same as a `GET`.
+    """
+    index = _get_index()
+    await _reset(index)
+    await index.incremental_index()
+
+    rng = random.Random(0)
+    urls = [rng.choice(corpus.annotations)['uri'] for _ in range(iterations)]
+    token = f'Bearer {corpus.users[0]}'
+    await index.kv_store.put('bench|value', '1')
+
+    lookups = {
+        'redis_get': lambda url: index.kv_store.get('bench|value'),
+        'fetch_count_anonymous': lambda url: index.fetch_count(url, None),
+        'fetch_count_authenticated': lambda url: index.fetch_count(url, token),
+    }
+    results = {}
+    for name, lookup in lookups.items():
+        # Warm up connections and caches.
+        await lookup(urls[0])
+        latencies = []
+        started = perf_counter()
+        for url in urls:
+            start = perf_counter()
+            await lookup(url)
+            latencies.append(perf_counter() - start)
+        results[name] = latency_summary(latencies, perf_counter() - started)
+
+    return {'lookup': results}
+
+
+def bench_decode(corpus, batches, batch_size=1000):
+    """
+    Measure the time and peak memory taken to decode batches of annotations,
+    as fetched from Elasticsearch by the indexer and as read from dump files
+    by `index_from_file`.
+
+    This does not require Redis.
+    """
+    from badger.fast_json import PARSER
+    from badger.index_fetcher import decode_es_hits
+    from badger.ingest import decode_chunk
+
+    anns = corpus.annotations[:batch_size]
+    es_body = json.dumps({'hits': {'hits': [
+        {**corpus.es_hit(ann), 'sort': [ann['created'], ann['id']]} for ann in anns]}}).encode()
+    ndjson_chunk = b''.join(json.dumps(corpus.api_annotation(ann)).encode() + b'\n'
+                            for ann in anns)
+
+    decoders = {
+        'es_hits': lambda: decode_es_hits(es_body),
+        'ndjson_chunk': lambda: decode_chunk(ndjson_chunk, 'ndjson'),
+    }
+    results = {'parser': PARSER, 'batch_size': len(anns)}
+    for name, decode in decoders.items():
+        decode()
+        latencies = []
+        started = perf_counter()
+        for _ in range(batches):
+            start = perf_counter()
+            decode()
+            latencies.append(perf_counter() - start)
+        results[name] = latency_summary(latencies, perf_counter() - started)
+
+        # Measured separately since tracing slows decoding down.
+        tracemalloc.start()
+        decoded = decode()
+        results[name]['peak_memory_bytes'] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        del decoded
+
+    return {'decode': results}
+
+
+def _metadata(corpus_params):
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                         stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'timestamp': datetime.now(timezone.utc).isoformat(),
+            'commit': commit,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'corpus': corpus_params,
+            'settings': {name: os.environ.get(name) for name in RECORDED_SETTINGS}}
+
+
+@click.group()
+@click.option('--annotations', default=100000, help='Number of annotations in the corpus')
+@click.option('--uris', default=20000, help='Number of annotated URIs')
+@click.option('--users', default=2000, help='Number of users')
+@click.option('--groups', default=200, help='Number of groups')
+@click.option('--seed', default=0, help='Random seed for the corpus')
+@click.option('--redis-db', default=15, help='Redis database to use. It is emptied!')
+@click.option('--h-latency', default=0.0, help='Latency in seconds added by the fake h and ES')
+@click.option('--output', type=click.Path(), help='Write results to this JSON file')
+@click.pass_context
+def cli(ctx, annotations, uris, users, groups, seed, redis_db, h_latency, output):
+    corpus_params = {'annotations': annotations, 'uris': uris, 'users': users,
+                     'groups': groups, 'seed': seed}
+    corpus = Corpus(**corpus_params)
+    services = FakeServices(corpus, latency=h_latency)
+    services.start()
+    _configure_env(services, redis_db)
+
+    ctx.obj = {'corpus': corpus, 'services': services, 'results': {}}
+
+    def write_results():
+        services.stop()
+        report = {'meta': _metadata(corpus_params), 'results': ctx.obj['results']}
+        click.echo(json.dumps(report, indent=2))
+        if output:
+            with open(output, 'w') as file:
+                json.dump(report, file, indent=2)
+
+    ctx.call_on_close(write_results)
+
+
+_count_options = [
+    click.option('--server-url', default='http://localhost:8001', help='URL of the badger server'),
+    click.option('--start-server/--no-start-server', default=True,
+                 help='Start a badger server configured to use the fake services'),
+    click.option('--duration', default=10.0, help='Duration of the load test in seconds'),
+    click.option('--concurrency', default=50, help='Number of concurrent requests'),
+    click.option('--unannotated-ratio', default=0.8,
+                 help='Fraction of requests for URLs which were never annotated'),
+    click.option('--anonymous-ratio', default=0.5,
+                 help='Fraction of requests without an access token'),
+]
+
+
+def count_options(func):
+    for option in reversed(_count_options):
+        func = option(func)
+    return func
+
+
+@cli.command(help='Benchmark /count latency and throughput')
+@count_options
+@click.pass_obj
+def count(obj, **kwargs):
+    obj['results'].update(_run(bench_count(obj['corpus'], obj['services'], **kwargs)))
+
+
+@cli.command(help='Benchmark in-process count lookups against a bare Redis GET')
+@click.option('--iterations', default=10000, help='Number of lookups of each kind')
+@click.pass_obj
+def lookup(obj, iterations):
+    obj['results'].update(_run(bench_lookup(obj['corpus'], iterations)))
+
+
+@cli.command(help='Benchmark indexing throughput')
+@click.option('--workers', type=int, help='Processes used to decode dump files')
+@click.pass_obj
+def index(obj, workers):
+    obj['results'].update(_run(bench_index(obj['corpus'], workers)))
+
+
+@cli.command(help='Benchmark decoding batches of annotations')
+@click.option('--batches', default=100, help='Number of batches of each kind to decode')
+@click.pass_obj
+def decode(obj, batches):
+    obj['results'].update(bench_decode(obj['corpus'], batches))
+
+
+@cli.command(name='all', help='Run all benchmarks')
+@click.option('--workers', type=int, help='Processes used to decode dump files')
+@click.option('--iterations', default=10000, help='Number of lookups of each kind')
+@click.option('--batches', default=100, help='Number of batches of each kind to decode')
+@count_options
+@click.pass_obj
+def all_(obj, workers, iterations, batches, **kwargs):
+    obj['results'].update(bench_decode(obj['corpus'], batches))
+    obj['results'].update(_run(bench_index(obj['corpus'], workers)))
+    obj['results'].update(_run(bench_lookup(obj['corpus'], iterations)))
+    obj['results'].update(_run(bench_count(obj['corpus'], obj['services'], **kwargs)))
+
+
+if __name__ == '__main__':
+    cli()
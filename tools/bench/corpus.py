@@ -0,0 +1,127 @@
+"""
+Generator for synthetic annotation corpora.
+
+Annotations are spread over URIs, users and groups with a Zipf-like skew, so
+that a few popular URIs and groups account for most annotations as they do on
+a real h service.
+"""
+
+from base64 import urlsafe_b64encode
+from datetime import datetime, timedelta, timezone
+from itertools import accumulate
+import gzip
+import json
+import random
+
+# Pubid of h's public group.
+PUBLIC_GROUP = '__world__'
+
+
+class Corpus:
+    """
+    A synthetic set of annotations and the users and groups that made them.
+    """
+
+    def __init__(self, annotations=10000, uris=2000, users=500, groups=50,
+                 public_ratio=0.7, private_ratio=0.1, skew=1.1, seed=0):
+        """
+        :param annotations: Number of annotations
+        :param uris: Number of distinct annotated URIs
+        :param users: Number of users
+        :param groups: Number of groups, excluding the public group
+        :param public_ratio: Fraction of annotations in the public group
+        :param private_ratio: Fraction of annotations which are private to
+                              their author
+        :param skew: Exponent of the Zipf-like distribution of annotations over
+                     URIs, users and groups
+        :param seed: Random seed. The same parameters and seed always produce
+                     the same corpus.
+        """
+        rng = random.Random(seed)
+
+        self.uris = [f'https://example.com/{i}/page.html' for i in range(uris)]
+        self.users = [f'acct:user{i}@example.com' for i in range(users)]
+        self.groups = [f'group{i}' for i in range(groups)]
+
+        # Each user is a member of a few groups, favouring popular ones.
+        group_weights = _zipf_weights(len(self.groups), skew)
+        self.memberships = {}
+        for user in self.users:
+            count = rng.randint(0, min(5, len(self.groups)))
+            self.memberships[user] = sorted(set(
+                rng.choices(self.groups, cum_weights=group_weights, k=count)))
+
+        uri_weights = _zipf_weights(len(self.uris), skew)
+        user_weights = _zipf_weights(len(self.users), skew)
+        start = datetime(2015, 1, 1, tzinfo=timezone.utc)
+
+        self.annotations = []
+        for i in range(annotations):
+            uri = rng.choices(self.uris, cum_weights=uri_weights)[0]
+            user = rng.choices(self.users, cum_weights=user_weights)[0]
+
+            kind = rng.random()
+            if kind < private_ratio:
+                group, shared = PUBLIC_GROUP, False
+            elif kind < private_ratio + public_ratio or not self.memberships[user]:
+                group, shared = PUBLIC_GROUP, True
+            else:
+                group, shared = rng.choice(self.memberships[user]), True
+
+            # Several annotations share each creation time, as happens in h.
+            created = start + timedelta(seconds=i // 3)
+            id_ = urlsafe_b64encode(rng.getrandbits(128).to_bytes(16, 'big'))
+            self.annotations.append({'id': id_.rstrip(b'=').decode(),
+                                     'uri': uri,
+                                     'user': user,
+                                     'group': group,
+                                     'shared': shared,
+                                     'created': created.isoformat()})
+
+    def api_annotation(self, ann):
+        """
+        Return an annotation in the format returned by h's API.
+        """
+        if ann['shared']:
+            read = [f'group:{ann["group"]}']
+        else:
+            read = [ann['user']]
+        return {'id': ann['id'],
+                'created': ann['created'],
+                'updated': ann['created'],
+                'user': ann['user'],
+                'uri': ann['uri'],
+                'group': ann['group'],
+                'permissions': {'read': read},
+                'target': [{'source': ann['uri']}],
+                'text': 'Lorem ipsum dolor sit amet ' * 4,
+                'tags': []}
+
+    def es_hit(self, ann):
+        """
+        Return an annotation in the format stored in h's Elasticsearch index.
+        """
+        source = {'uri': ann['uri'],
+                  'user': ann['user'],
+                  'group': ann['group'],
+                  'shared': ann['shared'],
+                  'created': ann['created'],
+                  'deleted': False}
+        return {'_id': ann['id'], '_source': source}
+
+    def write_dump(self, path, compress=True):
+        """
+        Write the corpus to a newline-delimited JSON dump file.
+        """
+        opener = gzip.open if compress else open
+        with opener(path, 'wt') as file:
+            for ann in self.annotations:
+                file.write(json.dumps(self.api_annotation(ann)))
+                file.write('\n')
+
+
+def _zipf_weights(count, skew):
+    """
+    Return cumulative weights for choosing from `count` items by Zipf's law.
+    """
+    return list(accumulate(1 / (rank ** skew) for rank in range(1, count + 1)))
@@ -0,0 +1,68 @@
+"""
+Load driver for the `/count` endpoint.
+"""
+
+from asyncio import gather
+import random
+from time import perf_counter
+
+import aiohttp
+
+from .stats import latency_summary
+
+
+async def drive_count(server_url, corpus, duration=10.0, concurrency=50,
+                      unannotated_ratio=0.8, anonymous_ratio=0.5, users=100,
+                      seed=0):
+    """
+    Send `/count` requests to a badger server for `duration` seconds.
+
+    :param server_url: Root URL of the badger web service
+    :param corpus: `Corpus` which the server's index was built from
+    :param concurrency: Number of requests in flight at once
+    :param unannotated_ratio: Fraction of requests for URLs which have never
+                              been annotated
+    :param anonymous_ratio: Fraction of requests made without an access token
+    :param users: Number of distinct users making authenticated requests
+    :return: Latency and throughput summary
+    """
+    rng = random.Random(seed)
+    tokens = [f'Bearer {userid}' for userid in corpus.users[:users]]
+    latencies = []
+    errors = 0
+
+    def next_request():
+        if rng.random() < unannotated_ratio:
+            url = f'https://unannotated.example.org/{rng.getrandbits(32)}'
+        else:
+            url = rng.choice(corpus.annotations)['uri']
+        headers = {}
+        if tokens and rng.random() >= anonymous_ratio:
+            headers['Authorization'] = rng.choice(tokens)
+        return url, headers
+
+    async def client(session, deadline):
+        nonlocal errors
+        while perf_counter() < deadline:
+            url, headers = next_request()
+            start = perf_counter()
+            try:
+                async with session.get(f'{server_url}/count', params={'url': url},
+                                       headers=headers) as rsp:
+                    await rsp.read()
+                    if rsp.status != 200:
+                        errors += 1
+                        continue
+            except aiohttp.ClientError:
+                errors += 1
+                continue
+            latencies.append(perf_counter() - start)
+
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        start = perf_counter()
+        deadline = start + duration
+        await gather(*[client(session, deadline) for _ in range(concurrency)])
+        elapsed = perf_counter() - start
+
+    return latency_summary(latencies, elapsed, errors)
@@ -0,0 +1,185 @@
+"""
+Local stand-ins for the h API and Elasticsearch services.
+
+These serve a `Corpus` using just enough of each service's API for badger's
+web service, indexer and dump tool to run against them.
+"""
+
+from asyncio import new_event_loop, run_coroutine_threadsafe, sleep
+from bisect import bisect_left, bisect_right
+from datetime import datetime
+import threading
+
+from aiohttp import web
+
+from .corpus import PUBLIC_GROUP
+
+
+def _epoch_millis(date):
+    if isinstance(date, (int, float)):
+        return date
+    return datetime.fromisoformat(date).timestamp() * 1000
+
+
+class FakeServices:
+    """
+    Fake h API and Elasticsearch servers, run in a background thread.
+
+    Access tokens of the form "Bearer {userid}" authenticate as that user and
+    requests without a token are treated as anonymous.
+    """
+
+    def __init__(self, corpus, host='127.0.0.1', h_port=5050, es_port=9250,
+                 latency=0.0):
+        """
+        :param corpus: The `Corpus` to serve
+        :param latency: Delay in seconds added to every response
+        """
+        self.corpus = corpus
+        self.host = host
+        self.h_port = h_port
+        self.es_port = es_port
+        self.latency = latency
+
+        # Number of requests received, by endpoint.
+        self.requests = {}
+
+        # Annotations sorted by (creation date, ID), as h's ES index sorts them.
+        self._anns = sorted(corpus.annotations,
+                            key=lambda ann: (ann['created'], ann['id']))
+        self._sort_keys = [(ann['created'], ann['id']) for ann in self._anns]
+        self._created_millis = [_epoch_millis(ann['created']) for ann in self._anns]
+
+        self._loop = None
+        self._runners = []
+
+    @property
+    def h_api_url(self):
+        return f'http://{self.host}:{self.h_port}/api'
+
+    @property
+    def es_url(self):
+        return f'http://{self.host}:{self.es_port}'
+
+    def start(self):
+        """
+        Start the servers in a background thread.
+        """
+        self._loop = new_event_loop()
+        thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        thread.start()
+        run_coroutine_threadsafe(self._start(), self._loop).result()
+
+    def stop(self):
+        run_coroutine_threadsafe(self._stop(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+
+    async def _start(self):
+        h_app = web.Application()
+        h_app.router.add_get('/api', self._h_root)
+        h_app.router.add_get('/api/profile', self._h_profile)
+        h_app.router.add_get('/api/groups', self._h_groups)
+        h_app.router.add_get('/api/search', self._h_search)
+
+        es_app = web.Application()
+        es_app.router.add_post('/{index}/_search', self._es_search)
+
+        for app, port in [(h_app, self.h_port), (es_app, self.es_port)]:
+            runner = web.AppRunner(app, access_log=None)
+            await runner.setup()
+            await web.TCPSite(runner, self.host, port).start()
+            self._runners.append(runner)
+
+    async def _stop(self):
+        for runner in self._runners:
+            await runner.cleanup()
+
+    async def _respond(self, name, body):
+        self.requests[name] = self.requests.get(name, 0) + 1
+        if self.latency:
+            await sleep(self.latency)
+        return web.json_response(body)
+
+    def _userid(self, request):
+        auth = request.headers.get('Authorization', '')
+        if auth.startswith('Bearer '):
+            return auth[len('Bearer '):]
+        return None
+
+    async def _h_root(self, request):
+        base = self.h_api_url
+        links = {'search': {'url': f'{base}/search'},
+                 'profile': {'read': {'url': f'{base}/profile'}},
+                 'groups': {'read': {'url': f'{base}/groups'}}}
+        return await self._respond('h.root', {'links': links})
+
+    async def _h_profile(self, request):
+        return await self._respond('h.profile', {'userid': self._userid(request)})
+
+    async def _h_groups(self, request):
+        userid = self._userid(request)
+        pubids = [PUBLIC_GROUP] + self.corpus.memberships.get(userid, [])
+        groups = [{'id': pubid, 'name': pubid} for pubid in pubids]
+        return await self._respond('h.groups', groups)
+
+    async def _h_search(self, request):
+        """
+        Return public annotations, sorted by creation date.
+
+        Supports the `limit`, `offset`, `order` and `search_after` parameters.
+        """
+        limit = int(request.query.get('limit', 20))
+        offset = int(request.query.get('offset', 0))
+        descending = request.query.get('order', 'desc') == 'desc'
+        search_after = request.query.get('search_after')
+
+        anns = [ann for ann in self._anns if ann['shared'] and
+                ann['group'] == PUBLIC_GROUP]
+        if descending:
+            anns = anns[::-1]
+        if search_after:
+            if descending:
+                anns = [ann for ann in anns if ann['created'] < search_after]
+            else:
+                anns = [ann for ann in anns if ann['created'] > search_after]
+
+        rows = [self.corpus.api_annotation(ann)
+                for ann in anns[offset:offset + limit]]
+        return await self._respond('h.search', {'total': len(anns), 'rows': rows})
+
+    async def _es_search(self, request):
+        """
+        Search annotations.
+
+        Supports a `range` query on `created`, sorting by creation date with
+        `search_after` paging and a `percentiles` aggregation on `created`.
+        """
+        body = await request.json()
+
+        if 'aggs' in body:
+            percents = body['aggs']['created']['percentiles']['percents']
+            millis = self._created_millis
+            values = {str(p): millis[min(int(len(millis) * p / 100), len(millis) - 1)]
+                      for p in percents} if millis else {}
+            result = {'aggregations': {'created': {'values': values}}}
+            return await self._respond('es.aggs', result)
+
+        start = 0
+        end = len(self._anns)
+        created_range = body.get('query', {}).get('range', {}).get('created', {})
+        if 'gte' in created_range:
+            start = bisect_left(self._created_millis,
+                                _epoch_millis(created_range['gte']))
+        if 'lt' in created_range:
+            end = bisect_left(self._created_millis,
+                              _epoch_millis(created_range['lt']))
+        if 'search_after' in body:
+            start = max(start, bisect_right(self._sort_keys,
+                                            tuple(body['search_after'])))
+
+        hits = []
+        for i in range(start, min(end, start + body.get('size', 10))):
+            ann = self._anns[i]
+            hits.append({**self.corpus.es_hit(ann),
+                         'sort': [ann['created'], ann['id']]})
+        return await self._respond('es.search', {'hits': {'hits': hits}})
@@ -0,0 +1,39 @@
+"""
+Helpers for summarizing benchmark measurements.
+"""
+
+
+def percentile(sorted_values, percent):
+    """
+    Return the `percent`th percentile of a sorted list, by nearest rank.
+    """
+    if not sorted_values:
+        return None
+    rank = max(0, min(len(sorted_values) - 1,
+                      round(percent / 100 * len(sorted_values)) - 1))
+    return sorted_values[rank]
+
+
+def latency_summary(latencies, duration, errors=0):
+    """
+    Summarize request latencies, in seconds, measured over `duration` seconds.
+    """
+    latencies = sorted(latencies)
+    summary = {'requests': len(latencies),
+               'errors': errors,
+               'duration_s': duration,
+               'throughput_rps': len(latencies) / duration if duration else None}
+    for percent in (50, 95, 99):
+        value = percentile(latencies, percent)
+        summary[f'p{percent}_ms'] = value * 1000 if value is not None else None
+    summary['max_ms'] = latencies[-1] * 1000 if latencies else None
+    return summary
+
+
+def rate_summary(count, duration):
+    """
+    Summarize the rate of processing `count` items in `duration` seconds.
+    """
+    return {'count': count,
+            'duration_s': duration,
+            'rate_per_s': count / duration if duration else None}
@@ -0,0 +1,287 @@
+#!/usr/bin/env python
+
+"""
+Check that the embedded key-value store behaves the same as Redis.
+
+The same scenario is run against `KeyValueStore` and `EmbeddedKeyValueStore`
+for each combination of counter and annotation layouts: annotations are
+indexed directly and by the incremental indexer, counted, drifted from a
+stand-in for Elasticsearch and reconciled, and migrated between layouts, URI
+filter refreshes are interrupted, and the set, stream and expiry operations
+used by the principals cache and the event consumer are exercised. The result of each
+step is compared and any differences are printed.
+
+A real Redis server is required. Its location is configured using the
+`REDIS_HOST` and `REDIS_PORT` environment variables, and the check uses (and
+empties) the Redis database selected by `--redis-db`. The embedded store is
+created in a temporary directory.
+
+Usage:
+
+    python -m tools.check_stores
+"""
+
+from asyncio import get_event_loop, sleep
+import os
+import sys
+import tempfile
+
+import click
+
+from badger.digest import java_string_hash
+from badger.embedded_store import EmbeddedKeyValueStore
+from badger.index import AnnotationCountIndex, uri_scope_key_for_ann
+from badger.index_fetcher import Annotation, ElasticsearchFetcher
+from badger.kv_store import KeyValueStore
+from badger.principals import PrincipalsCache
+from badger.uri_filter import URIFilter
+
+LAYOUTS = [('keys', 'keys'), ('keys', 'registry'), ('hash', 'keys'), ('hash', 'registry')]
+
+
+class FakeHAPI:
+    """
+    Stand-in for the h API which knows a single user.
+    """
+
+    async def profile(self, auth=None):
+        return {'userid': 'acct:bob@example.com' if auth else None}
+
+    async def groups(self, auth=None):
+        groups = [{'id': '__world__'}]
+        if auth:
+            groups.append({'id': 'group1'})
+        return groups
+
+
+class FakeFetcher(ElasticsearchFetcher):
+    """
+    Stand-in for `ElasticsearchFetcher` which serves annotations from memory.
+
+    Methods which do not query Elasticsearch are inherited.
+    """
+
+    def __init__(self):
+        self.anns = {}
+        self.deleted = set()
+
+    async def fetch_batches_since(self, date, until=None):
+        anns = sorted((ann for ann in self.anns.values()
+                       if (not date or ann.created >= date)
+                       and (not until or ann.created < until)),
+                      key=lambda ann: (ann.created, ann.id))
+        if anns:
+            yield anns
+
+    async def fetch_digest(self, buckets, parent_buckets=None, selected=None):
+        digest = {}
+        for ann in self.anns.values():
+            bucket = java_string_hash(ann.uri) % buckets
+            if selected is not None and bucket % parent_buckets not in selected:
+                continue
+            count, total = digest.get(bucket, (0, 0))
+            digest[bucket] = (count + 1, total + java_string_hash(uri_scope_key_for_ann(ann)))
+        return digest
+
+    async def fetch_bucket_annotations(self, buckets, selected):
+        return [ann for ann in self.anns.values()
+                if java_string_hash(ann.uri) % buckets in selected]
+
+    async def fetch_deleted_ids(self):
+        deleted = sorted(self.deleted)
+        for i in range(0, len(deleted), 100):
+            yield deleted[i:i + 100]
+
+
+class FailingStore:
+    """
+    Wrapper for a key-value store which fails the next call set in `fail`.
+
+    `fail` is a `(method, key)` tuple.
+    """
+
+    def __init__(self, kv_store):
+        self.kv_store = kv_store
+        self.fail = None
+
+    def __getattr__(self, name):
+        method = getattr(self.kv_store, name)
+
+        async def call(key, *args, **kwargs):
+            if (name, key) == self.fail:
+                self.fail = None
+                raise ConnectionError(f'{name} of "{key}" failed')
+            return await method(key, *args, **kwargs)
+        return call
+
+
+def _ann(n, uri, shared=True):
+    return Annotation(f'id{n}', uri, 'group1', 'acct:bob@example.com', shared,
+                      f'2020-01-{1 + n // 24:02d}T{n % 24:02d}:00:00+00:00')
+
+
+async def run_scenario(kv_store, counter_layout, ann_layout):
+    """
+    Run the scenario against `kv_store` and return a list of `(step, result)`.
+    """
+    results = []
+
+    def record(step, result):
+        results.append((step, result))
+
+    fetcher = FakeFetcher()
+    uri_filter = URIFilter(kv_store, bits=4096)
+    index = AnnotationCountIndex(FakeHAPI(), fetcher, kv_store,
+                                 principals_cache=PrincipalsCache(ttl=0.0),
+                                 uri_filter=uri_filter,
+                                 counter_layout=counter_layout,
+                                 ann_layout=ann_layout)
+    anns = [_ann(n, f'http://site{n % 7}.com/é', shared=n % 3 != 0) for n in range(40)]
+    for ann in anns:
+        fetcher.anns[ann.id] = ann
+    url = 'http://site1.com/é'
+
+    # Indexing and counting.
+    _, tag = await index.fetch_count_and_tag(url, 'token')
+    record('index', await index.index_annotations(anns))
+    record('index again', await index.index_annotations(anns))
+    for ann in [_ann(n, f'http://site{n % 7}.com/é') for n in range(40, 45)]:
+        fetcher.anns[ann.id] = ann
+    record('incremental index', await index.incremental_index())
+    record('incremental index again', await index.incremental_index())
+    await uri_filter.refresh()
+    record('count', await index.fetch_count(url, 'token'))
+    record('anonymous count', await index.fetch_count(url, None))
+    record('tag changed', (await index.fetch_count_and_tag(url, 'token'))[1] != tag)
+    record('counts', await index.fetch_counts([url, 'http://site2.com/é', 'http://none/'],
+                                              'token'))
+
+    # URI filter refreshes which fail partway leave the copy as it was, and
+    # are retried by the next refresh.
+    failing_store = FailingStore(kv_store)
+    reader = URIFilter(failing_store)
+    await reader.refresh()
+    for n, fail in enumerate([('get_hash', URIFilter.CHUNKS_KEY),
+                              ('get_ranges', URIFilter.BITMAP_KEY)]):
+        uri = f'http://filter{n}.com/'
+        await uri_filter.add([uri])
+        failing_store.fail = fail
+        try:
+            await reader.refresh()
+        except ConnectionError:
+            pass
+        await reader.refresh()
+        record(f'filter after failed {fail[0]}', reader.might_contain(uri))
+        assert reader.might_contain(uri), f'URI filter is stale after failed {fail[0]}'
+
+    # Reconciliation.
+    record('reconcile clean', await index.reconcile())
+    del fetcher.anns['id1']
+    fetcher.deleted.add('id1')
+    fetcher.anns['id2'] = _ann(2, 'http://moved.com/')
+    await index.remove_annotations(['id3'])
+    record('reconcile drift', await index.reconcile())
+    record('reconcile again', await index.reconcile())
+    record('count after reconcile', await index.fetch_count(url, 'token'))
+
+    # Layout migrations.
+    if counter_layout == 'keys':
+        record('migrate counters', await index.migrate_counters_to_hash())
+        index = AnnotationCountIndex(FakeHAPI(), fetcher, kv_store,
+                                     counter_layout='hash', ann_layout=ann_layout)
+        record('count after migration', await index.fetch_count(url, 'token'))
+    if ann_layout == 'keys':
+        record('migrate annotations', await index.migrate_anns_to_registry())
+        index = AnnotationCountIndex(FakeHAPI(), fetcher, kv_store,
+                                     counter_layout=index.counter_layout,
+                                     ann_layout='registry')
+        record('remove after migration', await index.remove_annotations(['id4', 'id5', 'nope']))
+        record('reconcile after migration', await index.reconcile())
+
+    # Keys, sets and hashes.
+    record('lock', await kv_store.put_if_absent('check|lock', '1', 1))
+    record('lock held', await kv_store.put_if_absent('check|lock', '1', 1))
+    await kv_store.add_to_set('check|set', ['a', 'b'], 10)
+    record('pop set', sorted(await kv_store.pop_set('check|set')))
+    record('pop empty set', await kv_store.pop_set('check|set'))
+    await kv_store.put_dict('check|dict', {'x': [1, 2]}, 1)
+    record('dict', await kv_store.get_dict('check|dict'))
+    await kv_store.put('check|n', 5)
+    record('get', await kv_store.get('check|n'))
+    record('increment', await kv_store.inc_counter('check|n'))
+    record('decrement field', await kv_store.dec_counter('check|hash', 'f'))
+    record('hash', await kv_store.get_hash('check|hash', typ=int))
+    record('scan', sorted([key async for key in kv_store.scan_keys('count|*', count=3)])[:5])
+    record('scan hashes', len([key async for key in kv_store.scan_keys('*', type='hash')]))
+
+    # Streams.
+    await kv_store.create_stream_group('check|stream', 'group')
+    await kv_store.create_stream_group('check|stream', 'group')
+    await kv_store.append_to_stream('check|stream', [{'a': '1'}, {'a': '2'}, {'a': '3'}],
+                                    maxlen=10)
+    first = await kv_store.read_stream_group('check|stream', 'group', 'c1', 2, block=100)
+    record('read stream', [fields for _, fields in first])
+    rest = await kv_store.read_stream_group('check|stream', 'group', 'c1', 5, block=100)
+    record('read rest of stream', [fields for _, fields in rest])
+    record('read empty stream',
+           await kv_store.read_stream_group('check|stream', 'group', 'c1', 5, block=100))
+    await kv_store.ack_stream_entries('check|stream', 'group', [first[0][0]])
+    await sleep(0.02)
+    claimed = await kv_store.claim_stream_entries('check|stream', 'group', 'c2', 10, 10)
+    record('claim stream', [fields for _, fields in claimed])
+
+    # Deletion and expiry.
+    await kv_store.delete('check|n')
+    record('deleted', await kv_store.get('check|n'))
+    await sleep(1.1)
+    record('expired dict', await kv_store.get_dict('check|dict'))
+    record('expired lock', await kv_store.put_if_absent('check|lock', '2', 1))
+    record('ping', await kv_store.ping())
+    return results
+
+
+def compare(redis_results, embedded_results):
+    """
+    Return the steps whose results differ, with both results.
+    """
+    differences = []
+    for (step, redis_result), (_, embedded_result) in zip(redis_results, embedded_results):
+        if redis_result != embedded_result:
+            differences.append((step, redis_result, embedded_result))
+    if len(redis_results) != len(embedded_results):
+        differences.append(('number of steps', len(redis_results), len(embedded_results)))
+    return differences
+
+
+async def check(redis_host, redis_port, redis_db, directory):
+    redis_store = KeyValueStore(redis_host, redis_port, redis_db=redis_db)
+    failed = False
+    for counter_layout, ann_layout in LAYOUTS:
+        await redis_store.redis.flushdb()
+        redis_results = await run_scenario(redis_store, counter_layout, ann_layout)
+        path = os.path.join(directory, f'{counter_layout}-{ann_layout}.db')
+        embedded_results = await run_scenario(EmbeddedKeyValueStore(path),
+                                              counter_layout, ann_layout)
+        differences = compare(redis_results, embedded_results)
+        print(f'counter layout "{counter_layout}", annotation layout "{ann_layout}": '
+              f'{len(redis_results)} steps, {len(differences)} differences')
+        for step, redis_result, embedded_result in differences:
+            print(f'  {step}:\n    redis:    {redis_result!r}\n    embedded: {embedded_result!r}')
+        failed = failed or bool(differences)
+    await redis_store.redis.flushdb()
+    return not failed
+
+
+@click.command()
+@click.option('--redis-db', default=15, help='Redis database to use. It is emptied!')
+def main(redis_db):
+    redis_host = os.environ.get('REDIS_HOST', '0.0.0.0')
+    redis_port = int(os.environ.get('REDIS_PORT', 6379))
+    with tempfile.TemporaryDirectory() as directory:
+        ok = get_event_loop().run_until_complete(
+            check(redis_host, redis_port, redis_db, directory))
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,85 +1,401 @@
 #!/usr/bin/env python
 
 """
-Create a JSON dump of all annotations in the Public channel.
+Create a dump of all public annotations from the h API.
+
+The annotations are written as gzip-compressed newline-delimited JSON, one
+annotation in h API format per line, which `python -m badger.app
+index-from-file` can read.
+
+Annotations are fetched by creation date rather than by offset. The span
+between the first and last annotation is split into partitions, each of which
+is paged through in ascending order of creation date using `search_after`, and
+several partitions are fetched at once. When a partition is finished and no
+others are waiting, the partition with the most time left is split in two so
+that the fetch does not slow down at the end.
+
+The number of concurrent requests is adjusted as the dump runs: it grows
+while responses arrive within `--target-latency` seconds and shrinks when they
+are slow or fail. Failed requests are retried with exponential backoff.
+
+Progress is saved to `{output}.progress` after each page, so if the dump is
+interrupted, running the same command again resumes it.
 """
 
-from asyncio import get_event_loop
+from asyncio import Condition, Queue, TimeoutError, get_event_loop, sleep
+from datetime import datetime, timedelta, timezone
+import gzip
 import json
 import os
+from random import random
+import re
 import sys
-from typing import Any, AsyncGenerator, Dict
+from time import monotonic
 
 import aiohttp
-from async_timeout import timeout
+import click
 
 
 H_API = os.environ.get('H_API_URL', 'https://hypothes.is/api')
 
+# Format of partition boundaries, matching the creation dates returned by h.
+DATE_FORMAT = '%Y-%m-%dT%H:%M:%S+00:00'
 
-async def fetch(session, url, params):
-    async with timeout(10):
-        async with session.get(url, params=params) as rsp:
-            if rsp.status != 200:
-                raise Exception(f'Request failed with status {rsp.status}')
-            return await rsp.json()
+# Partitions with less than this much time left are not split.
+MIN_SPLIT_SECONDS = 60
 
 
-async def search() -> AsyncGenerator[Dict[str, Any], None]:
+def parse_date(date):
+    """
+    Parse an annotation creation date, in UTC, as returned by h.
     """
-    Fetch all annotations from the API.
+    parsed = datetime.strptime(date[:19], '%Y-%m-%dT%H:%M:%S')
+    if date[19:20] == '.':
+        digits = re.match(r'\d*', date[20:]).group()
+        parsed = parsed.replace(microsecond=int(digits[:6].ljust(6, '0')))
+    return parsed.replace(tzinfo=timezone.utc)
+
 
-    Due to the way the H search API's paging works, there may be some overlap in
-    the responses. ie. it is possible for the same annotation to appear in more
-    than one response.
+def format_date(date):
+    return date.strftime(DATE_FORMAT)
 
-    Return responses from the `/api/search` endpoint.
+
+class RequestError(Exception):
+    def __init__(self, message, retryable=True, retry_after=None):
+        super().__init__(message)
+        self.retryable = retryable
+        self.retry_after = retry_after
+
+
+class AdaptiveConcurrency:
     """
+    Limit the number of concurrent requests, adjusting the limit to the
+    latency and failures of recent requests.
 
-    async with aiohttp.ClientSession() as session:
-        # Current position when iterating over search results
-        offset = 0
-        limit = 200
-        total = None
+    The limit increases by about one after each round of requests which all
+    complete within the target latency. It is reduced by a quarter when a
+    request is slow and halved when a request fails, at most once per round
+    trip so that a burst of slow responses to requests which were already in
+    flight only counts once.
+    """
 
-        # Number of concurrent requests to make to the API
-        concurrent_reqs = 10
+    def __init__(self, initial, maximum, target_latency):
+        """
+        :param initial: Initial number of concurrent requests
+        :param maximum: Maximum number of concurrent requests
+        :param target_latency: Latency in seconds above which the limit is
+                               reduced
+        """
+        self.limit = float(initial)
+        self.maximum = maximum
+        self.target_latency = target_latency
+        self.in_flight = 0
+        self._condition = Condition()
+        self._last_decrease = 0.0
 
-        while True:
-            url = f'{H_API}/search'
+    async def acquire(self):
+        async with self._condition:
+            while self.in_flight >= int(self.limit):
+                await self._condition.wait()
+            self.in_flight += 1
+        return monotonic()
+
+    async def release(self, started, failed=False):
+        """
+        Release a request slot and update the limit.
+
+        :param started: Value returned by `acquire`
+        :param failed: Whether the request failed
+        """
+        now = monotonic()
+        latency = now - started
+        if failed or latency > self.target_latency:
+            # Only react to requests which started after the last decrease.
+            if started >= self._last_decrease:
+                factor = 0.5 if failed else 0.75
+                self.limit = max(1.0, self.limit * factor)
+                self._last_decrease = now
+        else:
+            self.limit = min(float(self.maximum), self.limit + 1 / self.limit)
+        async with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+
+class Checkpoint:
+    """
+    Progress of a dump, saved next to the output file.
+
+    Each partition covers annotations created after its `start` and up to and
+    including its `end`. `after` is the `search_after` value of the partition's
+    next request. Because several annotations may share a creation date, `after`
+    is the date of the last annotation but one in the page and `seen` holds the
+    IDs of the annotations at the last date, which are skipped when they are
+    returned again.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.output_size = 0
+        self.fetched = 0
+        self.partitions = []
+
+    def load(self):
+        with open(self.path) as file:
+            state = json.load(file)
+        self.output_size = state['output_size']
+        self.fetched = state['fetched']
+        self.partitions = state['partitions']
+
+    def save(self):
+        state = {'output_size': self.output_size,
+                 'fetched': self.fetched,
+                 'partitions': self.partitions}
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w') as file:
+            json.dump(state, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, self.path)
+
+    def add_partition(self, start, end):
+        partition = {'start': start, 'end': end, 'after': start, 'seen': [],
+                     'done': False}
+        self.partitions.append(partition)
+        return partition
+
+
+class Dumper:
+    def __init__(self, session, output, checkpoint, limiter, page_size=200,
+                 max_retries=5):
+        """
+        :param session: `aiohttp.ClientSession` used for requests to the h API
+        :param output: Output file, opened for appending in binary mode
+        :param checkpoint: `Checkpoint` holding the progress of the dump
+        :param limiter: `AdaptiveConcurrency` limiting concurrent requests
+        :param page_size: Number of annotations to request at once
+        :param max_retries: Number of times a failed request is retried
+        """
+        self.session = session
+        self.output = output
+        self.checkpoint = checkpoint
+        self.limiter = limiter
+        self.page_size = page_size
+        self.max_retries = max_retries
+        self.retries = 0
+        self._queue = Queue()
+        self._active = []
+        self._last_report = 0.0
 
+    async def search(self, params):
+        """
+        Make an `/api/search` request, retrying it if it fails.
+        """
+        for attempt in range(self.max_retries + 1):
+            started = await self.limiter.acquire()
             try:
-                # Make `concurrent_reqs` concurrent search requests.
-                chunks = []
-                for i in range(0, concurrent_reqs):
-                    params = {'offset': offset + (i * limit),
-                              'limit': limit,
-                              'sort': 'created',
-                              'order': 'desc'}
-                    chunks.append(fetch(session, url, params))
-
-                # Wait for responses and increment offset.
-                chunks = [await c for c in chunks]
-                for chunk in chunks:
-                    yield chunk
-                    chunk_len = len(chunk['rows'])
-                    if chunk_len == 0:
-                        break
-                    offset += len(chunk['rows'])
-                    total = chunk['total']
-
-                    print(f'fetched {offset} of {total} entries', file=sys.stderr)
-            except Exception as ex:
-                print(f'request failed {ex}', file=sys.stderr)
-                continue
-
-
-async def run():
-    async for chunk in search():
-        print(json.dumps(chunk, indent=2))
-        # Marker to split resulting file on when re-reading, chosen as a string
-        # that won't appear in the JSON output.
-        print('\n""""\n')
-
-loop = get_event_loop()
-loop.run_until_complete(run())
+                rsp = await self._request(params)
+            except RequestError as ex:
+                await self.limiter.release(started, failed=True)
+                if not ex.retryable or attempt == self.max_retries:
+                    raise
+                delay = ex.retry_after or min(60.0, 2 ** attempt) * (0.5 + random())
+                self.retries += 1
+                print(f'request failed ({ex}), retrying in {delay:.1f}s',
+                      file=sys.stderr)
+                await sleep(delay)
+            else:
+                await self.limiter.release(started)
+                return rsp
+
+    async def _request(self, params):
+        try:
+            async with self.session.get(f'{H_API}/search', params=params) as rsp:
+                if rsp.status != 200:
+                    retry_after = rsp.headers.get('Retry-After', '')
+                    raise RequestError(
+                        f'status {rsp.status}',
+                        retryable=rsp.status == 429 or rsp.status >= 500,
+                        retry_after=float(retry_after) if retry_after.isdigit() else None)
+                return await rsp.json()
+        except (aiohttp.ClientError, TimeoutError) as ex:
+            raise RequestError(str(ex) or type(ex).__name__)
+
+    async def plan(self, partitions):
+        """
+        Split the span between the first and last public annotations into
+        `partitions` partitions of equal duration.
+        """
+        bounds = []
+        for order in ('asc', 'desc'):
+            rsp = await self.search({'sort': 'created', 'order': order, 'limit': 1})
+            if not rsp['rows']:
+                return
+            bounds.append(parse_date(rsp['rows'][0]['created']))
+        first, last = bounds
+
+        # Partition boundaries are exclusive at the start, so the first one
+        # starts just before the first annotation.
+        start = first.replace(microsecond=0) - timedelta(seconds=1)
+        end = last.replace(microsecond=0) + timedelta(seconds=1)
+        step = (end - start) / partitions
+        dates = [start + step * i for i in range(partitions)] + [end]
+        dates = sorted({format_date(date) for date in dates})
+        for part_start, part_end in zip(dates, dates[1:]):
+            self.checkpoint.add_partition(part_start, part_end)
+        self.checkpoint.save()
+
+    async def run(self, workers):
+        for partition in self.checkpoint.partitions:
+            if not partition['done']:
+                self._queue.put_nowait(partition)
+        await self._gather(*[self._worker() for _ in range(workers)])
+
+    async def _gather(self, *coros):
+        loop = get_event_loop()
+        tasks = [loop.create_task(coro) for coro in coros]
+        try:
+            for task in tasks:
+                await task
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def _worker(self):
+        while True:
+            partition = self._next_partition()
+            if not partition:
+                return
+            self._active.append(partition)
+            try:
+                while not partition['done']:
+                    await self._fetch_page(partition)
+            finally:
+                self._active.remove(partition)
+
+    def _next_partition(self):
+        """
+        Return the next partition to fetch, splitting the active partition
+        with the most time left if none are waiting.
+        """
+        if not self._queue.empty():
+            return self._queue.get_nowait()
+
+        def remaining(partition):
+            return parse_date(partition['end']) - parse_date(partition['after'])
+
+        candidates = [p for p in self._active
+                      if remaining(p) > timedelta(seconds=MIN_SPLIT_SECONDS)]
+        if not candidates:
+            return None
+        partition = max(candidates, key=remaining)
+        middle = parse_date(partition['after']) + remaining(partition) / 2
+        middle = format_date(middle.replace(microsecond=0))
+        new_partition = self.checkpoint.add_partition(middle, partition['end'])
+        partition['end'] = middle
+        self.checkpoint.save()
+        return new_partition
+
+    async def _fetch_page(self, partition):
+        params = {'sort': 'created', 'order': 'asc', 'limit': self.page_size,
+                  'search_after': partition['after']}
+        rows = (await self.search(params))['rows']
+
+        # Read the end after the request, since the partition may have been
+        # split while it was in flight.
+        end = parse_date(partition['end'])
+        seen = set(partition['seen'])
+        in_range = [row for row in rows if parse_date(row['created']) <= end]
+        new_rows = [row for row in in_range if row['id'] not in seen]
+
+        if new_rows:
+            lines = b''.join(json.dumps(row).encode() + b'\n' for row in new_rows)
+            # Each page is a complete gzip member, so the file can be truncated
+            # after any page.
+            self.output.write(gzip.compress(lines))
+            self.output.flush()
+            os.fsync(self.output.fileno())
+            self.checkpoint.output_size = self.output.tell()
+            self.checkpoint.fetched += len(new_rows)
+
+        if len(rows) < self.page_size or len(in_range) < len(rows):
+            partition['done'] = True
+            partition['seen'] = []
+        else:
+            last_created = rows[-1]['created']
+            tied = [row for row in rows if row['created'] == last_created]
+            if len(tied) < len(rows):
+                partition['after'] = rows[-len(tied) - 1]['created']
+                partition['seen'] = [row['id'] for row in tied]
+            else:
+                # A whole page shares one creation date. Move past it, at the
+                # risk of missing any more annotations created at that time.
+                print(f'more than {self.page_size} annotations created at '
+                      f'{last_created}, some may be missing', file=sys.stderr)
+                partition['after'] = last_created
+                partition['seen'] = []
+        self.checkpoint.save()
+        self._report()
+
+    def _report(self, force=False):
+        now = monotonic()
+        if not force and now - self._last_report < 1.0:
+            return
+        self._last_report = now
+        remaining = sum(1 for p in self.checkpoint.partitions if not p['done'])
+        print(f'fetched {self.checkpoint.fetched} annotations, '
+              f'{remaining} partitions left, '
+              f'concurrency {self.limiter.limit:.1f}', file=sys.stderr)
+
+
+@click.command()
+@click.argument('output', type=click.Path(dir_okay=False))
+@click.option('--partitions', default=64,
+              help='Number of creation date ranges to split the dump into')
+@click.option('--concurrency', default=4,
+              help='Initial number of concurrent requests')
+@click.option('--max-concurrency', default=16,
+              help='Maximum number of concurrent requests')
+@click.option('--target-latency', default=2.0,
+              help='Response time in seconds above which concurrency is reduced')
+@click.option('--timeout', default=30.0, help='Request timeout in seconds')
+@click.option('--max-retries', default=5,
+              help='Number of times a failed request is retried')
+@click.option('--restart', is_flag=True,
+              help='Discard the progress of an interrupted dump')
+def main(output, partitions, concurrency, max_concurrency, target_latency,
+         timeout, max_retries, restart):
+    """
+    Dump all public annotations to OUTPUT as gzip-compressed NDJSON.
+    """
+    checkpoint = Checkpoint(f'{output}.progress')
+    resume = not restart and os.path.exists(checkpoint.path)
+    if resume:
+        checkpoint.load()
+        # Discard anything written after the last checkpoint.
+        os.truncate(output, checkpoint.output_size)
+    elif os.path.exists(output) and not restart:
+        raise click.UsageError(f'{output} already exists, use --restart to overwrite it')
+
+    async def dump():
+        limiter = AdaptiveConcurrency(concurrency, max_concurrency, target_latency)
+        client_timeout = aiohttp.ClientTimeout(total=timeout)
+        async with aiohttp.ClientSession(timeout=client_timeout) as session:
+            with open(output, 'ab' if resume else 'wb') as file:
+                dumper = Dumper(session, file, checkpoint, limiter,
+                                max_retries=max_retries)
+                if not resume:
+                    await dumper.plan(partitions)
+                started = monotonic()
+                await dumper.run(max_concurrency)
+                dumper._report(force=True)
+        print(f'dumped {checkpoint.fetched} annotations in '
+              f'{monotonic() - started:.0f}s with {dumper.retries} retries',
+              file=sys.stderr)
+
+    get_event_loop().run_until_complete(dump())
+    os.remove(checkpoint.path)
+
+
+if __name__ == '__main__':
+    main()